@@ -70,6 +70,7 @@ setup(
     entry_points={
         'console_scripts' : [
             # 'py_rsync=py_rsync.cli:cli',
+            'py_rsync-compare=py_rsync.compare:main',
         ]
     },
 
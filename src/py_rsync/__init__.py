@@ -4,6 +4,31 @@
 
 from ._version import __version__
 from .main import *
+from .checksum_cache import *
+from .instrument import *
+from .capture import *
+from .run import *
+from .logfile import *
+from .batch import *
+from .relay import *
+from .watch import *
+from .cache_file import *
+from .capabilities import *
+from .benchmark import *
+from .profiles import *
+from .block_size import *
+from .manifest import *
+from .sparse import *
+from .local_copy import *
+from .jobqueue import *
+from .tree_diff import *
+from .columnar import *
+from .small_files import *
+from .retry import *
+from .merkle import *
+from .dataset import *
+from .compare import *
+from .estimate import *
 
 __author__ = "Samuel D. Lotz"
 __email__ = 'samuel.lotz@salotz.info'
@@ -0,0 +1,241 @@
+"""Compute a delta once with `--write-batch` and apply it to many replicas.
+
+A batch is only valid for destinations identical to the reference it
+was written against, so every destination is first checked against
+the reference with an itemized dry run. The batch is then written by
+syncing the source to the reference and read into the matching
+destinations in parallel.
+
+"""
+
+import dataclasses as dc
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Optional,
+    List,
+    Tuple,
+    Sequence,
+)
+
+from .main import (
+    Endpoint,
+    Options,
+    Command,
+    extend_options,
+)
+from .run import (
+    RunResult,
+    run_command,
+    run_argv,
+    parse_itemized,
+)
+from .relay import relay_argv
+
+__all__ = [
+    'BATCH_VERIFY_FLAGS',
+    'BatchDestResult',
+    'BatchResult',
+    'write_batch_command',
+    'read_batch_argv',
+    'verify_command',
+    'verify_argv',
+    'is_in_sync',
+    'batch_fanout',
+]
+
+
+BATCH_VERIFY_FLAGS = (
+    'archive',
+    'dry-run',
+    'itemize-changes',
+    'delete',
+)
+"""Flags of the dry run checking a destination matches the reference."""
+
+
+@dc.dataclass
+class BatchDestResult():
+    """What happened to one destination of a fan-out."""
+
+    dest: Endpoint
+    verified: bool
+    verify_result: Optional[RunResult] = None
+    apply_result: Optional[RunResult] = None
+
+    @property
+    def ok(self) -> bool:
+        return (self.verified and
+                self.apply_result is not None and
+                self.apply_result.returncode == 0)
+
+
+@dc.dataclass
+class BatchResult():
+    """The outcome of a batch fan-out."""
+
+    batch_file: str
+    write_result: Optional[RunResult]
+    destinations: List[BatchDestResult]
+
+    @property
+    def ok(self) -> bool:
+        return (self.write_result is not None and
+                self.write_result.returncode == 0 and
+                all(dest.ok for dest in self.destinations))
+
+
+def write_batch_command(command: Command,
+                        batch_file: str,
+                        only_write: bool = False,
+) -> Command:
+    """Return a copy of the command which also writes a batch file.
+
+    With `only_write` the destination is not updated.
+
+    """
+
+    key = 'only-write-batch' if only_write else 'write-batch'
+
+    return dc.replace(command,
+                      options=extend_options(command.options,
+                                             kv={key : batch_file}))
+
+
+def read_batch_argv(dest: Endpoint,
+                    batch_file: str,
+                    options: Optional[Options] = None,
+                    rsh: str = 'ssh',
+) -> Tuple[List[str], Optional[str]]:
+    """Build the arguments applying a batch to a destination.
+
+    Returns the argument list and the path to feed on standard input,
+    if any. Local destinations read the batch file directly while
+    remote ones run rsync over the remote shell and read it from
+    standard input.
+
+    """
+
+    # reading a batch takes no source so render against the
+    # destination and drop the source which is always rendered
+    # second to last
+    argv = Command(src=dest, dest=dest, options=options).render_argv()[:-2]
+
+    if not dest.url.host:
+        return argv + [f'--read-batch={batch_file}', dest.path], None
+
+    userhost = dest.url.host
+    if dest.url.user:
+        userhost = f'{dest.url.user}@{userhost}'
+
+    remote = argv + ['--read-batch=-', dest.path]
+
+    return (shlex.split(rsh) +
+            [userhost, ' '.join(shlex.quote(arg) for arg in remote)],
+            batch_file)
+
+
+def verify_command(reference: Endpoint,
+                   dest: Endpoint,
+                   options: Optional[Options] = None,
+) -> Command:
+    """Build the dry run comparing a destination to the reference."""
+
+    options = extend_options(options, flags=BATCH_VERIFY_FLAGS)
+
+    return Command(src=reference, dest=dest, options=options)
+
+
+def verify_argv(reference: Endpoint,
+                dest: Endpoint,
+                options: Optional[Options] = None,
+                rsh: str = 'ssh',
+) -> List[str]:
+    """Build the arguments of the dry run comparing a destination.
+
+    rsync can't take two remote endpoints, so when both are remote the
+    dry run is run on the reference host over the remote shell.
+
+    """
+
+    command = verify_command(reference, dest, options)
+
+    if reference.url.host and dest.url.host:
+        return relay_argv(reference, dest, options=command.options, rsh=rsh)
+
+    return command.render_argv()
+
+
+def is_in_sync(result: RunResult) -> bool:
+    """Test whether a verification dry run found no differences."""
+
+    # output too large to keep certainly lists differences
+    return (result.returncode == 0 and
+            result.stdout_path is None and
+            len(parse_itemized(result.stdout)) == 0)
+
+
+def batch_fanout(src: Endpoint,
+                 reference: Endpoint,
+                 destinations: Sequence[Endpoint],
+                 batch_file: str,
+                 options: Optional[Options] = None,
+                 verify: bool = True,
+                 workers: Optional[int] = None,
+                 rsh: str = 'ssh',
+                 instrument=None,
+) -> BatchResult:
+    """Sync src to reference writing a batch and replay it on destinations.
+
+    Destinations failing verification against the reference are
+    skipped. If writing the batch fails nothing is applied.
+
+    """
+
+    dest_results = [BatchDestResult(dest=dest, verified=not verify)
+                    for dest in destinations]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        if verify:
+            verify_results = pool.map(
+                lambda dest: run_argv(verify_argv(reference, dest,
+                                                  options=options,
+                                                  rsh=rsh),
+                                      instrument=instrument),
+                destinations)
+
+            for dest_result, verify_result in zip(dest_results, verify_results):
+                dest_result.verify_result = verify_result
+                dest_result.verified = is_in_sync(verify_result)
+
+        write_result = run_command(
+            write_batch_command(Command(src=src,
+                                        dest=reference,
+                                        options=options),
+                                batch_file),
+            instrument=instrument)
+
+        if write_result.returncode != 0:
+            return BatchResult(batch_file=batch_file,
+                               write_result=write_result,
+                               destinations=dest_results)
+
+        def apply(dest_result):
+
+            argv, stdin_path = read_batch_argv(dest_result.dest,
+                                               batch_file,
+                                               options=options,
+                                               rsh=rsh)
+
+            dest_result.apply_result = run_argv(argv,
+                                                stdin_path=stdin_path,
+                                                instrument=instrument)
+
+        list(pool.map(apply,
+                      [dest_result for dest_result in dest_results
+                       if dest_result.verified]))
+
+    return BatchResult(batch_file=batch_file,
+                       write_result=write_result,
+                       destinations=dest_results)
@@ -0,0 +1,449 @@
+"""Micro-benchmarks for choosing options on a given host.
+
+Results are collected as `BenchmarkResult` samples and can be saved
+as JSON so runs on different hosts or versions can be compared.
+
+"""
+
+import dataclasses as dc
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Sequence,
+)
+
+from .main import (
+    Endpoint,
+    Options,
+    Command,
+    RENDER_CACHE,
+)
+from .manifest import ManifestEntry
+from .columnar import ColumnarManifest
+from .capabilities import probe_capabilities
+from .local_copy import local_copy
+from .small_files import sync_small_files
+
+__all__ = [
+    'BenchmarkResult',
+    'save_results',
+    'load_results',
+    'write_sample_data',
+    'write_small_files',
+    'benchmark_checksums',
+    'benchmark_local_copy',
+    'benchmark_small_files',
+    'benchmark_render',
+    'benchmark_memory',
+    'fastest',
+]
+
+
+@dc.dataclass
+class BenchmarkResult():
+    """Repeated timings of one benchmark case."""
+
+    name: str
+    samples: List[float]
+    size: int = 0
+    count: int = 0
+
+    @property
+    def mean(self) -> float:
+        return statistics.mean(self.samples)
+
+    @property
+    def best(self) -> float:
+        return min(self.samples)
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """Bytes per second of the best sample."""
+
+        if not self.size or not self.best:
+            return None
+
+        return self.size / self.best
+
+    def to_dict(self) -> dict:
+        return dc.asdict(self)
+
+
+def save_results(path, results: Dict[str, BenchmarkResult]) -> None:
+
+    with open(path, 'w') as wf:
+        json.dump({name : result.to_dict()
+                   for name, result in results.items()},
+                  wf,
+                  indent=2)
+
+
+def load_results(path) -> Dict[str, BenchmarkResult]:
+
+    with open(path) as rf:
+        return {name : BenchmarkResult(**d)
+                for name, d in json.load(rf).items()}
+
+
+def write_sample_data(directory,
+                      size: int = 256 * 1024 * 1024,
+                      n_files: int = 4,
+                      seed: int = 0,
+) -> int:
+    """Fill a directory with files of pseudo-random bytes.
+
+    Returns the total number of bytes written.
+
+    """
+
+    rng = random.Random(seed)
+    file_size = size // n_files
+    chunk = 1024 * 1024
+
+    for i in range(n_files):
+        with open(os.path.join(str(directory), f'sample_{i}.bin'), 'wb') as wf:
+            remaining = file_size
+            while remaining > 0:
+                n = min(chunk, remaining)
+                wf.write(rng.getrandbits(8 * n).to_bytes(n, 'little'))
+                remaining -= n
+
+    return file_size * n_files
+
+
+def write_small_files(directory,
+                      n_files: int = 100_000,
+                      file_size: int = 1024,
+                      files_per_dir: int = 1000,
+                      seed: int = 0,
+) -> int:
+    """Fill a directory with many tiny files of pseudo-random bytes.
+
+    Files are spread over subdirectories of `files_per_dir` each.
+    Returns the total number of bytes written.
+
+    """
+
+    rng = random.Random(seed)
+
+    for i in range(n_files):
+        subdir = os.path.join(str(directory), f'dir_{i // files_per_dir}')
+        if i % files_per_dir == 0:
+            os.makedirs(subdir, exist_ok=True)
+
+        with open(os.path.join(subdir, f'small_{i}.bin'), 'wb') as wf:
+            wf.write(rng.getrandbits(8 * file_size).to_bytes(file_size, 'little'))
+
+    return n_files * file_size
+
+
+def benchmark_checksums(sample_dir=None,
+                        algorithms: Optional[Sequence[str]] = None,
+                        repeats: int = 3,
+                        sample_size: int = 256 * 1024 * 1024,
+                        rsync: str = 'rsync',
+) -> Dict[str, BenchmarkResult]:
+    """Time rsync's own checksum implementations on sample data.
+
+    Each algorithm is timed with a `--checksum` dry run from the sample
+    into an empty directory, which makes the sender hash every file.
+    By default all algorithms the local rsync lists are measured and
+    sample data is generated in a temporary directory.
+
+    """
+
+    if algorithms is None:
+        algorithms = [name for name in probe_capabilities(rsync=rsync).checksums
+                      if name != 'none']
+
+    with tempfile.TemporaryDirectory(prefix='py_rsync_bench_') as tmp_dir:
+
+        if sample_dir is None:
+            sample_dir = os.path.join(tmp_dir, 'sample')
+            os.mkdir(sample_dir)
+            write_sample_data(sample_dir, size=sample_size)
+
+        size = 0
+        count = 0
+        for dirpath, _, filenames in os.walk(str(sample_dir)):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+                count += 1
+
+        dest_dir = os.path.join(tmp_dir, 'dest')
+        os.mkdir(dest_dir)
+
+        results = {}
+        for algorithm in algorithms:
+
+            command = Command(
+                src=Endpoint.construct(path=os.path.abspath(str(sample_dir))),
+                dest=Endpoint.construct(path=dest_dir),
+                options=Options(flags=('archive', 'checksum', 'dry-run'),
+                                includes=(),
+                                excludes=(),
+                                info=None,
+                                kv=None,
+                                checksum_choice=algorithm))
+
+            argv = command.render_argv()
+            argv[0] = rsync
+
+            # warm the page cache so only hashing is measured
+            subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+                samples.append(time.perf_counter() - start)
+
+            results[algorithm] = BenchmarkResult(name=algorithm,
+                                                 samples=samples,
+                                                 size=size,
+                                                 count=count)
+
+    return results
+
+
+def fastest(results: Dict[str, BenchmarkResult]) -> Optional[str]:
+    """Get the name of the case with the best time."""
+
+    if not results:
+        return None
+
+    return min(results.values(), key=lambda result: result.best).name
+
+
+def benchmark_local_copy(sample_dir=None,
+                         repeats: int = 3,
+                         sample_size: int = 256 * 1024 * 1024,
+                         workers: Optional[int] = None,
+                         rsync: str = 'rsync',
+) -> Dict[str, BenchmarkResult]:
+    """Time an initial archive copy with the local engine and with rsync.
+
+    Every sample copies into a fresh directory on the same filesystem
+    as the sample data so reflinks can be used where supported.
+
+    """
+
+    with tempfile.TemporaryDirectory(prefix='py_rsync_bench_') as tmp_dir:
+
+        if sample_dir is None:
+            sample_dir = os.path.join(tmp_dir, 'sample')
+            os.mkdir(sample_dir)
+            write_sample_data(sample_dir, size=sample_size)
+
+        size = 0
+        count = 0
+        for dirpath, _, filenames in os.walk(str(sample_dir)):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+                count += 1
+
+        engines = {
+            'local_copy' : lambda command: local_copy(command, workers=workers),
+            'rsync' : lambda command: subprocess.run(
+                [rsync] + command.render_argv()[1:],
+                stdout=subprocess.DEVNULL,
+                check=True),
+        }
+
+        results = {}
+        for name, engine in engines.items():
+
+            samples = []
+            for i in range(repeats):
+                command = Command(
+                    src=Endpoint.construct(
+                        path=os.path.abspath(str(sample_dir))),
+                    dest=Endpoint.construct(
+                        path=os.path.join(tmp_dir, f'{name}_{i}')),
+                    options=Options(flags=('archive',),
+                                    includes=(),
+                                    excludes=(),
+                                    info=None,
+                                    kv=None))
+
+                start = time.perf_counter()
+                engine(command)
+                samples.append(time.perf_counter() - start)
+
+                shutil.rmtree(command.dest.path, ignore_errors=True)
+
+            results[name] = BenchmarkResult(name=name,
+                                            samples=samples,
+                                            size=size,
+                                            count=count)
+
+    return results
+
+
+def benchmark_small_files(sample_dir=None,
+                          repeats: int = 3,
+                          n_files: int = 100_000,
+                          file_size: int = 1024,
+                          n_streams: int = 4,
+                          rsync: str = 'rsync',
+) -> Dict[str, BenchmarkResult]:
+    """Time an initial archive copy of many tiny files with and without tar.
+
+    The small file mode time includes its final rsync pass.
+
+    """
+
+    with tempfile.TemporaryDirectory(prefix='py_rsync_bench_') as tmp_dir:
+
+        if sample_dir is None:
+            sample_dir = os.path.join(tmp_dir, 'sample')
+            os.mkdir(sample_dir)
+            write_small_files(sample_dir, n_files=n_files, file_size=file_size)
+
+        size = 0
+        count = 0
+        for dirpath, _, filenames in os.walk(str(sample_dir)):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+                count += 1
+
+        engines = {
+            'rsync' : lambda command: subprocess.run(
+                [rsync] + command.render_argv()[1:],
+                stdout=subprocess.DEVNULL,
+                check=True),
+            'small_files' : lambda command: sync_small_files(
+                command,
+                n_streams=n_streams,
+                executable=rsync),
+        }
+
+        results = {}
+        for name, engine in engines.items():
+
+            samples = []
+            for i in range(repeats):
+                command = Command(
+                    src=Endpoint.construct(
+                        path=os.path.abspath(str(sample_dir))),
+                    dest=Endpoint.construct(
+                        path=os.path.join(tmp_dir, f'{name}_{i}')),
+                    options=Options(flags=('archive',),
+                                    includes=(),
+                                    excludes=(),
+                                    info=None,
+                                    kv=None))
+
+                start = time.perf_counter()
+                engine(command)
+                samples.append(time.perf_counter() - start)
+
+                shutil.rmtree(command.dest.path, ignore_errors=True)
+
+            results[name] = BenchmarkResult(name=name,
+                                            samples=samples,
+                                            size=size,
+                                            count=count)
+
+    return results
+
+
+def _render_commands(n_commands: int) -> List[Command]:
+
+    return [Command(src=Endpoint.construct(host='source', path=f'/data/src_{i}'),
+                    dest=Endpoint.construct(path=f'/data/dest_{i}'),
+                    options=Options(flags=('archive', 'compress', 'itemize-changes'),
+                                    includes=('*.dat',),
+                                    excludes=('*.tmp', '.cache/'),
+                                    info=None,
+                                    kv={'files-from' : f'/shards/{i}.txt'},
+                                    timeout=60))
+            for i in range(n_commands)]
+
+
+def benchmark_render(n_commands: int = 4096,
+                     repeats: int = 5,
+) -> Dict[str, BenchmarkResult]:
+    """Time rendering distinct commands, uncached and from the render cache.
+
+    At most as many commands as the render cache holds are rendered so
+    the second pass is served from it.
+
+    """
+
+    commands = _render_commands(min(n_commands, RENDER_CACHE.maxsize))
+
+    samples = {'render_uncached' : [], 'render_cached' : []}
+    for _ in range(repeats):
+
+        RENDER_CACHE.clear()
+
+        start = time.perf_counter()
+        for command in commands:
+            command.render_argv()
+        samples['render_uncached'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for command in commands:
+            command.render_argv()
+        samples['render_cached'].append(time.perf_counter() - start)
+
+    RENDER_CACHE.clear()
+
+    return {name : BenchmarkResult(name=name,
+                                   samples=case_samples,
+                                   count=len(commands))
+            for name, case_samples in samples.items()}
+
+
+def benchmark_memory(n_entries: int = 100_000,
+                     repeats: int = 3,
+) -> Dict[str, BenchmarkResult]:
+    """Measure the bytes per file of manifests as objects and as columns.
+
+    The samples are bytes per entry, not times.
+
+    """
+
+    def entries():
+        for i in range(n_entries):
+            yield ManifestEntry(path=f'dir_{i % 1000}/file_{i}.dat',
+                                size=i,
+                                mtime=1.5e9 + i,
+                                kind='f')
+
+    builders = {
+        'manifest_entries' : lambda: list(entries()),
+        'columnar_manifest' : lambda: ColumnarManifest.from_entries(entries()),
+    }
+
+    results = {}
+    for name, build in builders.items():
+
+        samples = []
+        for _ in range(repeats):
+            tracemalloc.start()
+            try:
+                manifest = build()
+                used, _ = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+            samples.append(used / n_entries)
+            del manifest
+
+        results[name] = BenchmarkResult(name=name,
+                                        samples=samples,
+                                        count=n_entries)
+
+    return results
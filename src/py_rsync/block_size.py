@@ -0,0 +1,306 @@
+"""Adaptive `--block-size` selection for large-file delta transfers.
+
+rsync picks a block size of about the square root of the file size,
+which for very large files with small localized changes (VM images,
+databases) sends far more literal data than needed. Here files over a
+threshold are split into their own jobs and each gets a block size
+chosen per size class from the bytes past runs put on the wire,
+literal data plus the block checksums, relative to the file size.
+Block sizes not yet tried for a class are explored first, and ones
+whose runs failed, e.g. over rsync's `--max-alloc` for small blocks of
+huge files, are not tried again. Every decision is kept on the plan
+for inspection.
+
+"""
+
+import dataclasses as dc
+import json
+import os
+import tempfile
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Sequence,
+)
+
+from .main import (
+    Command,
+    extend_options,
+    protect_paths,
+)
+from .run import TransferStats
+from .checksum_cache import walk_files
+from .columnar import ColumnarManifest
+
+__all__ = [
+    'LARGE_FILE_THRESHOLD',
+    'BLOCK_SIZE_CANDIDATES',
+    'size_class',
+    'BlockSizeDecision',
+    'BlockSizeHistory',
+    'LargeFilePlan',
+    'plan_large_files',
+]
+
+
+LARGE_FILE_THRESHOLD = 1024**3
+"""Files of at least this many bytes get their own tuned job."""
+
+BLOCK_SIZE_CANDIDATES = (
+    2048,
+    8192,
+    32768,
+    131072,
+)
+"""The block sizes tried for each size class."""
+
+
+def size_class(size: int) -> int:
+    """Bucket a file size into power of 4 classes above the threshold."""
+
+    klass = 0
+    bound = LARGE_FILE_THRESHOLD
+    while size >= bound:
+        klass += 1
+        bound *= 4
+
+    return klass
+
+
+@dc.dataclass
+class BlockSizeDecision():
+    """The block size chosen for a file and why."""
+
+    path: str
+    size: int
+    size_class: int
+    # `None` leaves the choice to rsync
+    block_size: Optional[int]
+    reason: str
+
+    def to_dict(self) -> dict:
+        return dc.asdict(self)
+
+
+class BlockSizeHistory():
+    """Past results per size class and block size, kept as JSON lines."""
+
+    def __init__(self, path):
+
+        self.path = str(path)
+
+        # (size class, block size) -> list of wire byte fractions
+        self.records: Dict[tuple, List[float]] = {}
+
+        # (size class, block size) -> number of failed runs
+        self.failures: Dict[tuple, int] = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as rf:
+                for line in rf:
+                    if line.strip():
+                        record = json.loads(line)
+                        key = (record['size_class'], record['block_size'])
+                        if record.get('failed'):
+                            self.failures[key] = self.failures.get(key, 0) + 1
+                        else:
+                            self._add(*key, record['wire_fraction'])
+
+    def _add(self, klass, block_size, wire_fraction):
+        self.records.setdefault((klass, block_size), [])\
+                    .append(wire_fraction)
+
+    def _write(self, record: dict) -> None:
+
+        with open(self.path, 'a') as wf:
+            wf.write(json.dumps(record) + '\n')
+
+    def record(self,
+               decision: BlockSizeDecision,
+               stats: TransferStats,
+               returncode: int = 0,
+    ) -> Optional[float]:
+        """Add the outcome of the job a decision was made for.
+
+        Returns the bytes sent and received relative to the file size.
+        A run which failed, or whose stats don't say, is recorded as a
+        failure of the block size and `None` is returned.
+
+        """
+
+        if decision.block_size is None:
+            return None
+
+        key = (decision.size_class, decision.block_size)
+
+        failed = returncode != 0 or None in (stats.literal_data,
+                                             stats.matched_data,
+                                             stats.bytes_sent,
+                                             stats.bytes_received)
+
+        # an empty file says nothing about the block size
+        if not failed and stats.literal_data + stats.matched_data == 0:
+            return None
+
+        if failed:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            self._write({
+                'size_class' : decision.size_class,
+                'block_size' : decision.block_size,
+                'failed' : True,
+                'returncode' : returncode,
+                'path' : decision.path,
+                'size' : decision.size,
+            })
+            return None
+
+        total = stats.literal_data + stats.matched_data
+        wire_fraction = (stats.bytes_sent + stats.bytes_received) / total
+
+        self._add(*key, wire_fraction)
+
+        self._write({
+            'size_class' : decision.size_class,
+            'block_size' : decision.block_size,
+            'wire_fraction' : wire_fraction,
+            'literal_data' : stats.literal_data,
+            'matched_data' : stats.matched_data,
+            'path' : decision.path,
+            'size' : decision.size,
+        })
+
+        return wire_fraction
+
+    def choose(self,
+               path: str,
+               size: int,
+               candidates: Sequence[int] = BLOCK_SIZE_CANDIDATES,
+    ) -> BlockSizeDecision:
+        """Choose the block size for a file.
+
+        Untried candidates are explored in order, afterwards the one
+        with the least mean bytes on the wire is used. Candidates which
+        failed and never succeeded for the size class are skipped, and
+        when that leaves none the block size is left to rsync.
+
+        """
+
+        klass = size_class(size)
+
+        candidates = [block_size for block_size in candidates
+                      if (klass, block_size) in self.records or
+                         (klass, block_size) not in self.failures]
+
+        if not candidates:
+            return BlockSizeDecision(path=path,
+                                     size=size,
+                                     size_class=klass,
+                                     block_size=None,
+                                     reason='every candidate failed')
+
+        for block_size in candidates:
+            if (klass, block_size) not in self.records:
+                return BlockSizeDecision(path=path,
+                                         size=size,
+                                         size_class=klass,
+                                         block_size=block_size,
+                                         reason='explore')
+
+        def mean_wire(block_size):
+            fractions = self.records[(klass, block_size)]
+            return sum(fractions) / len(fractions)
+
+        best = min(candidates, key=mean_wire)
+
+        return BlockSizeDecision(
+            path=path,
+            size=size,
+            size_class=klass,
+            block_size=best,
+            reason=f'least bytes on the wire ({mean_wire(best):.4f})')
+
+
+@dc.dataclass
+class LargeFilePlan():
+    """Jobs for the large files and one for the rest of the tree."""
+
+    rest: Command
+    large: List[Command]
+    decisions: List[BlockSizeDecision]
+
+
+def plan_large_files(command: Command,
+                     history: BlockSizeHistory,
+                     threshold: int = LARGE_FILE_THRESHOLD,
+                     candidates: Sequence[int] = BLOCK_SIZE_CANDIDATES,
+                     files_from_dir: Optional[str] = None,
+                     manifest: Optional[ColumnarManifest] = None,
+) -> LargeFilePlan:
+    """Split the large files of a local source into tuned jobs.
+
+    Each large file gets a job with a `--files-from` list of just it,
+    its chosen block size and `--stats` to record the outcome from.
+    The job for the rest of the tree leaves the large files out with
+    hide and protect rules, so it doesn't delete them even with
+    '--delete-excluded'. The decisions are in the same order as the
+    large jobs. A columnar manifest of the source can be given to
+    select the large files from instead of walking the tree.
+
+    """
+
+    if command.src.url.host:
+        raise ValueError("Large file planning requires a local source")
+
+    if files_from_dir is None:
+        files_from_dir = tempfile.mkdtemp(prefix='py_rsync_large_')
+
+    root = command.src.path
+
+    if manifest is None:
+        sized_files = ((rel_path, os.path.getsize(os.path.join(root, rel_path)))
+                       for rel_path in walk_files(root))
+    else:
+        sized_files = ((manifest.path(i), manifest.sizes[i])
+                       for i in manifest.select(min_size=threshold))
+
+    large = []
+    decisions = []
+    large_paths = []
+    for rel_path, size in sized_files:
+
+        if size < threshold:
+            continue
+
+        decision = history.choose(rel_path, size, candidates=candidates)
+
+        files_from = os.path.join(files_from_dir, f'large_{len(large)}.txt')
+        with open(files_from, 'w') as wf:
+            wf.write(rel_path + '\n')
+
+        # the stats are what the history learns from
+        options = extend_options(command.options,
+                                 flags=('stats',),
+                                 kv={'files-from' : files_from})
+
+        # force the delta algorithm, which local transfers skip by
+        # default, or the block size would be meaningless
+        options = dc.replace(options,
+                             flags=tuple(flag for flag in options.flags
+                                         if flag != 'whole-file') +
+                                   ('no-whole-file',),
+                             block_size=decision.block_size)
+
+        large.append(dc.replace(command, options=options))
+        decisions.append(decision)
+        large_paths.append(rel_path)
+
+    rest_options = command.options
+    if large_paths:
+        rest_options = protect_paths(rest_options,
+                                     large_paths,
+                                     os.path.join(files_from_dir, 'large.rules'))
+
+    return LargeFilePlan(rest=dc.replace(command, options=rest_options),
+                         large=large,
+                         decisions=decisions)
@@ -0,0 +1,39 @@
+"""JSON files caching probed and learned values between runs.
+
+A cache is a single JSON object kept under `~/.cache/py_rsync` by
+default. A missing or corrupt file reads as empty, so a cache can
+always be thrown away, and writes replace the file atomically.
+
+"""
+
+import json
+import os
+from pathlib import Path
+
+__all__ = [
+    'load_cache',
+    'save_cache',
+]
+
+
+def load_cache(cache_path) -> dict:
+    """Read a cache file, empty when missing or unreadable."""
+
+    try:
+        with open(cache_path) as rf:
+            return json.load(rf)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache_path, cache: dict) -> None:
+    """Write a cache file, creating its directory when needed."""
+
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = cache_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as wf:
+        json.dump(cache, wf, indent=2)
+
+    os.replace(tmp_path, cache_path)
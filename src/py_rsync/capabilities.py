@@ -0,0 +1,298 @@
+"""Probe what an rsync binary supports and pick the fastest choices.
+
+Newer rsync builds list their supported checksum and compression
+algorithms in `rsync --version`. Probing is done once per binary, or
+per remote host through the remote shell, and the parsed results are
+cached on disk with a time-to-live so later runs don't pay for it.
+
+"""
+
+import dataclasses as dc
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import (
+    Optional,
+    Tuple,
+    Sequence,
+)
+
+from .main import (
+    Command,
+    extend_options,
+)
+from .cache_file import (
+    load_cache,
+    save_cache,
+)
+
+__all__ = [
+    'CHECKSUM_PREFERENCE',
+    'COMPRESS_PREFERENCE',
+    'CAPABILITIES_CACHE_PATH',
+    'CAPABILITIES_TTL',
+    'RsyncCapabilities',
+    'parse_version_output',
+    'probe_capabilities',
+    'command_capabilities',
+    'best_choice',
+    'auto_choices',
+]
+
+
+CHECKSUM_PREFERENCE = (
+    'xxh128',
+    'xxh3',
+    'xxh64',
+    'md5',
+    'md4',
+)
+"""Checksum algorithms by preference, the fast non-cryptographic ones first."""
+
+COMPRESS_PREFERENCE = (
+    'zstd',
+    'lz4',
+    'zlibx',
+    'zlib',
+)
+"""Compression algorithms from the best ratio/speed trade-off down."""
+
+CAPABILITIES_CACHE_PATH = Path('~/.cache/py_rsync/capabilities.json')
+"""Default location of the on-disk probe cache."""
+
+CAPABILITIES_TTL = 24 * 60 * 60
+"""Seconds a cached probe is trusted for."""
+
+VERSION_RE = re.compile(r'rsync\s+version\s+v?(?P<version>\S+)\s+'
+                        r'protocol version\s+(?P<protocol>\d+)')
+
+VERSION_SECTIONS = {
+    # heading in the version output : field
+    'Capabilities' : 'capabilities',
+    'Optimizations' : 'optimizations',
+    'Checksum list' : 'checksums',
+    'Compress list' : 'compressions',
+}
+
+_MEMORY_CACHE = {}
+
+
+@dc.dataclass
+class RsyncCapabilities():
+    """What an rsync binary reported about itself."""
+
+    version: str
+    protocol: int
+    capabilities: Tuple[str] = ()
+    optimizations: Tuple[str] = ()
+    checksums: Tuple[str] = ()
+    compressions: Tuple[str] = ()
+    probed: float = 0.0
+
+    @property
+    def version_info(self) -> Tuple[int]:
+        return tuple(int(part)
+                     for part in re.findall(r'\d+', self.version)[:3])
+
+    def has_capability(self, name: str) -> bool:
+        return name in self.capabilities
+
+    def to_dict(self) -> dict:
+        return dc.asdict(self)
+
+    @classmethod
+    def from_dict(cls, d) -> 'RsyncCapabilities':
+        return cls(**{key : tuple(value) if isinstance(value, list) else value
+                      for key, value in d.items()})
+
+
+def parse_version_output(output: str) -> RsyncCapabilities:
+    """Parse the output of `rsync --version`.
+
+    Builds too old to print checksum or compression lists get the
+    algorithms implied by their protocol version.
+
+    """
+
+    match = VERSION_RE.search(output)
+    if match is None:
+        raise ValueError("Not recognized as rsync version output")
+
+    sections = {field : [] for field in VERSION_SECTIONS.values()}
+    current = None
+    for line in output.splitlines():
+
+        heading = line.rstrip().rstrip(':')
+        if line.rstrip().endswith(':') and heading in VERSION_SECTIONS:
+            current = VERSION_SECTIONS[heading]
+            continue
+
+        if current is None or not line.startswith((' ', '\t')):
+            current = None
+            continue
+
+        if current in ('checksums', 'compressions'):
+            # e.g. "xxh128 xxh3 xxh64 (xxhash) md5 md4 none"
+            words = re.sub(r'\([^)]*\)', ' ', line).split()
+        else:
+            words = [word.strip() for word in line.split(',')]
+
+        sections[current].extend(word for word in words if word)
+
+    protocol = int(match.group('protocol'))
+
+    if not sections['checksums']:
+        sections['checksums'] = ['md5'] if protocol >= 30 else ['md4']
+
+    if not sections['compressions']:
+        sections['compressions'] = ['zlib']
+
+    return RsyncCapabilities(version=match.group('version'),
+                             protocol=protocol,
+                             probed=time.time(),
+                             **{field : tuple(words)
+                                for field, words in sections.items()})
+
+
+def probe_capabilities(rsync: str = 'rsync',
+                       host: Optional[str] = None,
+                       user: Optional[str] = None,
+                       rsh: str = 'ssh',
+                       cache_path=CAPABILITIES_CACHE_PATH,
+                       ttl: float = CAPABILITIES_TTL,
+                       refresh: bool = False,
+) -> RsyncCapabilities:
+    """Get the capabilities of a local binary or the rsync on a host.
+
+    Results are cached in memory and in the JSON file at `cache_path`
+    (disabled when `None`). Local entries are keyed by the resolved
+    binary and its modification time so upgrades are noticed.
+
+    """
+
+    if host is None:
+        resolved = shutil.which(rsync) or rsync
+        try:
+            mtime = os.stat(resolved).st_mtime
+        except OSError:
+            mtime = 0
+        key = f"local:{os.path.realpath(resolved)}:{mtime}"
+        argv = [resolved, '--version']
+
+    else:
+        userhost = f"{user}@{host}" if user else host
+        key = f"remote:{userhost}:{rsync}"
+        argv = shlex.split(rsh) + [userhost, f"{shlex.quote(rsync)} --version"]
+
+    now = time.time()
+
+    cached = _MEMORY_CACHE.get(key)
+    if cached is not None and not refresh and now - cached.probed < ttl:
+        return cached
+
+    if cache_path is not None:
+        cache_path = Path(cache_path).expanduser()
+        disk_cache = load_cache(cache_path)
+
+        entry = disk_cache.get(key)
+        if entry is not None and not refresh and now - entry['probed'] < ttl:
+            cached = RsyncCapabilities.from_dict(entry)
+            _MEMORY_CACHE[key] = cached
+            return cached
+
+    proc = subprocess.run(argv,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"Probing rsync failed: {proc.stderr.strip()}")
+
+    caps = parse_version_output(proc.stdout)
+    _MEMORY_CACHE[key] = caps
+
+    if cache_path is not None:
+        disk_cache[key] = caps.to_dict()
+        save_cache(cache_path, disk_cache)
+
+    return caps
+
+
+def command_capabilities(command: Command,
+                         rsync: str = 'rsync',
+                         **kwargs,
+) -> Tuple[RsyncCapabilities, Optional[RsyncCapabilities]]:
+    """Probe the local rsync and that of the remote end of a command.
+
+    The remote is `None` for local to local commands.
+
+    """
+
+    local = probe_capabilities(rsync=rsync, **kwargs)
+
+    remote_url = command.src.url if command.src.url.host else command.dest.url
+    if not remote_url.host:
+        return local, None
+
+    remote = probe_capabilities(rsync=rsync,
+                                host=remote_url.host,
+                                user=remote_url.user or None,
+                                **kwargs)
+
+    return local, remote
+
+
+def best_choice(preference: Sequence[str],
+                *supported: Sequence[str],
+) -> Optional[str]:
+    """Get the first preferred algorithm supported by every side."""
+
+    for name in preference:
+        if all(name in side for side in supported):
+            return name
+
+    return None
+
+
+def auto_choices(command: Command,
+                 local: RsyncCapabilities,
+                 remote: Optional[RsyncCapabilities] = None,
+) -> Command:
+    """Return a copy of the command using the preferred shared algorithms.
+
+    The checksum and, when compressing, the compression algorithm are
+    only chosen if every side is new enough to negotiate them and the
+    command doesn't already choose them.
+
+    """
+
+    sides = [local] if remote is None else [local, remote]
+
+    # the choice options came with rsync 3.2.0
+    if any(side.version_info < (3, 2) for side in sides):
+        return command
+
+    options = extend_options(command.options)
+    given = options.kv or {}
+    kv = {}
+
+    checksum = best_choice(CHECKSUM_PREFERENCE,
+                           *[side.checksums for side in sides])
+    if (checksum is not None and
+        options.checksum_choice is None and
+        'checksum-choice' not in given):
+        options = dc.replace(options, checksum_choice=checksum)
+
+    flags = options.flags or ()
+    if 'compress' in flags and 'compress-choice' not in given:
+        compression = best_choice(COMPRESS_PREFERENCE,
+                                  *[side.compressions for side in sides])
+        if compression is not None:
+            kv['compress-choice'] = compression
+
+    return dc.replace(command,
+                      options=extend_options(options, kv=kv))
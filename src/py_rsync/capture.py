@@ -0,0 +1,270 @@
+"""Bounded memory capture of a process's output.
+
+With `verbose` and `itemize-changes` rsync can write hundreds of
+megabytes, which `communicate` would hold in memory as a whole. Here
+standard output and error are read together with `selectors` as they
+are written, so neither pipe fills up and blocks the process. Each
+stream is split into lines, at carriage returns too as progress
+output uses them, which are passed to registered parsers as they
+arrive and kept in a ring buffer of the most recent output. The
+complete output is kept in memory up to a threshold and spilled to a
+temporary file beyond it.
+
+"""
+
+import os
+import re
+import selectors
+import subprocess
+import tempfile
+from collections import deque
+from typing import (
+    Optional,
+    Callable,
+    Dict,
+    List,
+)
+
+__all__ = [
+    'RING_SIZE',
+    'SPILL_THRESHOLD',
+    'RingBuffer',
+    'drain_pipe',
+    'StreamCapture',
+    'OutputCapture',
+]
+
+
+RING_SIZE = 1024 * 1024
+"""Default bytes of the most recent output kept per stream."""
+
+SPILL_THRESHOLD = 64 * 1024 * 1024
+"""Default bytes of output per stream kept in memory before spilling."""
+
+READ_SIZE = 64 * 1024
+
+LINE_BREAK_RE = re.compile(rb'\r\n|\r|\n')
+
+
+class RingBuffer():
+    """The most recent lines written, up to a number of bytes.
+
+    The last line is always kept even if it's larger than the
+    capacity.
+
+    """
+
+    def __init__(self, capacity: int = RING_SIZE):
+
+        self.capacity = capacity
+        self.nbytes = 0
+        self.dropped = 0
+        self._lines = deque()
+
+    def append(self, line: bytes) -> None:
+
+        self._lines.append(line)
+        self.nbytes += len(line)
+
+        while self.nbytes > self.capacity and len(self._lines) > 1:
+            self.nbytes -= len(self._lines.popleft())
+            self.dropped += 1
+
+    def getvalue(self) -> bytes:
+        return b''.join(self._lines)
+
+
+def drain_pipe(pipe, ring: RingBuffer) -> None:
+    """Read a binary pipe's lines into a ring buffer until it closes.
+
+    This is meant to run in a thread while the process's other output
+    is consumed elsewhere, so a chatty standard error can't fill its
+    pipe and block the process.
+
+    """
+
+    for line in pipe:
+        ring.append(line)
+
+    pipe.close()
+
+
+class StreamCapture():
+    """Capture of a single output stream."""
+
+    def __init__(self,
+                 name: str,
+                 ring_size: int = RING_SIZE,
+                 spill_threshold: Optional[int] = SPILL_THRESHOLD,
+                 spill_dir: Optional[str] = None,
+    ):
+
+        self.name = name
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+
+        self.parsers: List[Callable[[str], None]] = []
+        self.ring = RingBuffer(ring_size)
+        self.nbytes = 0
+        self.n_lines = 0
+
+        # the path of the complete output once spilled to disk
+        self.spill_path: Optional[str] = None
+
+        self._memory = bytearray()
+        self._spill_file = None
+        self._partial = b''
+
+    @property
+    def spilled(self) -> bool:
+        return self.spill_path is not None
+
+    def feed(self, chunk: bytes) -> None:
+        """Take a chunk read from the stream."""
+
+        self.nbytes += len(chunk)
+
+        if self._spill_file is not None:
+            self._spill_file.write(chunk)
+
+        else:
+            self._memory += chunk
+
+            if (self.spill_threshold is not None and
+                len(self._memory) > self.spill_threshold):
+                self._spill()
+
+        data = self._partial + chunk
+        lines = LINE_BREAK_RE.split(data)
+        self._partial = lines.pop()
+
+        # a carriage return may be followed by a newline in the next
+        # chunk, so the line before it waits for that
+        if data.endswith(b'\r'):
+            self._partial = lines.pop() + b'\r'
+
+        for line in lines:
+            self._line(line + b'\n')
+
+        # output without any line breaks is cut into lines of the ring
+        # size, keeping the memory bounded and the copying linear
+        if len(self._partial) >= self.ring.capacity:
+            self._line(self._partial)
+            self._partial = b''
+
+    def _spill(self) -> None:
+
+        fd, self.spill_path = tempfile.mkstemp(prefix=f'py_rsync_{self.name}_',
+                                               suffix='.log',
+                                               dir=self.spill_dir)
+        self._spill_file = os.fdopen(fd, 'wb')
+        self._spill_file.write(self._memory)
+        self._memory = bytearray()
+
+    def _line(self, line: bytes) -> None:
+
+        self.n_lines += 1
+        self.ring.append(line)
+
+        if self.parsers:
+            text = line.decode(errors='replace').rstrip('\n')
+            for parser in self.parsers:
+                parser(text)
+
+    def close(self) -> None:
+        """Flush a last line without a newline and close the spill file."""
+
+        if self._partial:
+            self._line(self._partial.rstrip(b'\r'))
+            self._partial = b''
+
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def tail(self) -> str:
+        """The most recent output kept in the ring buffer."""
+
+        return self.ring.getvalue().decode(errors='replace')
+
+    def text(self) -> Optional[str]:
+        """The complete output, or `None` when it was spilled to disk."""
+
+        if self.spilled:
+            return None
+
+        return self._memory.decode(errors='replace')
+
+
+class OutputCapture():
+    """Concurrent capture of standard output and error of one process.
+
+    Line parsers are registered per stream with `add_parser` and called
+    with each line, without its newline, from the thread calling `run`.
+    An instance is for a single process.
+
+    """
+
+    def __init__(self,
+                 ring_size: int = RING_SIZE,
+                 spill_threshold: Optional[int] = SPILL_THRESHOLD,
+                 spill_dir: Optional[str] = None,
+    ):
+
+        self.streams: Dict[str, StreamCapture] = {
+            name : StreamCapture(name,
+                                 ring_size=ring_size,
+                                 spill_threshold=spill_threshold,
+                                 spill_dir=spill_dir)
+            for name in ('stdout', 'stderr')
+        }
+
+    @property
+    def stdout(self) -> StreamCapture:
+        return self.streams['stdout']
+
+    @property
+    def stderr(self) -> StreamCapture:
+        return self.streams['stderr']
+
+    def add_parser(self,
+                   stream: str,
+                   parser: Callable[[str], None],
+    ) -> None:
+
+        if stream not in self.streams:
+            raise ValueError(f"Stream '{stream}' not recognized.")
+
+        self.streams[stream].parsers.append(parser)
+
+    def run(self, proc: subprocess.Popen) -> int:
+        """Read the process's pipes until both close and wait for it.
+
+        The process must have been started with binary pipes for
+        standard output and error. Returns its return code.
+
+        """
+
+        selector = selectors.DefaultSelector()
+        for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+            if pipe is not None:
+                selector.register(pipe, selectors.EVENT_READ, self.streams[name])
+
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+
+                    chunk = os.read(key.fd, READ_SIZE)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        continue
+
+                    key.data.feed(chunk)
+
+        finally:
+            selector.close()
+            for stream in self.streams.values():
+                stream.close()
+
+        return proc.wait()
@@ -0,0 +1,293 @@
+"""Persistent checksum cache for pre-filtering `--checksum` syncs.
+
+In `--checksum` mode rsync reads every byte of every file on both
+sides. When trees rarely change most of that work is repeated for
+nothing. This module keeps a local SQLite cache of file digests keyed
+by (path, size, mtime, inode) so only files whose stat signature
+changed are re-hashed, and uses it to compute the subset of files that
+really need rsync's checksum comparison.
+
+"""
+
+import dataclasses as dc
+import hashlib
+import mmap
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    Optional,
+    Tuple,
+    Generator,
+    Mapping,
+    Dict,
+    List,
+)
+
+from .main import (
+    Command,
+    extend_options,
+)
+
+__all__ = [
+    'CHECKSUM_CACHE_ALGORITHM',
+    'FileKey',
+    'ChecksumCache',
+    'hash_file',
+    'walk_files',
+    'checksum_changed_files',
+    'checksum_prefilter',
+]
+
+
+CHECKSUM_CACHE_ALGORITHM = 'md5'
+"""Default hashlib algorithm used for cached digests."""
+
+HASH_CHUNK_SIZE = 64 * 1024 * 1024
+"""Number of bytes of a mapped file handed to the hasher at once."""
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL
+)
+"""
+
+
+@dc.dataclass(frozen=True)
+class FileKey():
+    """The stat signature which a cached digest is valid for."""
+
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def from_path(cls, path) -> 'FileKey':
+
+        st = os.stat(path)
+
+        return cls(path=str(Path(path).absolute()),
+                   size=st.st_size,
+                   mtime_ns=st.st_mtime_ns,
+                   inode=st.st_ino)
+
+
+def hash_file(path,
+              algorithm: str = CHECKSUM_CACHE_ALGORITHM,
+) -> str:
+    """Hash a file by memory-mapping it, returning the hex digest.
+
+    Hashing the mapped buffer releases the GIL so this can be run in
+    parallel from a thread pool.
+
+    """
+
+    hasher = hashlib.new(algorithm)
+
+    with open(path, 'rb') as rf:
+
+        # empty files can't be mapped
+        size = os.fstat(rf.fileno()).st_size
+        if size == 0:
+            return hasher.hexdigest()
+
+        # slicing the view hands the mapped pages to the hasher
+        # without copying them, the view must be released before the
+        # map is closed
+        with mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+             memoryview(mm) as view:
+            for offset in range(0, size, HASH_CHUNK_SIZE):
+                hasher.update(view[offset:offset + HASH_CHUNK_SIZE])
+
+    return hasher.hexdigest()
+
+
+def walk_files(root) -> Generator[str, None, None]:
+    """Yield the paths of regular files under root relative to it.
+
+    Symlinks are not followed and are not yielded.
+
+    """
+
+    root = str(root)
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+
+                rel_path = os.path.join(rel_dir, entry.name)
+
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel_path)
+
+                elif entry.is_file(follow_symlinks=False):
+                    yield rel_path
+
+
+class ChecksumCache():
+    """SQLite backed store of file digests keyed by stat signature."""
+
+    def __init__(self,
+                 db_path,
+                 algorithm: str = CHECKSUM_CACHE_ALGORITHM,
+    ):
+
+        self.db_path = str(db_path)
+        self.algorithm = algorithm
+
+        self._conn = sqlite3.connect(self.db_path)
+        self._conn.execute(CACHE_SCHEMA)
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def lookup(self, key: FileKey) -> Optional[str]:
+        """Get the digest for a file if its stat signature is unchanged."""
+
+        row = self._conn.execute(
+            "SELECT size, mtime_ns, inode, algorithm, digest "
+            "FROM checksums WHERE path = ?",
+            (key.path,)).fetchone()
+
+        if row is None:
+            return None
+
+        size, mtime_ns, inode, algorithm, digest = row
+        if (size, mtime_ns, inode, algorithm) != \
+           (key.size, key.mtime_ns, key.inode, self.algorithm):
+            return None
+
+        return digest
+
+    def store(self, digests: Mapping[FileKey, str]) -> None:
+        """Record many digests in a single transaction."""
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO checksums "
+                "(path, size, mtime_ns, inode, algorithm, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(key.path, key.size, key.mtime_ns, key.inode,
+                  self.algorithm, digest)
+                 for key, digest in digests.items()])
+
+    def tree_checksums(self,
+                       root,
+                       workers: Optional[int] = None,
+    ) -> Dict[str, str]:
+        """Get digests for every file under root, keyed by relative path.
+
+        Only files missing from the cache or whose stat signature
+        changed are read, and those are hashed in parallel.
+
+        """
+
+        root = Path(root).absolute()
+
+        digests = {}
+        stale = {}
+        for rel_path in walk_files(root):
+            key = FileKey.from_path(root / rel_path)
+            digest = self.lookup(key)
+
+            if digest is None:
+                stale[rel_path] = key
+            else:
+                digests[rel_path] = digest
+
+        if stale:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                new_digests = pool.map(
+                    lambda key: hash_file(key.path, self.algorithm),
+                    stale.values())
+
+                new_digests = dict(zip(stale.values(), new_digests))
+
+            self.store(new_digests)
+
+            for rel_path, key in stale.items():
+                digests[rel_path] = new_digests[key]
+
+        return digests
+
+
+def checksum_changed_files(src_root,
+                           dest_root,
+                           cache: ChecksumCache,
+                           workers: Optional[int] = None,
+) -> List[str]:
+    """Get the sorted relative paths whose contents differ between trees.
+
+    Files missing from the destination are included. Files only in
+    the destination are not, deletions are left to rsync.
+
+    """
+
+    src_digests = cache.tree_checksums(src_root, workers=workers)
+
+    if Path(dest_root).is_dir():
+        dest_digests = cache.tree_checksums(dest_root, workers=workers)
+    else:
+        dest_digests = {}
+
+    return sorted(rel_path
+                  for rel_path, digest in src_digests.items()
+                  if dest_digests.get(rel_path) != digest)
+
+
+def checksum_prefilter(command: Command,
+                       cache: ChecksumCache,
+                       files_from: Optional[str] = None,
+                       workers: Optional[int] = None,
+) -> Tuple[Command, List[str]]:
+    """Restrict a checksum sync to the files the cache says changed.
+
+    Both endpoints must be local. The changed paths are written to a
+    `--files-from` list (a temporary file when `files_from` is not
+    given) and a copy of the command using it together with
+    `--checksum` is returned along with the paths.
+
+    A temporary list belongs to the caller, who removes it once the
+    command ran; its path is the command's 'files-from' option.
+
+    """
+
+    if command.src.url.host or command.dest.url.host:
+        raise ValueError("Checksum prefiltering requires local endpoints")
+
+    changed = checksum_changed_files(command.src.path,
+                                     command.dest.path,
+                                     cache,
+                                     workers=workers)
+
+    if files_from is None:
+        fd, files_from = tempfile.mkstemp(prefix='py_rsync_files_from_',
+                                          suffix='.txt')
+        os.close(fd)
+
+    with open(files_from, 'w') as wf:
+        for rel_path in changed:
+            wf.write(rel_path + '\n')
+
+    options = extend_options(command.options,
+                             flags=('checksum',),
+                             kv={'files-from' : files_from})
+
+    return dc.replace(command, options=options), changed
@@ -0,0 +1,332 @@
+"""Compact columnar manifests for trees of very many files.
+
+A list of `ManifestEntry` objects costs a couple hundred bytes per
+file. Here the same data is kept in typed `array` columns: sizes,
+modification times, kinds, and the path as the index of its interned
+parent directory plus the offset of its name in a single byte blob.
+That is around 30 bytes per file plus the name.
+
+Filters over the columns return arrays of row indices. Without numpy
+they aren't vectorized: the kind filter is a single `bytes.translate`
+but size and time ranges still compare every row in Python, about
+0.07 seconds per million rows and condition, so seconds at a hundred
+million rows. Manifests are saved as one file of raw columns which is
+memory mapped on load, so opening one is instant and only the pages
+used are read. A loaded manifest holds the mapping until `close`.
+
+"""
+
+import itertools
+import mmap
+import os
+import struct
+from array import array
+from typing import (
+    Optional,
+    Iterable,
+    Iterator,
+    Sequence,
+    Dict,
+)
+
+from .manifest import (
+    ManifestEntry,
+    scan_local,
+)
+
+__all__ = [
+    'ColumnarManifest',
+    'scan_columnar',
+]
+
+
+COLUMNAR_MAGIC = b'PYRSCOL1'
+
+# magic, then the number of rows, directories, name blob bytes and
+# directory blob bytes
+HEADER = struct.Struct('<8sQQQQ')
+
+# the columns in file order with their array typecodes, followed in
+# the file by the name and directory blobs
+COLUMNS = (
+    ('sizes', 'q'),
+    ('mtimes', 'd'),
+    ('dir_ids', 'I'),
+    ('name_offsets', 'Q'),
+    ('dir_offsets', 'Q'),
+    ('kinds', 'B'),
+)
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class ColumnarManifest():
+    """A manifest stored as columns.
+
+    Columns are `array`s while building and memoryviews of the mapped
+    file after `load`. In both cases a manifest loaded from disk is
+    read only, and should be closed, or used as a context manager, to
+    unmap the file.
+
+    """
+
+    def __init__(self):
+
+        self.sizes = array('q')
+        self.mtimes = array('d')
+        self.kinds = array('B')
+        self.dir_ids = array('I')
+
+        # name i is names[name_offsets[i]:name_offsets[i+1]]
+        self.name_offsets = array('Q', [0])
+        self.names = bytearray()
+
+        self.dir_offsets = array('Q', [0])
+        self.dirs = bytearray()
+
+        self._dir_index: Optional[Dict[str, int]] = {}
+        self._mmap = None
+        self._view = None
+
+    def close(self) -> None:
+        """Unmap a loaded manifest, leaving it empty."""
+
+        if self._mmap is None:
+            return
+
+        # the mapping can't be closed while views of it are alive
+        for name in [name for name, _ in COLUMNS] + ['names', 'dirs']:
+            getattr(self, name).release()
+        self._view.release()
+        self._mmap.close()
+
+        self.__init__()
+        self._dir_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[ManifestEntry]) -> 'ColumnarManifest':
+
+        manifest = cls()
+        for entry in entries:
+            manifest.append(entry)
+
+        return manifest
+
+    def append(self, entry: ManifestEntry) -> None:
+
+        if self._dir_index is None:
+            raise ValueError("Loaded manifests are read only")
+
+        dirname, _, name = entry.path.rpartition('/')
+
+        dir_id = self._dir_index.get(dirname)
+        if dir_id is None:
+            dir_id = len(self._dir_index)
+            self._dir_index[dirname] = dir_id
+            self.dirs += os.fsencode(dirname)
+            self.dir_offsets.append(len(self.dirs))
+
+        self.names += os.fsencode(name)
+        self.name_offsets.append(len(self.names))
+
+        self.dir_ids.append(dir_id)
+        self.sizes.append(entry.size)
+        self.mtimes.append(entry.mtime)
+        self.kinds.append(ord(entry.kind))
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    @property
+    def nbytes(self) -> int:
+        """The bytes taken by the column data."""
+
+        return sum(len(column) * column.itemsize
+                   for column in (self.sizes, self.mtimes, self.kinds,
+                                  self.dir_ids, self.name_offsets,
+                                  self.dir_offsets)) + \
+               len(self.names) + len(self.dirs)
+
+    def name(self, i: int) -> str:
+
+        return os.fsdecode(
+            bytes(self.names[self.name_offsets[i]:self.name_offsets[i + 1]]))
+
+    def dirname(self, i: int) -> str:
+
+        dir_id = self.dir_ids[i]
+        return os.fsdecode(
+            bytes(self.dirs[self.dir_offsets[dir_id]:self.dir_offsets[dir_id + 1]]))
+
+    def path(self, i: int) -> str:
+
+        dirname = self.dirname(i)
+        if dirname:
+            return dirname + '/' + self.name(i)
+
+        return self.name(i)
+
+    def entry(self, i: int) -> ManifestEntry:
+
+        return ManifestEntry(path=self.path(i),
+                             size=self.sizes[i],
+                             mtime=self.mtimes[i],
+                             kind=chr(self.kinds[i]))
+
+    def __iter__(self) -> Iterator[ManifestEntry]:
+
+        for i in range(len(self)):
+            yield self.entry(i)
+
+    def entries(self, indices: Iterable[int]) -> Iterator[ManifestEntry]:
+        """The entries of some rows, e.g. those selected by `select`."""
+
+        for i in indices:
+            yield self.entry(i)
+
+    def select(self,
+               min_size: Optional[int] = None,
+               max_size: Optional[int] = None,
+               mtime_after: Optional[float] = None,
+               mtime_before: Optional[float] = None,
+               extensions: Optional[Sequence[str]] = None,
+               kinds: Optional[Sequence[str]] = 'f',
+    ) -> array:
+        """Get the indices of rows matching all the given conditions.
+
+        Sizes are inclusive of `min_size` and exclusive of `max_size`,
+        and likewise for the times. Extensions are matched on the end
+        of the name and include their dot, e.g. '.iso'. Only files are
+        selected by default.
+
+        The size and time ranges take a Python comparison per row, the
+        kinds a single translation of their column, and the extensions
+        are only checked for the rows the other conditions left.
+
+        """
+
+        n = len(self)
+
+        # each condition is a mask of one byte per row, 1 where it
+        # holds, from a single pass over its column, and the masks are
+        # combined as integers. A generator of comparisons turned out
+        # faster than mapping the bound comparison methods.
+        masks = []
+
+        if kinds is not None:
+            table = bytearray(256)
+            for kind in kinds:
+                table[ord(kind)] = 1
+            masks.append(bytes(self.kinds).translate(table))
+
+        if min_size is not None or max_size is not None:
+            lo = -1 if min_size is None else min_size
+            hi = float('inf') if max_size is None else max_size
+            masks.append(bytes(lo <= size < hi for size in self.sizes))
+
+        if mtime_after is not None or mtime_before is not None:
+            lo = float('-inf') if mtime_after is None else mtime_after
+            hi = float('inf') if mtime_before is None else mtime_before
+            masks.append(bytes(lo <= mtime < hi for mtime in self.mtimes))
+
+        if masks:
+            combined = int.from_bytes(masks[0], 'little')
+            for mask in masks[1:]:
+                combined &= int.from_bytes(mask, 'little')
+
+            rows = itertools.compress(range(n),
+                                      combined.to_bytes(n, 'little'))
+        else:
+            rows = range(n)
+
+        # names are only checked for the rows left
+        if extensions is not None:
+            suffixes = tuple(os.fsencode(ext) for ext in extensions)
+            names = self.names
+            offsets = self.name_offsets
+            rows = (i for i in rows
+                    if bytes(names[offsets[i]:offsets[i + 1]]).endswith(suffixes))
+
+        return array('Q', rows)
+
+    def total_size(self, indices: Optional[Iterable[int]] = None) -> int:
+
+        if indices is None:
+            return sum(self.sizes)
+
+        sizes = self.sizes
+        return sum(sizes[i] for i in indices)
+
+    def save(self, path) -> None:
+        """Write the columns to a file, to be mapped with `load`."""
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as wf:
+
+            wf.write(HEADER.pack(COLUMNAR_MAGIC,
+                                 len(self),
+                                 len(self.dir_offsets) - 1,
+                                 len(self.names),
+                                 len(self.dirs)))
+
+            for name, _ in COLUMNS:
+                data = bytes(getattr(self, name))
+                wf.write(data + b'\0' * (_align(len(data)) - len(data)))
+
+            wf.write(bytes(self.names))
+            wf.write(bytes(self.dirs))
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) -> 'ColumnarManifest':
+        """Memory map a manifest written with `save`."""
+
+        with open(path, 'rb') as rf:
+            mm = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_rows, n_dirs, names_len, dirs_len = HEADER.unpack_from(mm, 0)
+        if magic != COLUMNAR_MAGIC:
+            mm.close()
+            raise ValueError(f"Not a columnar manifest: {path}")
+
+        lengths = {
+            'sizes' : n_rows,
+            'mtimes' : n_rows,
+            'dir_ids' : n_rows,
+            'name_offsets' : n_rows + 1,
+            'dir_offsets' : n_dirs + 1,
+            'kinds' : n_rows,
+        }
+
+        manifest = cls()
+        manifest._dir_index = None
+
+        view = memoryview(mm)
+        manifest._view = view
+        manifest._mmap = mm
+        offset = HEADER.size
+        for name, typecode in COLUMNS:
+            nbytes = lengths[name] * array(typecode).itemsize
+            setattr(manifest, name, view[offset:offset + nbytes].cast(typecode))
+            offset += _align(nbytes)
+
+        manifest.names = view[offset:offset + names_len]
+        offset += names_len
+        manifest.dirs = view[offset:offset + dirs_len]
+
+        return manifest
+
+
+def scan_columnar(root) -> ColumnarManifest:
+    """Scan a local directory straight into a columnar manifest."""
+
+    return ColumnarManifest.from_entries(scan_local(root))
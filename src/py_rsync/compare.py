@@ -0,0 +1,296 @@
+"""Comparison of benchmark results for regression gating.
+
+Two sets of `BenchmarkResult`s, as saved by `save_results`, are
+compared case by case. The relative change of the mean is given with
+a Welch confidence interval over the repeated samples, and a case is
+only called a regression or an improvement when the whole interval is
+past its threshold. All samples are taken as costs, lower is better,
+which holds for the timings and the memory per object the benchmarks
+record.
+
+The `py_rsync-compare BASELINE CANDIDATE` command prints the report
+and exits with 1 when anything regressed.
+
+"""
+
+import argparse
+import dataclasses as dc
+import math
+import statistics
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Tuple,
+)
+
+from .benchmark import (
+    BenchmarkResult,
+    load_results,
+)
+
+__all__ = [
+    'REGRESSION_THRESHOLD',
+    'COMPARISON_STATUSES',
+    't_quantile',
+    'relative_change_interval',
+    'Comparison',
+    'RegressionReport',
+    'compare_results',
+    'compare_files',
+]
+
+
+REGRESSION_THRESHOLD = 0.05
+"""Default relative change of the mean that counts as a regression."""
+
+COMPARISON_STATUSES = (
+    'regression',
+    'improvement',
+    'unchanged',
+    'inconclusive',
+    'missing',
+    'new',
+)
+"""The outcomes of comparing a case."""
+
+
+def t_quantile(p: float, df: float) -> float:
+    """Approximate quantile of Student's t distribution.
+
+    Uses the Cornish-Fisher expansion around the normal quantile,
+    within a few percent for 2 or more degrees of freedom.
+
+    """
+
+    z = statistics.NormalDist().inv_cdf(p)
+
+    return (z +
+            (z**3 + z) / (4 * df) +
+            (5 * z**5 + 16 * z**3 + 3 * z) / (96 * df**2) +
+            (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * df**3))
+
+
+def relative_change_interval(baseline: List[float],
+                             candidate: List[float],
+                             confidence: float = 0.95,
+) -> Tuple[float, Optional[float], Optional[float]]:
+    """The relative change of the mean and its confidence interval.
+
+    The interval is Welch's for the difference of the means, divided
+    by the baseline mean. It is `None` when either side has fewer
+    than two samples.
+
+    """
+
+    base_mean = statistics.mean(baseline)
+    cand_mean = statistics.mean(candidate)
+    change = cand_mean / base_mean - 1
+
+    if len(baseline) < 2 or len(candidate) < 2:
+        return change, None, None
+
+    base_se2 = statistics.variance(baseline) / len(baseline)
+    cand_se2 = statistics.variance(candidate) / len(candidate)
+    se = math.sqrt(base_se2 + cand_se2)
+
+    if se == 0:
+        return change, change, change
+
+    # Welch-Satterthwaite degrees of freedom
+    df = (base_se2 + cand_se2)**2 / (
+        base_se2**2 / (len(baseline) - 1) +
+        cand_se2**2 / (len(candidate) - 1))
+
+    margin = t_quantile(1 - (1 - confidence) / 2, df) * se / base_mean
+
+    return change, change - margin, change + margin
+
+
+@dc.dataclass
+class Comparison():
+    """The comparison of one benchmark case."""
+
+    name: str
+    status: str
+    threshold: float
+    baseline_mean: Optional[float] = None
+    candidate_mean: Optional[float] = None
+    change: Optional[float] = None
+    ci_low: Optional[float] = None
+    ci_high: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return dc.asdict(self)
+
+
+def _status(change: float,
+            ci_low: Optional[float],
+            ci_high: Optional[float],
+            threshold: float,
+) -> str:
+
+    # without an interval only a change within the threshold is clear
+    if ci_low is None:
+        return 'unchanged' if abs(change) <= threshold else 'inconclusive'
+
+    if ci_low > threshold:
+        return 'regression'
+    elif ci_high < -threshold:
+        return 'improvement'
+    elif -threshold <= ci_low and ci_high <= threshold:
+        return 'unchanged'
+    else:
+        return 'inconclusive'
+
+
+@dc.dataclass
+class RegressionReport():
+    """The comparisons of all cases of two benchmark runs."""
+
+    comparisons: List[Comparison]
+    confidence: float
+
+    def by_status(self, status: str) -> List[Comparison]:
+        return [comparison for comparison in self.comparisons
+                if comparison.status == status]
+
+    @property
+    def regressions(self) -> List[Comparison]:
+        return self.by_status('regression')
+
+    @property
+    def passed(self) -> bool:
+        return not self.regressions
+
+    def to_dict(self) -> dict:
+
+        return {
+            'confidence' : self.confidence,
+            'passed' : self.passed,
+            'comparisons' : [comparison.to_dict()
+                             for comparison in self.comparisons],
+        }
+
+    def to_text(self) -> str:
+
+        def percent(value):
+            return '' if value is None else f"{value:+.1%}"
+
+        lines = [f"{'case':<24} {'baseline':>12} {'candidate':>12} "
+                 f"{'change':>8} {int(self.confidence * 100)}% interval"
+                 f"{'':<6} {'threshold':>9}  status"]
+
+        for c in self.comparisons:
+
+            interval = ''
+            if c.ci_low is not None:
+                interval = f"[{percent(c.ci_low)}, {percent(c.ci_high)}]"
+
+            lines.append(
+                f"{c.name:<24} "
+                f"{'' if c.baseline_mean is None else f'{c.baseline_mean:.6g}':>12} "
+                f"{'' if c.candidate_mean is None else f'{c.candidate_mean:.6g}':>12} "
+                f"{percent(c.change):>8} {interval:<20} "
+                f"{c.threshold:>9.1%}  {c.status}")
+
+        lines.append('PASSED' if self.passed else
+                     f"FAILED: {len(self.regressions)} regression(s)")
+
+        return '\n'.join(lines)
+
+
+def compare_results(baseline: Dict[str, BenchmarkResult],
+                    candidate: Dict[str, BenchmarkResult],
+                    threshold: float = REGRESSION_THRESHOLD,
+                    thresholds: Optional[Dict[str, float]] = None,
+                    confidence: float = 0.95,
+) -> RegressionReport:
+    """Compare the cases of two benchmark runs.
+
+    `thresholds` overrides the relative threshold of single cases.
+    Cases only in the baseline are 'missing' and only in the
+    candidate 'new'.
+
+    """
+
+    thresholds = thresholds or {}
+
+    comparisons = []
+    for name in sorted(baseline.keys() | candidate.keys()):
+
+        case_threshold = thresholds.get(name, threshold)
+
+        if name not in candidate:
+            comparisons.append(Comparison(name=name,
+                                          status='missing',
+                                          threshold=case_threshold,
+                                          baseline_mean=baseline[name].mean))
+            continue
+
+        if name not in baseline:
+            comparisons.append(Comparison(name=name,
+                                          status='new',
+                                          threshold=case_threshold,
+                                          candidate_mean=candidate[name].mean))
+            continue
+
+        change, ci_low, ci_high = relative_change_interval(
+            baseline[name].samples,
+            candidate[name].samples,
+            confidence=confidence)
+
+        comparisons.append(Comparison(
+            name=name,
+            status=_status(change, ci_low, ci_high, case_threshold),
+            threshold=case_threshold,
+            baseline_mean=baseline[name].mean,
+            candidate_mean=candidate[name].mean,
+            change=change,
+            ci_low=ci_low,
+            ci_high=ci_high))
+
+    return RegressionReport(comparisons=comparisons, confidence=confidence)
+
+
+def compare_files(baseline_path,
+                  candidate_path,
+                  **kwargs,
+) -> RegressionReport:
+    """Compare two saved benchmark runs, see `compare_results`."""
+
+    return compare_results(load_results(baseline_path),
+                           load_results(candidate_path),
+                           **kwargs)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+
+    parser = argparse.ArgumentParser(
+        prog='py_rsync-compare',
+        description="Compare two benchmark result files.")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="relative change counted as a regression")
+    parser.add_argument('--case-threshold', action='append', default=[],
+                        metavar='NAME=THRESHOLD',
+                        help="threshold of a single case, repeatable")
+    parser.add_argument('--confidence', type=float, default=0.95)
+
+    args = parser.parse_args(argv)
+
+    thresholds = {}
+    for item in args.case_threshold:
+        name, _, value = item.rpartition('=')
+        thresholds[name] = float(value)
+
+    report = compare_files(args.baseline,
+                           args.candidate,
+                           threshold=args.threshold,
+                           thresholds=thresholds,
+                           confidence=args.confidence)
+
+    print(report.to_text())
+
+    return 0 if report.passed else 1
@@ -0,0 +1,344 @@
+"""Seeded synthetic trees for reproducible transfer benchmarks.
+
+`generate_tree` builds a tree from a `DatasetSpec`: a number of files
+with sizes drawn from a distribution, spread over directories up to a
+depth, with some of them sparse, hardlinked or symlinked. Everything,
+contents and modification times included, is derived from the seed
+so the same spec gives an identical tree on any Linux machine.
+
+`mutate_tree` then changes a percentage of the files the way trees
+change between syncs (edits in place, appends, new, deleted and
+renamed files), again deterministically, to benchmark delta transfers.
+
+"""
+
+import dataclasses as dc
+import math
+import os
+import random
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Tuple,
+)
+
+from .tree_diff import scan_local_sorted
+
+__all__ = [
+    'SIZE_DISTRIBUTIONS',
+    'MUTATIONS',
+    'DatasetSpec',
+    'GeneratedTree',
+    'generate_tree',
+    'MutationReport',
+    'mutate_tree',
+]
+
+
+SIZE_DISTRIBUTIONS = (
+    'lognormal',
+    'uniform',
+    'fixed',
+)
+"""The file size distributions a spec can use."""
+
+MUTATIONS = (
+    'modify',
+    'append',
+    'create',
+    'delete',
+    'rename',
+)
+"""The kinds of changes `mutate_tree` makes."""
+
+BASE_MTIME = 1_500_000_000
+"""Modification time of generated files, offset by their index."""
+
+WRITE_CHUNK = 1024 * 1024
+
+SPARSE_BLOCK = 64 * 1024
+
+
+@dc.dataclass
+class DatasetSpec():
+    """The shape of a generated tree."""
+
+    n_files: int = 1000
+    max_depth: int = 3
+    # subdirectories of each directory above the maximum depth
+    fanout: int = 4
+    size_distribution: str = 'lognormal'
+    # the median for lognormal, the mean for uniform and the size for
+    # fixed
+    file_size: int = 16 * 1024
+    # the shape of the lognormal distribution
+    sigma: float = 1.5
+    max_size: int = 64 * 1024 * 1024
+    # fractions of the files which are sparse, hardlinks to another
+    # file and symlinks to another file
+    sparse_fraction: float = 0.0
+    sparse_size: int = 64 * 1024 * 1024
+    hardlink_fraction: float = 0.0
+    symlink_fraction: float = 0.0
+    seed: int = 0
+
+    def __post_init__(self):
+
+        if self.size_distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError(
+                f"Size distribution '{self.size_distribution}' not recognized.")
+
+        if self.sparse_fraction + self.hardlink_fraction + \
+           self.symlink_fraction > 1:
+            raise ValueError("Fractions of special files add up to more than 1")
+
+    def draw_size(self, rng: random.Random) -> int:
+
+        if self.size_distribution == 'fixed':
+            size = self.file_size
+        elif self.size_distribution == 'uniform':
+            size = rng.randint(0, 2 * self.file_size)
+        else:
+            size = int(rng.lognormvariate(math.log(self.file_size), self.sigma))
+
+        return min(size, self.max_size)
+
+
+@dc.dataclass
+class GeneratedTree():
+    """What was generated, paths relative to the root."""
+
+    root: str
+    files: List[str]
+    sparse: List[str]
+    hardlinks: List[Tuple[str, str]]
+    symlinks: List[Tuple[str, str]]
+    dirs: List[str]
+    total_bytes: int
+
+
+def _write_random(path: str, size: int, rng: random.Random) -> None:
+
+    with open(path, 'wb') as wf:
+        remaining = size
+        while remaining > 0:
+            n = min(WRITE_CHUNK, remaining)
+            wf.write(rng.getrandbits(8 * n).to_bytes(n, 'little'))
+            remaining -= n
+
+
+def _write_sparse(path: str, size: int, rng: random.Random) -> int:
+    """Write a few random data blocks into a file of holes."""
+
+    n_blocks = max(1, size // (SPARSE_BLOCK * 64))
+    offsets = sorted({rng.randrange(0, max(size - SPARSE_BLOCK, 1))
+                      for _ in range(n_blocks)})
+
+    with open(path, 'wb') as wf:
+        wf.truncate(size)
+        for offset in offsets:
+            n = min(SPARSE_BLOCK, size - offset)
+            wf.seek(offset)
+            wf.write(rng.getrandbits(8 * n).to_bytes(n, 'little'))
+
+    return size
+
+
+def _make_dirs(spec: DatasetSpec) -> List[str]:
+
+    dirs = ['']
+    level = ['']
+    for _ in range(spec.max_depth):
+        level = [os.path.join(parent, f'd{i}')
+                 for parent in level
+                 for i in range(spec.fanout)]
+        dirs.extend(level)
+
+    return dirs
+
+
+def generate_tree(root, spec: DatasetSpec) -> GeneratedTree:
+    """Generate the tree of a spec under root, which must not exist.
+
+    Each file's contents come from its own generator seeded by the
+    spec's seed and the file's index, so changing one part of a spec
+    changes as little of the tree as possible.
+
+    """
+
+    root = str(root)
+    os.makedirs(root)
+
+    rng = random.Random(spec.seed)
+
+    dirs = _make_dirs(spec)
+    for rel_dir in dirs[1:]:
+        os.mkdir(os.path.join(root, rel_dir))
+
+    n_sparse = int(spec.n_files * spec.sparse_fraction)
+    n_hardlinks = int(spec.n_files * spec.hardlink_fraction)
+    n_symlinks = int(spec.n_files * spec.symlink_fraction)
+    n_regular = spec.n_files - n_sparse - n_hardlinks - n_symlinks
+
+    kinds = (['regular'] * n_regular + ['sparse'] * n_sparse +
+             ['hardlink'] * n_hardlinks + ['symlink'] * n_symlinks)
+    # links need a file to point to, which the first one always is
+    rest = kinds[1:]
+    rng.shuffle(rest)
+    kinds = kinds[:1] + rest
+
+    tree = GeneratedTree(root=root,
+                         files=[],
+                         sparse=[],
+                         hardlinks=[],
+                         symlinks=[],
+                         dirs=dirs[1:],
+                         total_bytes=0)
+
+    targets = []
+    for i, kind in enumerate(kinds):
+
+        rel_path = os.path.join(rng.choice(dirs), f'file_{i}.dat')
+        path = os.path.join(root, rel_path)
+        file_rng = random.Random(f"{spec.seed}:{i}")
+
+        if kind == 'regular' or (kind != 'sparse' and not targets):
+            size = spec.draw_size(rng)
+            _write_random(path, size, file_rng)
+            tree.files.append(rel_path)
+            tree.total_bytes += size
+            targets.append(rel_path)
+
+        elif kind == 'sparse':
+            tree.total_bytes += _write_sparse(path, spec.sparse_size, file_rng)
+            tree.sparse.append(rel_path)
+            targets.append(rel_path)
+
+        elif kind == 'hardlink':
+            target = rng.choice(targets)
+            os.link(os.path.join(root, target), path)
+            tree.hardlinks.append((rel_path, target))
+            continue
+
+        else:
+            target = rng.choice(targets)
+            link = os.path.relpath(os.path.join(root, target),
+                                   os.path.dirname(path))
+            os.symlink(link, path)
+            tree.symlinks.append((rel_path, target))
+
+            mtime = BASE_MTIME + i
+            os.utime(path, (mtime, mtime), follow_symlinks=False)
+            continue
+
+        mtime = BASE_MTIME + i
+        os.utime(path, (mtime, mtime))
+
+    # creating the files changed the times of their directories
+    for rel_dir in dirs:
+        os.utime(os.path.join(root, rel_dir), (BASE_MTIME, BASE_MTIME))
+
+    return tree
+
+
+@dc.dataclass
+class MutationReport():
+    """The changes made by `mutate_tree`, paths relative to the root."""
+
+    modified: List[str] = dc.field(default_factory=list)
+    appended: List[str] = dc.field(default_factory=list)
+    created: List[str] = dc.field(default_factory=list)
+    deleted: List[str] = dc.field(default_factory=list)
+    # (old path, new path)
+    renamed: List[Tuple[str, str]] = dc.field(default_factory=list)
+
+    @property
+    def n_changes(self) -> int:
+        return (len(self.modified) + len(self.appended) + len(self.created) +
+                len(self.deleted) + len(self.renamed))
+
+
+def mutate_tree(root,
+                percent: float,
+                seed: int = 0,
+                weights: Optional[Dict[str, float]] = None,
+                edit_size: int = 4096,
+                file_size: int = 16 * 1024,
+) -> MutationReport:
+    """Change a percentage of the regular files of a tree in place.
+
+    Each chosen file gets one of the `MUTATIONS`, picked by `weights`
+    (equal by default). Edits overwrite `edit_size` bytes at a random
+    offset, appends add as many, and new files are of `file_size`.
+    Changed and new files get modification times after any generated
+    one. The same tree, percentage and seed give the same changes.
+
+    """
+
+    root = str(root)
+    rng = random.Random(seed)
+
+    if weights is None:
+        weights = {mutation : 1.0 for mutation in MUTATIONS}
+
+    unknown = set(weights) - set(MUTATIONS)
+    if unknown:
+        raise ValueError(f"Mutations not recognized: {sorted(unknown)}")
+
+    mutations = list(weights)
+
+    files = [entry.path for entry in scan_local_sorted(root) if entry.kind == 'f']
+    n_changes = round(len(files) * percent / 100)
+    chosen = rng.sample(files, min(n_changes, len(files)))
+
+    report = MutationReport()
+    mtime = BASE_MTIME + 10**9
+    changed_dirs = set()
+    for i, rel_path in enumerate(chosen):
+
+        mutation = rng.choices(mutations,
+                               weights=[weights[m] for m in mutations])[0]
+        path = os.path.join(root, rel_path)
+        changed_dirs.add(os.path.dirname(rel_path))
+        change_rng = random.Random(f"{seed}:mutate:{i}")
+
+        if mutation == 'modify':
+            size = os.path.getsize(path)
+            offset = change_rng.randrange(0, max(size - edit_size, 0) + 1)
+            with open(path, 'r+b') as wf:
+                wf.seek(offset)
+                wf.write(change_rng.getrandbits(8 * edit_size)
+                                   .to_bytes(edit_size, 'little'))
+            report.modified.append(rel_path)
+
+        elif mutation == 'append':
+            with open(path, 'ab') as wf:
+                wf.write(change_rng.getrandbits(8 * edit_size)
+                                   .to_bytes(edit_size, 'little'))
+            report.appended.append(rel_path)
+
+        elif mutation == 'create':
+            dirname = os.path.dirname(rel_path)
+            rel_path = os.path.join(dirname, f'new_{seed}_{i}.dat')
+            path = os.path.join(root, rel_path)
+            _write_random(path, file_size, change_rng)
+            report.created.append(rel_path)
+
+        elif mutation == 'delete':
+            os.remove(path)
+            report.deleted.append(rel_path)
+            continue
+
+        else:
+            new_rel_path = rel_path + '.renamed'
+            os.rename(path, os.path.join(root, new_rel_path))
+            report.renamed.append((rel_path, new_rel_path))
+            continue
+
+        os.utime(path, (mtime + i, mtime + i))
+
+    for rel_dir in changed_dirs:
+        os.utime(os.path.join(root, rel_dir), (mtime, mtime))
+
+    return report
@@ -0,0 +1,340 @@
+"""Duration and wire byte estimates of commands, learned from past runs.
+
+A transfer's time is modelled as a per-file cost for building and
+exchanging the file list, hashing time when `--checksum` reads every
+file, and the bytes put on the wire over the link's bandwidth. The
+bytes on the wire follow from the source manifest, the fraction of
+the data which changed, how much of the change delta transfer still
+sends as literal data, and the compression ratio.
+
+Each of those rates is learned per pair of hosts from the `--stats`
+of completed runs, as exponentially weighted averages, and kept in a
+JSON file. Pairs without history use conservative defaults.
+
+"""
+
+import dataclasses as dc
+import re
+import time
+from pathlib import Path
+from typing import (
+    Optional,
+    Dict,
+    Iterable,
+    Union,
+)
+
+from .main import Command
+from .manifest import (
+    ManifestEntry,
+    list_tree,
+)
+from .columnar import ColumnarManifest
+from .run import (
+    RunResult,
+    parse_size,
+)
+from .cache_file import (
+    load_cache,
+    save_cache,
+)
+
+__all__ = [
+    'ESTIMATES_CACHE_PATH',
+    'DEFAULT_RATES',
+    'host_pair_key',
+    'bwlimit_rate',
+    'ManifestSummary',
+    'summarize_manifest',
+    'PairRates',
+    'Estimate',
+    'TransferEstimator',
+]
+
+
+ESTIMATES_CACHE_PATH = Path('~/.cache/py_rsync/estimates.json')
+"""Default location of the learned rates."""
+
+DEFAULT_RATES = {
+    # seconds per file of file list generation and transfer
+    'per_file_seconds' : 0.0005,
+    # bytes per second on the wire
+    'bandwidth' : 50e6,
+    # bytes per second hashed by --checksum
+    'checksum_rate' : 300e6,
+    # wire bytes per literal byte with compression
+    'compress_ratio' : 0.7,
+    # fraction of the source bytes which changed, 1 for a first sync
+    'change_fraction' : 1.0,
+    # literal bytes per changed byte with delta transfer
+    'literal_fraction' : 1.0,
+}
+"""The rates used for host pairs, or single rates, without history."""
+
+FILE_LIST_BYTES_PER_FILE = 100
+"""Approximate wire bytes per file of the file list."""
+
+LEARNING_RATE = 0.3
+"""Weight of a new run in the learned averages."""
+
+BWLIMIT_RE = re.compile(r'^(?P<number>\d+(?:\.\d+)?)'
+                        r'(?:(?P<suffix>[KMGTP])(?P<binary>i?)(?P<bytes>B?))?$',
+                        re.IGNORECASE)
+
+
+def host_pair_key(command: Command) -> str:
+    """Key the learned rates by the hosts, as paths vary between jobs."""
+
+    def host(endpoint):
+        if not endpoint.url.host:
+            return 'local'
+        if endpoint.url.user:
+            return f"{endpoint.url.user}@{endpoint.url.host}"
+        return endpoint.url.host
+
+    return f"{host(command.src)} -> {host(command.dest)}"
+
+
+@dc.dataclass
+class ManifestSummary():
+    """The file count and bytes of a source."""
+
+    n_files: int
+    total_bytes: int
+
+
+def summarize_manifest(
+        entries: Union[Iterable[ManifestEntry], ColumnarManifest],
+) -> ManifestSummary:
+
+    if isinstance(entries, ColumnarManifest):
+        files = entries.select()
+        return ManifestSummary(n_files=len(files),
+                               total_bytes=entries.total_size(files))
+
+    n_files = 0
+    total_bytes = 0
+    for entry in entries:
+        if entry.kind == 'f':
+            n_files += 1
+            total_bytes += entry.size
+
+    return ManifestSummary(n_files=n_files, total_bytes=total_bytes)
+
+
+@dc.dataclass
+class PairRates():
+    """The rates learned for a host pair, `None` where never observed."""
+
+    runs: int = 0
+    updated: Optional[float] = None
+    per_file_seconds: Optional[float] = None
+    bandwidth: Optional[float] = None
+    checksum_rate: Optional[float] = None
+    compress_ratio: Optional[float] = None
+    change_fraction: Optional[float] = None
+    literal_fraction: Optional[float] = None
+
+    def get(self, name: str) -> float:
+
+        value = getattr(self, name)
+        return DEFAULT_RATES[name] if value is None else value
+
+    def learn(self, name: str, value: float) -> None:
+
+        old = getattr(self, name)
+        if old is None:
+            setattr(self, name, value)
+        else:
+            setattr(self, name, (1 - LEARNING_RATE) * old + LEARNING_RATE * value)
+
+
+@dc.dataclass
+class Estimate():
+    """The predicted cost of a command."""
+
+    duration: float
+    wire_bytes: int
+    # seconds of each part of the model
+    file_list: float
+    checksum: float
+    transfer: float
+    n_files: int
+    total_bytes: int
+    # the number of runs the rates were learned from
+    runs: int
+
+
+def bwlimit_rate(value) -> float:
+    """Bytes per second of a `--bwlimit` value like '5000' or '10M'.
+
+    As for rsync, plain numbers are KiB per second and suffixes are
+    powers of 1024, except those ending in a bare 'B' like 'MB' which
+    are powers of 1000. A limit of 0 means no limit and is infinite.
+
+    """
+
+    match = BWLIMIT_RE.match(str(value))
+    if match is None:
+        raise ValueError(f"Invalid bandwidth limit '{value}'")
+
+    number, suffix = match.group('number'), match.group('suffix')
+    if float(number) == 0:
+        return float('inf')
+
+    if suffix is None:
+        return float(number) * 1024
+
+    unit = 1000 if match.group('bytes') and not match.group('binary') else 1024
+
+    return parse_size(number + suffix.upper(), unit=unit)
+
+
+def _flags(command: Command) -> set:
+
+    if command.options is None or command.options.flags is None:
+        return set()
+
+    return set(command.options.flags)
+
+
+class TransferEstimator():
+    """Estimates command costs and learns the rates from finished runs."""
+
+    def __init__(self, cache_path=ESTIMATES_CACHE_PATH):
+
+        self.cache_path = None if cache_path is None else Path(cache_path).expanduser()
+
+        self.pairs: Dict[str, PairRates] = {}
+        if self.cache_path is not None:
+            self.pairs = {key : PairRates(**rates)
+                          for key, rates in load_cache(self.cache_path).items()}
+
+    def rates(self, command: Command) -> PairRates:
+        return self.pairs.get(host_pair_key(command), PairRates())
+
+    def estimate(self,
+                 command: Command,
+                 manifest: Union[None,
+                                 Iterable[ManifestEntry],
+                                 ColumnarManifest,
+                                 ManifestSummary] = None,
+                 change_fraction: Optional[float] = None,
+    ) -> Estimate:
+        """Predict the duration and wire bytes of a command.
+
+        The source is listed when no manifest, or summary of one, is
+        given. `change_fraction` overrides the learned fraction of
+        changed bytes, e.g. 1 for a first sync to an empty destination.
+
+        """
+
+        if manifest is None:
+            manifest = list_tree(command.src)
+
+        if not isinstance(manifest, ManifestSummary):
+            manifest = summarize_manifest(manifest)
+
+        rates = self.rates(command)
+        flags = _flags(command)
+
+        if change_fraction is None:
+            change_fraction = rates.get('change_fraction')
+
+        file_list = manifest.n_files * rates.get('per_file_seconds')
+
+        checksum = 0.0
+        if 'checksum' in flags:
+            checksum = manifest.total_bytes / rates.get('checksum_rate')
+
+        literal = 0.0
+        if 'dry-run' not in flags:
+            literal = manifest.total_bytes * change_fraction
+            if 'whole-file' not in flags:
+                literal *= rates.get('literal_fraction')
+
+            if 'compress' in flags:
+                literal *= rates.get('compress_ratio')
+
+        wire_bytes = int(literal + manifest.n_files * FILE_LIST_BYTES_PER_FILE)
+
+        bandwidth = rates.get('bandwidth')
+        bwlimit = None
+        if command.options is not None:
+            bwlimit = command.options.bwlimit
+            if bwlimit is None and command.options.kv:
+                bwlimit = command.options.kv.get('bwlimit')
+
+        if bwlimit is not None:
+            bandwidth = min(bandwidth, bwlimit_rate(bwlimit))
+
+        transfer = wire_bytes / bandwidth
+
+        return Estimate(duration=file_list + checksum + transfer,
+                        wire_bytes=wire_bytes,
+                        file_list=file_list,
+                        checksum=checksum,
+                        transfer=transfer,
+                        n_files=manifest.n_files,
+                        total_bytes=manifest.total_bytes,
+                        runs=rates.runs)
+
+    def record(self, command: Command, result: RunResult) -> PairRates:
+        """Learn from the `--stats` of a finished run of a command.
+
+        Runs without stats, or which failed, are ignored. The updated
+        rates are saved right away.
+
+        """
+
+        rates = self.pairs.setdefault(host_pair_key(command), PairRates())
+        stats = result.stats
+        flags = _flags(command)
+
+        if result.returncode != 0 or stats.files_total is None:
+            return rates
+
+        file_list_time = ((stats.file_list_generation_time or 0.0) +
+                          (stats.file_list_transfer_time or 0.0))
+
+        if stats.files_total and file_list_time:
+            if 'checksum' in flags:
+                # hashing happens while generating the file list
+                if stats.total_size:
+                    rates.learn('checksum_rate',
+                                stats.total_size / max(file_list_time, 1e-6))
+            else:
+                rates.learn('per_file_seconds', file_list_time / stats.files_total)
+
+        wire_bytes = (stats.bytes_sent or 0) + (stats.bytes_received or 0)
+        transfer_time = result.duration - file_list_time
+        if wire_bytes and transfer_time > 0:
+            rates.learn('bandwidth', wire_bytes / transfer_time)
+
+        if 'dry-run' not in flags:
+
+            if stats.total_size and stats.transferred_size is not None:
+                rates.learn('change_fraction',
+                            stats.transferred_size / stats.total_size)
+
+            if (stats.transferred_size and
+                stats.literal_data is not None and
+                'whole-file' not in flags):
+                rates.learn('literal_fraction',
+                            stats.literal_data / stats.transferred_size)
+
+            if 'compress' in flags and stats.literal_data:
+                rates.learn('compress_ratio',
+                            max(wire_bytes - stats.files_total *
+                                FILE_LIST_BYTES_PER_FILE, 0) /
+                            stats.literal_data)
+
+        rates.runs += 1
+        rates.updated = time.time()
+
+        if self.cache_path is not None:
+            save_cache(self.cache_path,
+                       {key : dc.asdict(pair_rates)
+                        for key, pair_rates in self.pairs.items()})
+
+        return rates
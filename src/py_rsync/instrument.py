@@ -0,0 +1,270 @@
+"""Timing and metrics instrumentation for rsync runs.
+
+An `Instrument` hands out a `JobRecorder` per job which times the
+phases of a run and collects its results. Finished jobs are emitted
+to any number of sinks. When no instrument is given the shared
+`NULL_INSTRUMENT` is used whose recorders do nothing.
+
+"""
+
+import dataclasses as dc
+import json
+import os
+import threading
+import time
+import uuid
+from typing import (
+    Optional,
+    Dict,
+    List,
+    Iterable,
+)
+
+__all__ = [
+    'RUN_PHASES',
+    'JobMetrics',
+    'JobRecorder',
+    'Instrument',
+    'NULL_INSTRUMENT',
+    'MemorySink',
+    'JSONLinesSink',
+    'PrometheusSink',
+]
+
+
+RUN_PHASES = (
+    'render', # building the command line
+    'startup', # spawning the rsync process
+    'file_list', # building the file list, from rsync's stats
+    'transfer', # the rest of the process lifetime
+    'teardown', # reaping the process and parsing its output
+)
+"""The phases recorded for each run."""
+
+
+@dc.dataclass
+class JobMetrics():
+    """The measurements for a single job."""
+
+    job_id: str
+    started: float
+    finished: Optional[float] = None
+    phases: Dict[str, float] = dc.field(default_factory=dict)
+    exit_code: Optional[int] = None
+    bytes_sent: Optional[int] = None
+    bytes_received: Optional[int] = None
+    files_total: Optional[int] = None
+    files_transferred: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        return dc.asdict(self)
+
+
+class _Phase():
+    """Context manager adding its elapsed time to a phase."""
+
+    __slots__ = ('phases', 'name', 'start')
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.phases[self.name] = self.phases.get(self.name, 0.0) + elapsed
+
+
+class _NullPhase():
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class JobRecorder():
+    """Records the phases and results of one job."""
+
+    enabled = True
+
+    def __init__(self, instrument, job_id: str):
+        self.instrument = instrument
+        self.metrics = JobMetrics(job_id=job_id,
+                                  started=time.time())
+
+    def phase(self, name: str) -> _Phase:
+        return _Phase(self.metrics.phases, name)
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        self.metrics.phases[name] = self.metrics.phases.get(name, 0.0) + seconds
+
+    def record(self, **results) -> None:
+        """Set result fields of the metrics, e.g. `exit_code`."""
+
+        for field, value in results.items():
+            setattr(self.metrics, field, value)
+
+    def finish(self) -> JobMetrics:
+
+        self.metrics.finished = time.time()
+        for sink in self.instrument.sinks:
+            sink.emit(self.metrics)
+
+        return self.metrics
+
+
+class _NullRecorder():
+
+    enabled = False
+    metrics = None
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def add_phase(self, name, seconds):
+        pass
+
+    def record(self, **results):
+        pass
+
+    def finish(self):
+        return None
+
+
+_NULL_RECORDER = _NullRecorder()
+
+
+class Instrument():
+    """Creates job recorders which emit to the given sinks."""
+
+    def __init__(self, sinks: Iterable = ()):
+        self.sinks = list(sinks)
+
+    def job(self, job_id: Optional[str] = None) -> JobRecorder:
+
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+
+        return JobRecorder(self, job_id)
+
+
+class _NullInstrument():
+
+    sinks = ()
+
+    def job(self, job_id=None):
+        return _NULL_RECORDER
+
+
+NULL_INSTRUMENT = _NullInstrument()
+"""Instrument that records nothing, used when instrumentation is off."""
+
+
+class MemorySink():
+    """Keeps the metrics of finished jobs in a list."""
+
+    def __init__(self):
+        self.records: List[JobMetrics] = []
+
+    def emit(self, metrics: JobMetrics) -> None:
+        self.records.append(metrics)
+
+
+class JSONLinesSink():
+    """Appends the metrics of finished jobs as JSON lines to a file."""
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def emit(self, metrics: JobMetrics) -> None:
+
+        with open(self.path, 'a') as wf:
+            wf.write(json.dumps(metrics.to_dict()) + '\n')
+
+
+class PrometheusSink():
+    """Aggregates metrics into a Prometheus text exposition file.
+
+    The file is rewritten atomically after every job so it can be
+    picked up by the node exporter textfile collector. Jobs may be
+    emitted from several threads.
+
+    """
+
+    COUNTERS = (
+        'bytes_sent',
+        'bytes_received',
+        'files_transferred',
+    )
+
+    def __init__(self, path, prefix: str = 'py_rsync'):
+        self.path = str(path)
+        self.prefix = prefix
+
+        self.jobs: Dict[int, int] = {}
+        self.phases: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {name : 0 for name in self.COUNTERS}
+
+        # reentrant as emitting writes and writing renders
+        self._lock = threading.RLock()
+
+    def emit(self, metrics: JobMetrics) -> None:
+
+        with self._lock:
+            self.jobs[metrics.exit_code] = self.jobs.get(metrics.exit_code, 0) + 1
+
+            for name, seconds in metrics.phases.items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+            for name in self.COUNTERS:
+                self.counters[name] += getattr(metrics, name) or 0
+
+            self.write()
+
+    def render(self) -> str:
+
+        with self._lock:
+            return self._render()
+
+    def _render(self) -> str:
+
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_jobs_total Finished rsync jobs by exit code.",
+            f"# TYPE {p}_jobs_total counter",
+        ]
+        for exit_code, count in sorted(self.jobs.items(), key=str):
+            lines.append(f'{p}_jobs_total{{exit_code="{exit_code}"}} {count}')
+
+        lines.extend([
+            f"# HELP {p}_phase_seconds_total Time spent in each run phase.",
+            f"# TYPE {p}_phase_seconds_total counter",
+        ])
+        for name, seconds in sorted(self.phases.items()):
+            lines.append(f'{p}_phase_seconds_total{{phase="{name}"}} {seconds}')
+
+        for name, value in self.counters.items():
+            lines.extend([
+                f"# TYPE {p}_{name}_total counter",
+                f"{p}_{name}_total {value}",
+            ])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self) -> None:
+
+        with self._lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as wf:
+                wf.write(self._render())
+
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,444 @@
+"""Crash-safe persistent queue of commands for long migrations.
+
+Jobs are stored in SQLite with a state of pending, running, done or
+failed. Workers lease jobs for a limited time and renew the lease
+while a job runs. A lease that expires, because the process holding
+it died, makes the job available again, so a restarted orchestrator
+only resumes unfinished work. Enqueuing
+and state changes are written in batches to keep the database from
+becoming the bottleneck with millions of jobs.
+
+"""
+
+import dataclasses as dc
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import (
+    Optional,
+    List,
+    Iterable,
+    Dict,
+    Callable,
+)
+
+from hyperlink import URL
+
+from .main import (
+    Endpoint,
+    InfoOptions,
+    Options,
+    Command,
+)
+
+__all__ = [
+    'JOB_STATES',
+    'LEASE_SECONDS',
+    'command_to_dict',
+    'command_from_dict',
+    'Job',
+    'JobQueue',
+    'benchmark_queue',
+]
+
+
+JOB_STATES = (
+    'pending',
+    'running',
+    'done',
+    'failed',
+)
+"""The states a job can be in."""
+
+LEASE_SECONDS = 60 * 60
+"""Default time a worker holds a job before it is considered lost."""
+
+QUEUE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        command TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires REAL,
+        returncode INTEGER,
+        error TEXT,
+        updated REAL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)
+    """,
+)
+
+
+def command_to_dict(command: Command) -> dict:
+    """Convert a command to plain JSON serializable data."""
+
+    d = {
+        'src' : command.src.url.to_text(),
+        'dest' : command.dest.url.to_text(),
+        'options' : None,
+    }
+
+    if command.options is not None:
+        options = dc.asdict(command.options)
+        options['kv'] = dict(command.options.kv) if command.options.kv else None
+        d['options'] = options
+
+    return d
+
+
+def command_from_dict(d: dict) -> Command:
+    """Rebuild a command converted with `command_to_dict`."""
+
+    options = None
+    if d['options'] is not None:
+        fields = dict(d['options'])
+
+        for name in ('flags', 'includes', 'excludes'):
+            if fields[name] is not None:
+                fields[name] = tuple(fields[name])
+
+        if fields['info'] is not None:
+            fields['info'] = InfoOptions(flags=tuple(fields['info']['flags']))
+
+        options = Options(**fields)
+
+    return Command(src=Endpoint(URL.from_text(d['src'])),
+                   dest=Endpoint(URL.from_text(d['dest'])),
+                   options=options)
+
+
+@dc.dataclass
+class Job():
+    """A leased job."""
+
+    id: int
+    command: Command
+    attempts: int
+
+
+class JobQueue():
+    """SQLite backed queue of commands with leased execution.
+
+    State changes from `complete` are buffered and written in batches
+    of `batch_size`, or on `flush`. Buffered changes lost in a crash
+    only mean those jobs are run again once their lease expires.
+
+    A lease lasts `lease_seconds` from when it's taken or last renewed
+    with `renew`. Once it expires another worker may take the job over
+    and the first owner's completion of it is dropped, so workers
+    running jobs themselves must renew their leases more often than
+    that, as `run` does.
+
+    """
+
+    def __init__(self,
+                 db_path,
+                 lease_seconds: float = LEASE_SECONDS,
+                 batch_size: int = 1000,
+                 owner: Optional[str] = None,
+    ):
+
+        self.db_path = str(db_path)
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._conn = sqlite3.connect(self.db_path,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in QUEUE_SCHEMA:
+            self._conn.execute(statement)
+
+        self._lock = threading.Lock()
+        self._pending_updates = []
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def enqueue(self, commands: Iterable[Command]) -> int:
+        """Add commands as pending jobs in batches, returning the count."""
+
+        count = 0
+        batch = []
+        now = time.time()
+
+        with self._lock:
+            for command in commands:
+                batch.append((json.dumps(command_to_dict(command)), now))
+
+                if len(batch) >= self.batch_size:
+                    self._insert(batch)
+                    count += len(batch)
+                    batch = []
+
+            if batch:
+                self._insert(batch)
+                count += len(batch)
+
+        return count
+
+    def _insert(self, batch) -> None:
+
+        self._conn.execute("BEGIN")
+        self._conn.executemany(
+            "INSERT INTO jobs (command, updated) VALUES (?, ?)",
+            batch)
+        self._conn.execute("COMMIT")
+
+    def lease(self, n: int = 1) -> List[Job]:
+        """Take up to n available jobs, including ones with expired leases."""
+
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, command, attempts FROM jobs "
+                    "WHERE state = 'pending' "
+                    "OR (state = 'running' AND lease_expires < ?) "
+                    "ORDER BY id LIMIT ?",
+                    (now, n)).fetchall()
+
+                self._conn.executemany(
+                    "UPDATE jobs SET state = 'running', lease_owner = ?, "
+                    "lease_expires = ?, attempts = attempts + 1, updated = ? "
+                    "WHERE id = ?",
+                    [(self.owner, now + self.lease_seconds, now, row[0])
+                     for row in rows])
+
+                self._conn.execute("COMMIT")
+
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return [Job(id=job_id,
+                    command=command_from_dict(json.loads(command)),
+                    attempts=attempts + 1)
+                for job_id, command, attempts in rows]
+
+    def renew(self, job: Job) -> bool:
+        """Extend the lease of a job by `lease_seconds` from now.
+
+        Returns `False` when this owner no longer holds the lease,
+        because it expired and was taken over, in which case the job
+        shouldn't be run any further.
+
+        """
+
+        now = time.time()
+
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? "
+                "WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                (now + self.lease_seconds, now, job.id, self.owner)).rowcount == 1
+
+    def _heartbeat(self, held: List[Job], stop: threading.Event) -> None:
+
+        # renewing at a third of the lease leaves room for a slow
+        # database or a missed beat
+        while not stop.wait(self.lease_seconds / 3):
+            for job in list(held):
+                self.renew(job)
+
+    def complete(self,
+                 job: Job,
+                 returncode: int = 0,
+                 error: Optional[str] = None,
+    ) -> None:
+        """Mark a job done, or failed for a non-zero return code."""
+
+        state = 'done' if returncode == 0 else 'failed'
+
+        with self._lock:
+            self._pending_updates.append(
+                (state, returncode, error, time.time(), job.id, self.owner))
+
+            if len(self._pending_updates) >= self.batch_size:
+                self._flush()
+
+    def flush(self) -> None:
+        """Write buffered state changes."""
+
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+
+        if not self._pending_updates:
+            return
+
+        self._conn.execute("BEGIN")
+        # a job whose lease was taken over is left to the new owner
+        self._conn.executemany(
+            "UPDATE jobs SET state = ?, returncode = ?, error = ?, "
+            "updated = ?, lease_owner = NULL, lease_expires = NULL "
+            "WHERE id = ? AND lease_owner = ?",
+            self._pending_updates)
+        self._conn.execute("COMMIT")
+
+        self._pending_updates = []
+
+    def retry_failed(self, max_attempts: Optional[int] = None) -> int:
+        """Make failed jobs pending again, returning how many."""
+
+        query = "UPDATE jobs SET state = 'pending' WHERE state = 'failed'"
+        params = ()
+        if max_attempts is not None:
+            query += " AND attempts < ?"
+            params = (max_attempts,)
+
+        with self._lock:
+            self._flush()
+            return self._conn.execute(query, params).rowcount
+
+    def recover(self, owner: Optional[str] = None) -> int:
+        """Release the leases of an owner's running jobs, returning how many.
+
+        This is for a restart of one owner, which needs a stable
+        `owner` name given to the queue, and defaults to this queue's
+        owner. Its buffered completions are written first so finished
+        jobs aren't run again. Expired leases of any owner are released
+        too, which `lease` would do anyway, while the live leases of
+        other owners are left alone.
+
+        """
+
+        with self._lock:
+            self._flush()
+            return self._conn.execute(
+                "UPDATE jobs SET state = 'pending', lease_owner = NULL, "
+                "lease_expires = NULL WHERE state = 'running' "
+                "AND (lease_owner = ? OR lease_expires < ?)",
+                (owner or self.owner, time.time())).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Get the number of jobs in each state."""
+
+        with self._lock:
+            self._flush()
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+
+        counts = {state : 0 for state in JOB_STATES}
+        counts.update(dict(rows))
+
+        return counts
+
+    def run(self,
+            runner: Callable[[Command], object],
+            batch: int = 1,
+    ) -> int:
+        """Lease and run jobs until none are left, returning how many ran.
+
+        The runner's result is taken as a return code if it's an int or
+        has a `returncode`, exceptions fail the job.
+
+        The leases of a batch are renewed by a heartbeat thread until
+        each job has completed, so jobs with a runtime beyond
+        `lease_seconds`, or waiting for the ones before them in the
+        batch, keep their leases. A job whose lease was taken over by
+        another worker nonetheless, e.g. after the process was
+        suspended, is skipped.
+
+        """
+
+        ran = 0
+        while True:
+            jobs = self.lease(batch)
+            if not jobs:
+                break
+
+            held = list(jobs)
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat,
+                                         args=(held, stop),
+                                         daemon=True)
+            heartbeat.start()
+            try:
+                for job in jobs:
+                    if not self.renew(job):
+                        held.remove(job)
+                        continue
+
+                    try:
+                        result = runner(job.command)
+                        returncode = getattr(result, 'returncode', result)
+                        self.complete(job,
+                                      returncode=returncode
+                                      if isinstance(returncode, int) else 0)
+
+                    except Exception as err:
+                        self.complete(job, returncode=-1, error=repr(err))
+
+                    # a buffered completion would outlive the lease it's
+                    # guarded by, and a job takes far longer than a commit
+                    self.flush()
+                    held.remove(job)
+                    ran += 1
+
+            finally:
+                stop.set()
+                heartbeat.join()
+
+        return ran
+
+
+def benchmark_queue(db_path,
+                    n_jobs: int = 1_000_000,
+                    lease_batch: int = 1000,
+                    batch_size: int = 10000,
+) -> Dict[str, float]:
+    """Measure enqueue, lease and complete throughput in jobs per second."""
+
+    command = Command(src=Endpoint.construct(path='/src'),
+                      dest=Endpoint.construct(path='/dest'),
+                      options=Options(flags=('archive',),
+                                      includes=(),
+                                      excludes=(),
+                                      info=None,
+                                      kv={'files-from' : '/shard.txt'}))
+
+    with JobQueue(db_path, batch_size=batch_size) as queue:
+
+        start = time.perf_counter()
+        queue.enqueue(command for _ in range(n_jobs))
+        enqueue_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        leased = 0
+        while True:
+            jobs = queue.lease(lease_batch)
+            if not jobs:
+                break
+
+            for job in jobs:
+                queue.complete(job)
+
+            leased += len(jobs)
+
+        queue.flush()
+        dequeue_time = time.perf_counter() - start
+
+    return {
+        'enqueue_per_second' : n_jobs / enqueue_time,
+        'dequeue_per_second' : leased / dequeue_time,
+    }
@@ -0,0 +1,563 @@
+"""Native copy engine for commands between two local endpoints.
+
+When neither endpoint has a host, spawning rsync means reading and
+writing every byte through userspace. This engine instead clones files
+with the `FICLONE` ioctl where the filesystem supports reflinks and
+otherwise copies in the kernel with `os.copy_file_range` or
+`os.sendfile`, using a thread pool. The same `Options` are honoured
+for the supported subset of rsync's semantics: archive metadata,
+recursion, the quick check and its variants, include and exclude
+patterns, `--files-from`, deletion and dry runs. Unsupported options,
+and devices or special files in archive mode, raise a `ValueError`
+rather than being silently ignored.
+
+"""
+
+import dataclasses as dc
+import errno
+import fcntl
+import fnmatch
+import os
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Optional,
+    List,
+    Tuple,
+    Set,
+)
+
+from .main import Command
+from .checksum_cache import hash_file
+
+__all__ = [
+    'LOCAL_ENGINE_FLAGS',
+    'LOCAL_ENGINE_IGNORED_FLAGS',
+    'LocalCopyResult',
+    'is_local_command',
+    'copy_file',
+    'FilterRules',
+    'local_copy',
+]
+
+
+LOCAL_ENGINE_FLAGS = (
+    'archive',
+    'recursive',
+    'dry-run',
+    'delete',
+    'delete-excluded',
+    'delete-before',
+    'delete-during',
+    'delete-delay',
+    'delete-after',
+    'update',
+    'ignore-existing',
+    'existing',
+    'checksum',
+    'inplace',
+)
+"""Flags the engine implements."""
+
+LOCAL_ENGINE_IGNORED_FLAGS = (
+    'verbose',
+    'human-readable',
+    'itemize-changes',
+    'stats',
+    'compress',
+    'whole-file',
+    'no-whole-file',
+    'preallocate',
+    'no-inc-recursive',
+    'force',
+)
+"""Flags which only affect output or the network and are ignored."""
+
+LOCAL_ENGINE_KV_OPTS = (
+    'files-from',
+    'checksum-choice',
+    'compress-choice',
+    'block-size',
+    'max-alloc',
+    'bwlimit',
+    'timeout',
+)
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+CLONE_UNSUPPORTED = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                     errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+@dc.dataclass
+class LocalCopyResult():
+    """What the engine did."""
+
+    files_copied: int = 0
+    files_reflinked: int = 0
+    files_skipped: int = 0
+    bytes_copied: int = 0
+    deleted: List[str] = dc.field(default_factory=list)
+    duration: float = 0.0
+
+    # the itemize-changes like list of copied paths
+    copied: List[str] = dc.field(default_factory=list)
+
+
+def is_local_command(command: Command) -> bool:
+    return not command.src.url.host and not command.dest.url.host
+
+
+def _copy_data(src_fd: int, dst_fd: int, size: int) -> bool:
+    """Copy the contents between descriptors, True if reflinked."""
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as err:
+        if err.errno not in CLONE_UNSUPPORTED:
+            raise
+
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd,
+                                       min(COPY_CHUNK_SIZE, size - copied))
+                if n == 0:
+                    break
+                copied += n
+
+            return False
+
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                 errno.EOPNOTSUPP):
+                raise
+
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied,
+                        min(COPY_CHUNK_SIZE, size - copied))
+        if n == 0:
+            break
+        copied += n
+
+    return False
+
+
+def _copy_metadata(src: str, dst: str, st: os.stat_result) -> None:
+
+    if os.geteuid() == 0:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+
+    if not os.path.islink(dst):
+        os.chmod(dst, st.st_mode & 0o7777)
+
+    os.utime(dst,
+             ns=(st.st_atime_ns, st.st_mtime_ns),
+             follow_symlinks=False)
+
+
+def copy_file(src: str,
+              dst: str,
+              archive: bool = True,
+              inplace: bool = False,
+) -> bool:
+    """Copy a regular file, returning True if it was reflinked.
+
+    Unless `inplace` the data is written to a temporary file next to
+    the destination which is renamed over it when complete.
+
+    """
+
+    st = os.stat(src)
+
+    tmp = dst if inplace else os.path.join(
+        os.path.dirname(dst),
+        f".{os.path.basename(dst)}.py_rsync.{threading.get_ident()}")
+
+    with open(src, 'rb') as rf, open(tmp, 'wb') as wf:
+        reflinked = _copy_data(rf.fileno(), wf.fileno(), st.st_size)
+
+    if archive:
+        _copy_metadata(src, tmp, st)
+
+    if not inplace:
+        os.replace(tmp, dst)
+
+    return reflinked
+
+
+class FilterRules():
+    """The subset of rsync include/exclude patterns the engine supports.
+
+    Includes are checked before excludes, as they are rendered, and the
+    first matching pattern decides. A leading '/' anchors a pattern to
+    the transfer root, a trailing '/' only matches directories, and
+    patterns without a '/' match the last path component.
+
+    """
+
+    def __init__(self, includes=(), excludes=()):
+
+        self.rules = ([(pattern, True) for pattern in includes or ()] +
+                      [(pattern, False) for pattern in excludes or ()])
+
+        # directory -> whether it and all its parents are included
+        self._dirs = {'' : True}
+
+    @staticmethod
+    def _matches(pattern: str, rel_path: str, is_dir: bool) -> bool:
+
+        if pattern.endswith('/'):
+            if not is_dir:
+                return False
+            pattern = pattern.rstrip('/')
+
+        if pattern.startswith('/'):
+            return fnmatch.fnmatchcase(rel_path, pattern.lstrip('/'))
+
+        if '/' in pattern:
+            return (fnmatch.fnmatchcase(rel_path, pattern) or
+                    fnmatch.fnmatchcase(rel_path, '*/' + pattern))
+
+        return fnmatch.fnmatchcase(os.path.basename(rel_path), pattern)
+
+    def included(self, rel_path: str, is_dir: bool = False) -> bool:
+
+        for pattern, include in self.rules:
+            if self._matches(pattern, rel_path, is_dir):
+                return include
+
+        return True
+
+    def included_path(self, rel_path: str, is_dir: bool = False) -> bool:
+        """Test a path of a flat listing, excluded with any parent directory.
+
+        `included` only looks at the path itself, which is enough when
+        walking a tree without descending into excluded directories.
+
+        """
+
+        parent = os.path.dirname(rel_path)
+        if parent not in self._dirs:
+            self._dirs[parent] = self.included_path(parent, is_dir=True)
+
+        if not self._dirs[parent]:
+            return False
+
+        return self.included(rel_path, is_dir=is_dir)
+
+
+def _check_options(flags, kv) -> None:
+
+    unsupported = [flag for flag in flags
+                   if flag not in LOCAL_ENGINE_FLAGS and
+                   flag not in LOCAL_ENGINE_IGNORED_FLAGS]
+
+    unsupported += [key for key in kv if key not in LOCAL_ENGINE_KV_OPTS]
+
+    if unsupported:
+        raise ValueError(
+            f"Options not supported by the local engine: {', '.join(unsupported)}")
+
+
+def _walk(root: str,
+          rules: FilterRules,
+) -> Tuple[List[str], List[str], List[str], List[str]]:
+    """Get the included (dirs, files, symlinks, others) under root."""
+
+    dirs, files, links, others = [], [], [], []
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                rel_path = os.path.join(rel_dir, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+
+                if not rules.included(rel_path, is_dir=is_dir):
+                    continue
+
+                if entry.is_symlink():
+                    links.append(rel_path)
+                elif is_dir:
+                    dirs.append(rel_path)
+                    stack.append(rel_path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(rel_path)
+                else:
+                    others.append(rel_path)
+
+    return dirs, files, links, others
+
+
+def _files_from(root: str,
+                path: str,
+                rules: FilterRules,
+) -> Tuple[List[str], List[str], List[str], List[str]]:
+    """Get the (dirs, files, symlinks, others) of a list the rules include."""
+
+    dirs, files, links, others = set(), [], [], []
+    with open(path) as rf:
+        for line in rf:
+            rel_path = line.rstrip('\n').strip('/')
+            if not rel_path:
+                continue
+
+            full = os.path.join(root, rel_path)
+            is_dir = os.path.isdir(full) and not os.path.islink(full)
+
+            # like rsync, the filter rules apply to the listed paths
+            if not rules.included_path(rel_path, is_dir=is_dir):
+                continue
+
+            # the implied parent directories are created as well
+            parent = os.path.dirname(rel_path)
+            while parent:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+
+            if os.path.islink(full):
+                links.append(rel_path)
+            elif is_dir:
+                dirs.add(rel_path)
+            elif os.path.isfile(full):
+                files.append(rel_path)
+            elif os.path.lexists(full):
+                others.append(rel_path)
+
+    return sorted(dirs), files, links, others
+
+
+def _conflicts(path: str, is_dir: bool) -> bool:
+    """Whether a destination entry is of another type than the source's.
+
+    Only a directory can take a directory and a regular file a file.
+
+    """
+
+    try:
+        st = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+    if is_dir:
+        return not stat.S_ISDIR(st.st_mode)
+
+    return not stat.S_ISREG(st.st_mode)
+
+
+def _needs_copy(src: str,
+                dst: str,
+                src_st: os.stat_result,
+                flags: Set[str],
+) -> bool:
+
+    try:
+        dst_st = os.stat(dst, follow_symlinks=False)
+    except (FileNotFoundError, NotADirectoryError):
+        # a dry run doesn't replace a file where a directory goes
+        return 'existing' not in flags
+
+    if 'ignore-existing' in flags:
+        return False
+
+    if 'update' in flags and dst_st.st_mtime_ns > src_st.st_mtime_ns:
+        return False
+
+    if 'checksum' in flags:
+        return (src_st.st_size != dst_st.st_size or
+                hash_file(src) != hash_file(dst))
+
+    return (src_st.st_size != dst_st.st_size or
+            src_st.st_mtime_ns // 10**9 != dst_st.st_mtime_ns // 10**9)
+
+
+def local_copy(command: Command,
+               workers: Optional[int] = None,
+) -> LocalCopyResult:
+    """Carry out a local to local command without spawning rsync."""
+
+    if not is_local_command(command):
+        raise ValueError("The local engine requires two local endpoints")
+
+    options = command.options
+    flags = set((options and options.flags) or ())
+    kv = {**((options and options.kv) or {}),
+          **(options.typed_kv() if options else {})}
+
+    _check_options(flags, kv)
+
+    archive = 'archive' in flags
+    dry_run = 'dry-run' in flags
+    deletes = bool(options and options.deletes)
+
+    src_root = command.src.path
+    dest_root = command.dest.path
+
+    rules = FilterRules(options and options.includes,
+                        options and options.excludes)
+
+    if 'files-from' in kv:
+        dirs, files, links, others = _files_from(src_root, kv['files-from'], rules)
+    elif archive or 'recursive' in flags:
+        dirs, files, links, others = _walk(src_root, rules)
+    else:
+        raise ValueError("The local engine needs recursion or a files-from list")
+
+    # archive mode implies '--devices --specials', without it rsync
+    # skips them too
+    if archive and others:
+        raise ValueError(
+            f"Devices and special files are not supported by the local engine: "
+            f"{', '.join(sorted(others)[:10])}")
+
+    result = LocalCopyResult()
+    start = time.perf_counter()
+    lock = threading.Lock()
+    replaced = set()
+
+    def clear_conflict(rel_path, is_dir):
+        """Remove a destination entry of another type than the source's,
+        which rsync deletes too, as otherwise it can't be replaced."""
+
+        path = os.path.join(dest_root, rel_path)
+        if not _conflicts(path, is_dir):
+            return
+
+        with lock:
+            result.deleted.append(rel_path)
+            replaced.add(rel_path)
+
+        if not dry_run:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    if not dry_run:
+        os.makedirs(dest_root, exist_ok=True)
+
+    for rel_dir in dirs:
+        clear_conflict(rel_dir, is_dir=True)
+        if not dry_run:
+            os.makedirs(os.path.join(dest_root, rel_dir), exist_ok=True)
+
+    def transfer(rel_path):
+
+        src = os.path.join(src_root, rel_path)
+        dst = os.path.join(dest_root, rel_path)
+        src_st = os.stat(src)
+
+        if not _needs_copy(src, dst, src_st, flags):
+            with lock:
+                result.files_skipped += 1
+            return
+
+        clear_conflict(rel_path, is_dir=False)
+
+        reflinked = False
+        if not dry_run:
+            reflinked = copy_file(src, dst,
+                                  archive=archive,
+                                  inplace='inplace' in flags)
+
+        with lock:
+            result.files_copied += 1
+            result.files_reflinked += int(reflinked)
+            result.bytes_copied += src_st.st_size
+            result.copied.append(rel_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(transfer, files))
+
+    # like rsync, symlinks are only copied in archive mode
+    if archive:
+        for rel_path in links:
+            src = os.path.join(src_root, rel_path)
+            dst = os.path.join(dest_root, rel_path)
+
+            target = os.readlink(src)
+            if os.path.islink(dst) and os.readlink(dst) == target:
+                result.files_skipped += 1
+                continue
+
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                clear_conflict(rel_path, is_dir=False)
+
+            result.copied.append(rel_path)
+            if dry_run:
+                continue
+
+            if os.path.lexists(dst):
+                os.remove(dst)
+
+            os.symlink(target, dst)
+            _copy_metadata(src, dst, os.lstat(src))
+
+    if deletes and 'files-from' not in kv and os.path.isdir(dest_root):
+
+        keep = set(dirs) | set(files) | set(links)
+        protect = 'delete-excluded' not in flags
+
+        def delete_extraneous(rel_dir) -> bool:
+            """Delete below a destination directory, returning whether
+            anything remains in it."""
+
+            remains = False
+            with os.scandir(os.path.join(dest_root, rel_dir)) as it:
+                entries = list(it)
+
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+
+                # excluded entries on the receiver are protected along
+                # with everything in them, so they're not descended into
+                if protect and not rules.included(rel_path, is_dir=is_dir):
+                    remains = True
+                    continue
+
+                # only left in a dry run, where it was already listed
+                if rel_path in replaced:
+                    remains = True
+                    continue
+
+                # extraneous directories are emptied first, and kept if
+                # they hold protected entries
+                if is_dir and delete_extraneous(rel_path):
+                    remains = True
+                    continue
+
+                if rel_path in keep:
+                    remains = True
+                    continue
+
+                result.deleted.append(rel_path)
+                if not dry_run:
+                    if is_dir:
+                        os.rmdir(entry.path)
+                    else:
+                        os.remove(entry.path)
+
+            return remains
+
+        delete_extraneous('')
+
+    # directory times last, since filling them changes them
+    if archive and not dry_run:
+        for rel_dir in sorted(dirs, reverse=True):
+            src = os.path.join(src_root, rel_dir)
+            _copy_metadata(src, os.path.join(dest_root, rel_dir), os.stat(src))
+
+    result.duration = time.perf_counter() - start
+
+    return result
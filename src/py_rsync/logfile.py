@@ -0,0 +1,269 @@
+"""Streaming parser for the files written by `--log-file`.
+
+Logs are read through `mmap` a line at a time so multi-gigabyte logs
+never have to be loaded into memory, and a `LogTailer` can follow a
+log incrementally while rsync is still writing it.
+
+"""
+
+import dataclasses as dc
+import mmap
+import os
+import re
+import time
+from typing import (
+    Optional,
+    Dict,
+    Generator,
+    Pattern,
+)
+
+from .main import (
+    Command,
+    extend_options,
+)
+
+__all__ = [
+    'LOG_FILE_FORMAT_DEFAULT',
+    'LOG_FORMAT_ESCAPES',
+    'LogRecord',
+    'compile_log_format',
+    'parse_log_line',
+    'iter_log_records',
+    'LogTailer',
+    'with_log_file',
+]
+
+
+LOG_FILE_FORMAT_DEFAULT = '%i %n%L'
+"""The format rsync uses for `--log-file` when none is given."""
+
+LOG_LINE_PREFIX = '%t [%p] '
+"""Prefix rsync writes before every line of a log file."""
+
+LOG_FORMAT_ESCAPES = {
+    # escape : (field name, regex, type)
+    'a' : ('addr', r'\S*', str),
+    'b' : ('bytes', r'[0-9,]+', int),
+    'B' : ('perms', r'\S+', str),
+    'c' : ('checksum_bytes', r'[0-9,]+', int),
+    'C' : ('checksum', r'\S*', str),
+    'f' : ('fullname', r'.+?', str),
+    'G' : ('gid', r'\S+', str),
+    'h' : ('host', r'\S*', str),
+    # deletions are padded to the width of the other itemizations
+    'i' : ('itemize', r'\*deleting *|[<>ch.*][fdLDS][^ ]{9}', str),
+    'l' : ('length', r'[0-9,]+', int),
+    'L' : ('link', r'(?: -> .*?)?', str),
+    'm' : ('module', r'\S*', str),
+    'M' : ('mtime', r'\S+', str),
+    'n' : ('name', r'.+?', str),
+    'o' : ('operation', r'\S+', str),
+    'p' : ('pid', r'\d+', int),
+    'P' : ('module_path', r'.+?', str),
+    't' : ('timestamp', r'\d{4}/\d\d/\d\d \d\d:\d\d:\d\d', str),
+    'u' : ('user', r'\S*', str),
+    'U' : ('uid', r'\d+', int),
+}
+"""The supported `--log-file-format` escapes."""
+
+LOG_FIELD_TYPES = {name : type_ for name, _, type_ in LOG_FORMAT_ESCAPES.values()}
+
+FORMAT_ESCAPE_RE = re.compile(r"%'?-?\d*([A-Za-z%])")
+
+LOG_PREFIX_RE = re.compile(r'^(?P<timestamp>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) '
+                           r'\[(?P<pid>\d+)\] ')
+
+
+@dc.dataclass
+class LogRecord():
+    """A single parsed log line."""
+
+    offset: int
+    line: str
+    timestamp: Optional[str] = None
+    pid: Optional[int] = None
+    fields: Dict[str, object] = dc.field(default_factory=dict)
+    matched: bool = True
+
+
+def compile_log_format(log_format: str = LOG_FILE_FORMAT_DEFAULT) -> Pattern:
+    """Build the regex matching a log line written with the given format."""
+
+    pattern = []
+    seen = set()
+    pos = 0
+    for match in FORMAT_ESCAPE_RE.finditer(LOG_LINE_PREFIX + log_format):
+
+        pattern.append(re.escape(match.string[pos:match.start()]))
+        pos = match.end()
+
+        escape = match.group(1)
+        if escape == '%':
+            pattern.append('%')
+            continue
+
+        if escape not in LOG_FORMAT_ESCAPES:
+            raise ValueError(f"Log format escape '%{escape}' not supported.")
+
+        name, regex, _ = LOG_FORMAT_ESCAPES[escape]
+
+        # the same escape may be repeated but a group name may not
+        if name in seen:
+            pattern.append(f"(?:{regex})")
+        else:
+            pattern.append(f"(?P<{name}>{regex})")
+            seen.add(name)
+
+    pattern.append(re.escape((LOG_LINE_PREFIX + log_format)[pos:]))
+
+    return re.compile('^' + ''.join(pattern) + '$')
+
+
+def parse_log_line(line: str,
+                   pattern: Pattern,
+                   offset: int = 0,
+) -> LogRecord:
+    """Parse a line into a record.
+
+    Lines which don't match the format, like rsync's own messages, are
+    returned unmatched with only the prefix fields if present.
+
+    """
+
+    match = pattern.match(line)
+    if match is None:
+
+        prefix = LOG_PREFIX_RE.match(line)
+        if prefix is None:
+            return LogRecord(offset=offset, line=line, matched=False)
+
+        return LogRecord(offset=offset,
+                         line=line,
+                         timestamp=prefix.group('timestamp'),
+                         pid=int(prefix.group('pid')),
+                         matched=False)
+
+    fields = {}
+    for name, value in match.groupdict().items():
+        if value is not None and LOG_FIELD_TYPES[name] is int:
+            value = int(value.replace(',', ''))
+        elif name == 'itemize':
+            value = value.rstrip()
+        fields[name] = value
+
+    return LogRecord(offset=offset,
+                     line=line,
+                     timestamp=fields.pop('timestamp'),
+                     pid=fields.pop('pid'),
+                     fields=fields)
+
+
+def _iter_lines(path,
+                offset: int = 0,
+) -> Generator[tuple, None, None]:
+    """Yield (offset, next offset, line) for complete lines using mmap.
+
+    A trailing partial line is not yielded so it can be read once it
+    has been finished.
+
+    """
+
+    with open(path, 'rb') as rf:
+
+        size = os.fstat(rf.fileno()).st_size
+        if size <= offset:
+            return
+
+        # the mapping must start on an allocation boundary
+        map_start = offset - (offset % mmap.ALLOCATIONGRANULARITY)
+
+        with mmap.mmap(rf.fileno(),
+                       size - map_start,
+                       access=mmap.ACCESS_READ,
+                       offset=map_start) as mm:
+
+            pos = offset - map_start
+            while True:
+                end = mm.find(b'\n', pos)
+                if end < 0:
+                    break
+
+                line = mm[pos:end].decode(errors='replace')
+                yield map_start + pos, map_start + end + 1, line
+
+                pos = end + 1
+
+
+def iter_log_records(path,
+                     log_format: str = LOG_FILE_FORMAT_DEFAULT,
+                     offset: int = 0,
+) -> Generator[LogRecord, None, None]:
+    """Stream the parsed records of a log file."""
+
+    pattern = compile_log_format(log_format)
+
+    for line_offset, _, line in _iter_lines(path, offset=offset):
+        yield parse_log_line(line, pattern, offset=line_offset)
+
+
+class LogTailer():
+    """Incrementally reads new records of a log as it is written."""
+
+    def __init__(self,
+                 path,
+                 log_format: str = LOG_FILE_FORMAT_DEFAULT,
+                 offset: int = 0,
+    ):
+
+        self.path = str(path)
+        self.pattern = compile_log_format(log_format)
+        self.offset = offset
+
+    def poll(self) -> Generator[LogRecord, None, None]:
+        """Yield the records completed since the last poll."""
+
+        if not os.path.exists(self.path):
+            return
+
+        lines = _iter_lines(self.path, offset=self.offset)
+        for line_offset, next_offset, line in lines:
+
+            self.offset = next_offset
+            yield parse_log_line(line, self.pattern, offset=line_offset)
+
+    def follow(self,
+               proc=None,
+               interval: float = 0.5,
+    ) -> Generator[LogRecord, None, None]:
+        """Yield records until the process exits, then drain the rest.
+
+        `proc` is anything with a `poll` method like `subprocess.Popen`.
+        Without a process this follows forever.
+
+        """
+
+        while True:
+
+            done = proc is not None and proc.poll() is not None
+
+            yield from self.poll()
+
+            if done:
+                break
+
+            time.sleep(interval)
+
+
+def with_log_file(command: Command,
+                  path,
+                  log_format: Optional[str] = None,
+) -> Command:
+    """Return a copy of the command writing a log file."""
+
+    kv = {'log-file' : str(path)}
+    if log_format is not None:
+        kv['log-file-format'] = log_format
+
+    return dc.replace(command,
+                      options=extend_options(command.options, kv=kv))
@@ -1,14 +1,24 @@
 import dataclasses as dc
+import functools
 import pkgutil
+import re
+import shlex
+import threading
+from collections import OrderedDict
 from pathlib import Path
 from typing import (
     Optional,
     Tuple,
     Generator,
     Mapping,
+    Iterable,
+    List,
 )
 
-from jinja2 import Template
+from jinja2 import (
+    Environment,
+    Template,
+)
 from hyperlink import URL
 
 __all__ = [
@@ -16,10 +26,19 @@ __all__ = [
     'RSYNC_FLAGS',
     'RSYNC_INFO_OPTS',
     'RSYNC_KV_OPTS',
+    'RSYNC_CHECKSUM_CHOICES',
+    'RSYNC_EXCLUSIVE_FLAGS',
+    'RSYNC_DELETE_FLAGS',
     'Endpoint',
     'InfoOptions',
     'Options',
     'Command',
+    'extend_options',
+    'escape_filter_pattern',
+    'protect_paths',
+    'command_key',
+    'RenderCache',
+    'RENDER_CACHE',
 
 ]
 
@@ -28,6 +47,7 @@ RSYNC_OPTIONS = (
     # long, short, docstring
     # non-essential options
     ('archive', 'a', "archive mode; equals -rlptgoD (no -H,-A,-X)"),
+    ('recursive', 'r', "recurse into directories"),
     ('verbose', 'v', "increase verbosity"),
     ('human-readable', 'h', "output numbers in a human-readable format"),
     ('itemize-changes', 'i', "output a change-summary for all updates"),
@@ -37,15 +57,41 @@ RSYNC_OPTIONS = (
     # transport options
     ('dry-run', 'n', "perform a trial run with no changes made"),
     ('compress', 'z', "compress file data during the transfer"),
+    ('compress-choice', None, "choose the compression algorithm"),
+    ('checksum-choice', None, "choose the checksum algorithm"),
+    ('checksum-seed', None, "set block/file checksum seed (advanced)"),
     ('backup', 'b', "make backups (see --suffix & --backup-dir)"),
+    ('whole-file', 'W', "copy files whole (w/o delta-xfer algorithm)"),
+    ('no-whole-file', None, "always use the delta-xfer algorithm"),
+    ('inplace', None, "update destination files in-place"),
+    ('append', None, "append data onto shorter files"),
+    ('sparse', 'S', "turn sequences of nulls into sparse blocks"),
+    ('preallocate', None, "allocate dest files before writing them"),
+    ('no-inc-recursive', None, "disable incremental recursion"),
+    ('block-size', 'B', "force a fixed checksum block-size"),
+    ('max-alloc', None, "change a limit relating to memory alloc"),
+    ('bwlimit', None, "limit socket I/O bandwidth"),
+    ('timeout', None, "set I/O timeout in seconds"),
     ('suffix', None, "backup suffix (default ~ w/o --backup-dir)"),
+    ('checksum', 'c', "skip based on checksum, not mod-time & size"),
+    ('files-from', None, "read list of source-file names from FILE"),
+    ('log-file', None, "log what we're doing to the specified FILE"),
+    ('log-file-format', None, "log updates using the specified FMT"),
+    ('write-batch', None, "write a batched update to FILE"),
+    ('only-write-batch', None, "like --write-batch but w/o updating dest"),
+    ('read-batch', None, "read a batched update from FILE"),
 
     # sync options
     ('delete', None, "delete extraneous files from dest dirs"),
     ('delete-excluded', None, "also delete excluded files from dest dirs"),
+    ('delete-before', None, "receiver deletes before xfer, not during"),
+    ('delete-during', None, "receiver deletes during the transfer"),
+    ('delete-delay', None, "find deletions during, delete after"),
+    ('delete-after', None, "receiver deletes after transfer, not during"),
     ('update', 'u', "skip files that are newer on the receiver"),
     ('ignore-existing', None, "skip updating files that exist on receiver"),
     ('existing', None, "skip creating new files on receiver"),
+    ('delete-missing-args', None, "delete missing source args from destination"),
 
     # misc.
 
@@ -67,19 +113,100 @@ RSYNC_FLAGS = (
     'compress',
     'update',
     'archive',
+    'recursive',
     'verbose',
     'human-readable',
     'itemize-changes',
     'stats',
     'backup',
+    'checksum',
+    'whole-file',
+    'no-whole-file',
+    'inplace',
+    'append',
+    'sparse',
+    'preallocate',
+    'no-inc-recursive',
+    'delete-before',
+    'delete-during',
+    'delete-delay',
+    'delete-after',
+    'delete-missing-args',
+    'force',
 )
 """Boolean options that require no explicit value. The presence implies 'True'"""
 
 RSYNC_KV_OPTS = (
     'suffix',
+    'files-from',
+    'log-file',
+    'log-file-format',
+    'write-batch',
+    'only-write-batch',
+    'read-batch',
+    'compress-choice',
+    'checksum-choice',
+    'checksum-seed',
+    'block-size',
+    'max-alloc',
+    'bwlimit',
+    'timeout',
+    'filter',
 )
 """The supported options that require typed values."""
 
+RSYNC_EXCLUSIVE_FLAGS = (
+    ('delete-before', 'delete-during', 'delete-delay', 'delete-after'),
+    ('whole-file', 'no-whole-file'),
+    # appending only sends the data past the destination's end, which
+    # needs the delta transfer
+    ('append', 'whole-file'),
+)
+"""Groups of flags of which at most one may be given."""
+
+RSYNC_DELETE_FLAGS = (
+    'delete',
+    'delete-excluded',
+    'delete-before',
+    'delete-during',
+    'delete-delay',
+    'delete-after',
+)
+"""Flags which delete extraneous destination files, each implies '--delete'."""
+
+RSYNC_MAX_BLOCK_SIZE = 131072
+"""Largest 'block-size' accepted by protocol 30 and newer."""
+
+FILTER_WILDCARD_RE = re.compile(r'[*?[]')
+
+FILTER_ESCAPE_RE = re.compile(r'([*?[\\])')
+
+SIZE_RE = re.compile(r'^\d+(\.\d+)?([KMGTP]i?)?[Bb]?$', re.IGNORECASE)
+
+RSYNC_CHECKSUM_CHOICES = (
+    'auto',
+    'xxh128',
+    'xxh3',
+    'xxh64',
+    'xxhash',
+    'md5',
+    'md4',
+    'sha1',
+    'none',
+)
+"""The algorithms accepted by 'checksum-choice'."""
+
+TYPED_KV_FIELDS = (
+    # field, option
+    ('checksum_choice', 'checksum-choice'),
+    ('checksum_seed', 'checksum-seed'),
+    ('block_size', 'block-size'),
+    ('max_alloc', 'max-alloc'),
+    ('bwlimit', 'bwlimit'),
+    ('timeout', 'timeout'),
+)
+"""Fields of `Options` rendered as key-value options when set."""
+
 RSYNC_INFO_OPTS = (
         'backup', # Mention files backed up
         'copy', # Mention files copied locally on the receiving side
@@ -130,6 +257,92 @@ class Options():
     # the key-value options
     suffix: str = '~'
 
+    # a single algorithm or a comma separated pair for the transfer
+    # and pre-transfer checksums
+    checksum_choice: Optional[str] = None
+    checksum_seed: Optional[int] = None
+
+    # the block size is in bytes, the other sizes may also be given
+    # with units like '128K'
+    block_size: Optional[int] = None
+    max_alloc: Optional[str] = None
+    bwlimit: Optional[str] = None
+    timeout: Optional[int] = None
+
+    def __post_init__(self) -> None:
+
+        conflicts = self.conflicts()
+        if conflicts:
+            raise ValueError(f"Conflicting options: {', '.join(conflicts)}")
+
+        if self.checksum_choice is not None:
+            choices = self.checksum_choice.split(',')
+
+            if len(choices) > 2 or any(choice not in RSYNC_CHECKSUM_CHOICES
+                                       for choice in choices):
+                raise ValueError(
+                    f"Invalid checksum choice '{self.checksum_choice}'")
+
+        if self.checksum_seed is not None:
+            if not 0 <= int(self.checksum_seed) < 2**32:
+                raise ValueError("Checksum seed must be a 32-bit unsigned int")
+
+        if self.block_size is not None:
+            try:
+                block_size = int(self.block_size)
+            except ValueError:
+                raise ValueError(
+                    f"Block size must be a number of bytes, not '{self.block_size}'")
+
+            if not 0 < block_size <= RSYNC_MAX_BLOCK_SIZE:
+                raise ValueError(
+                    f"Block size must be between 1 and {RSYNC_MAX_BLOCK_SIZE}")
+
+        for field in ('max_alloc', 'bwlimit'):
+            value = getattr(self, field)
+            if value is not None and not SIZE_RE.match(str(value)):
+                raise ValueError(f"Invalid size '{value}' for {field}")
+
+        if self.timeout is not None and int(self.timeout) < 0:
+            raise ValueError("Timeout must not be negative")
+
+    def conflicts(self) -> List[str]:
+        """Get the options which can't be used together.
+
+        These are the groups of `RSYNC_EXCLUSIVE_FLAGS`, combinations
+        current rsync versions refuse. Ones only older versions refuse,
+        like '--sparse' with '--inplace' before 3.1.3, are left to
+        rsync.
+
+        """
+
+        flags = set(self.flags or ())
+
+        conflicts = []
+        for group in RSYNC_EXCLUSIVE_FLAGS:
+            given = [flag for flag in group if flag in flags]
+            if len(given) > 1:
+                conflicts.append(' & '.join(given))
+
+        return conflicts
+
+    @property
+    def deletes(self) -> bool:
+        """Whether any of the `RSYNC_DELETE_FLAGS` is given."""
+
+        return bool(set(self.flags or ()) & set(RSYNC_DELETE_FLAGS))
+
+    def typed_kv(self) -> Mapping[str, str]:
+        """The key-value options set through the typed fields."""
+
+        kv = {}
+        for field, option in TYPED_KV_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                kv[option] = str(value)
+
+        return kv
+
     @staticmethod
     def is_flags_valid(flags):
 
@@ -202,6 +415,18 @@ class Endpoint():
     def path(self):
         return '/' + '/'.join(self.url.path)
 
+    @property
+    def spec(self) -> str:
+        """The endpoint as an rsync argument, '[user@]host:path' when remote."""
+
+        prefix = ''
+        if self.url.user:
+            prefix += f"{self.url.user}@"
+        if self.url.host:
+            prefix += f"{self.url.host}:"
+
+        return prefix + self.path
+
     @classmethod
     def construct(cls,
                   host=None,
@@ -249,6 +474,132 @@ def get_rsync_template() -> str:
                   .decode()
 
 
+@functools.lru_cache(maxsize=1)
+def get_compiled_rsync_template() -> Template:
+    """Get the command template, only compiling it once.
+
+    Values are shell quoted with the 'quote' filter so the rendering
+    can be pasted into a shell.
+
+    """
+
+    env = Environment()
+    env.filters['quote'] = shlex.quote
+
+    return env.from_string(get_rsync_template())
+
+
+_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+def _freeze(value):
+
+    if type(value) in _SCALAR_TYPES:
+        return value
+
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(val) for val in value)
+
+    elif isinstance(value, (set, frozenset)):
+        # sorted by representation as the members may not be comparable
+        return ('set',) + tuple(sorted((_freeze(val) for val in value), key=repr))
+
+    elif isinstance(value, URL):
+        return value.to_text()
+
+    elif hasattr(value, '__dataclass_fields__'):
+        return (type(value).__name__,) + tuple(_freeze(getattr(value, name))
+                                              for name in value.__dataclass_fields__)
+
+    elif isinstance(value, Mapping):
+        return tuple(sorted((key, _freeze(val)) for key, val in value.items()))
+
+    try:
+        hash(value)
+    except TypeError:
+        raise TypeError(
+            f"Can't key a rendering on a value of type '{type(value).__name__}'")
+
+    return value
+
+
+def command_key(command: 'Command') -> tuple:
+    """Get a hashable key of everything that determines a rendering.
+
+    The dataclasses are mutable so the key is computed from their
+    content on every call rather than cached on them.
+
+    """
+
+    return _freeze(command)
+
+
+class RenderCache():
+    """Size bounded LRU cache of rendered commands keyed by content."""
+
+    def __init__(self, maxsize: int = 4096):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _lookup(self, key, render):
+
+        if self.maxsize <= 0:
+            return render()
+
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            self.misses += 1
+
+        value = render()
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def render(self, command: 'Command') -> str:
+
+        return self._lookup(('str', command_key(command)),
+                            command._render)
+
+    def render_argv(self, command: 'Command') -> List[str]:
+
+        # the cached list is shared so hand out copies
+        return list(self._lookup(('argv', command_key(command)),
+                                 lambda: tuple(command._render_argv())))
+
+
+RENDER_CACHE = RenderCache()
+"""The cache used by `Command.render` and `Command.render_argv`.
+
+Set its `maxsize` to 0 to disable memoization.
+
+"""
+
+
 @dc.dataclass
 class Command():
     """Specifications for an rsync invocation."""
@@ -266,6 +617,19 @@ class Command():
             raise ValueError("Invalid dest endpoint")
 
     def render(self) -> str:
+        return RENDER_CACHE.render(self)
+
+    def render_argv(self) -> List[str]:
+        """Render the command as an argument list for `subprocess`."""
+
+        return RENDER_CACHE.render_argv(self)
+
+    def _kv(self) -> Mapping[str, str]:
+
+        # typed fields take precedence over raw key-values
+        return {**(self.options.kv or {}), **self.options.typed_kv()}
+
+    def _render(self) -> str:
 
         d = {
                 'src' : self.src,
@@ -286,20 +650,106 @@ class Command():
                     **d,
                 }
 
-            if self.options.kv:
+            kv = self._kv()
+            if kv:
                 d = {
-                    'kv' : self.options.kv,
+                    'kv' : kv,
                     **d,
                 }
 
 
-        template = Template(get_rsync_template())
+        template = get_compiled_rsync_template()
         result = template.render(**d,
                                  trim_blocks=True,
                                  lstrip_blocks=True)
 
         return result
 
+    def _render_argv(self) -> List[str]:
+
+        # built in the order of the template, values are passed on as
+        # they are since no shell is involved
+        argv = ['rsync']
+
+        if self.options:
+            argv.extend(f"--{flag}" for flag in self.options.flags or ())
+
+            argv.extend(f"--{key}={value}" for key, value in self._kv().items())
+
+            if self.options.info:
+                argv.append(f"--info={','.join(self.options.info.flags)}")
+
+            argv.extend(f"--include={spec}" for spec in self.options.includes or ())
+            argv.extend(f"--exclude={spec}" for spec in self.options.excludes or ())
+
+        argv.append(self.src.spec + '/')
+        argv.append(self.dest.spec)
+
+        return argv
+
+def extend_options(options: Optional[Options],
+                   flags: Tuple[str] = (),
+                   kv: Optional[Mapping[str, str]] = None,
+) -> Options:
+    """Return a copy of the options with extra flags and key-values added.
+
+    Flags already present are not duplicated and new key-values
+    override existing ones. A missing `options` is treated as empty.
+
+    """
+
+    if options is None:
+        options = Options(flags=(),
+                          includes=(),
+                          excludes=(),
+                          info=None,
+                          kv=None)
+
+    old_flags = tuple(options.flags or ())
+    new_flags = old_flags + tuple(f for f in flags if f not in old_flags)
+
+    new_kv = {**(options.kv or {}), **(kv or {})}
+
+    return dc.replace(options,
+                      flags=new_flags,
+                      kv=new_kv if new_kv else options.kv)
+
+def escape_filter_pattern(path: str) -> str:
+    """Escape a path for use as a literal include or exclude pattern.
+
+    rsync only takes backslashes as escapes in patterns with wildcard
+    characters, so paths without any are returned as they are.
+
+    """
+
+    if not FILTER_WILDCARD_RE.search(path):
+        return path
+
+    return FILTER_ESCAPE_RE.sub(r'\\\1', path)
+
+def protect_paths(options: Optional[Options],
+                  rel_paths: Iterable[str],
+                  rules_path: str,
+) -> Options:
+    """Return a copy of the options leaving paths out without deleting them.
+
+    This is for paths another job transfers. Excluded paths are
+    deleted from the destination with '--delete-excluded', so instead
+    a merge file is written at `rules_path` with a hide rule, which
+    only keeps the sender from sending a path, and a protect rule,
+    which keeps the receiver from deleting it, for each path relative
+    to the source. It's given with the 'filter' option, which comes
+    before the includes and excludes.
+
+    """
+
+    with open(rules_path, 'w') as wf:
+        for rel_path in rel_paths:
+            pattern = '/' + escape_filter_pattern(rel_path)
+            wf.write(f"H {pattern}\nP {pattern}\n")
+
+    return extend_options(options, kv={'filter' : f'. {rules_path}'})
+
 default_options = {
     'flags' : (
         'archive',
@@ -0,0 +1,460 @@
+"""Tree manifests of local and remote endpoints, and sharding by them.
+
+A manifest is a stream of `ManifestEntry` records, one per file,
+directory or symlink under a root with paths relative to it. Local
+trees are scanned directly. Remote trees are listed with a single
+`find -printf` (or `rsync --list-only`) over the remote shell and the
+output is parsed as it streams in. Remote listings are cached on disk
+in the same NUL separated format `write_manifest` uses.
+
+Any command taking a host and a command line like ssh does can be
+used as the remote shell, e.g. a local script running the command
+with `sh -c` to stand in for a remote host.
+
+"""
+
+import dataclasses as dc
+import hashlib
+import heapq
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import (
+    Optional,
+    List,
+    Iterable,
+    Generator,
+    Set,
+)
+
+from .main import (
+    Endpoint,
+    Command,
+    extend_options,
+)
+from .capture import (
+    RingBuffer,
+    drain_pipe,
+)
+
+__all__ = [
+    'MANIFEST_CACHE_DIR',
+    'MANIFEST_TTL',
+    'ManifestEntry',
+    'scan_local',
+    'write_manifest',
+    'read_manifest',
+    'parse_find_record',
+    'parse_list_only_line',
+    'list_remote',
+    'list_tree',
+    'existing_paths',
+    'shard_manifest',
+    'shard_commands',
+]
+
+
+MANIFEST_CACHE_DIR = Path('~/.cache/py_rsync/manifests')
+"""Default directory of cached remote listings."""
+
+MANIFEST_TTL = 60 * 60
+"""Seconds a cached remote listing is reused for."""
+
+FIND_FORMAT = r'%y\t%s\t%T@\t%P\0'
+"""The `find -printf` format of remote listings."""
+
+EXISTS_BATCH = 1000
+
+MISSING_ROOT_EXIT = 66
+"""Exit status of the remote `find` listing when the root doesn't exist."""
+
+# how rsync --list-only reports a missing root
+MISSING_ROOT_RE = re.compile(r'(?:change_dir|link_stat) "[^"]*" failed: '
+                             r'No such file or directory')
+
+LIST_ONLY_RE = re.compile(r'^(?P<mode>[-dlcbps][-rwxsStT]{9})\s+'
+                          r'(?P<size>[\d,]+)\s+'
+                          r'(?P<date>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d)\s'
+                          r'(?P<path>.+)$')
+
+READ_SIZE = 1024 * 1024
+
+
+@dc.dataclass(frozen=True)
+class ManifestEntry():
+    """A single node of a tree."""
+
+    path: str
+    size: int
+    mtime: float
+    # 'f' for files, 'd' for directories, 'l' for symlinks, and
+    # otherwise the `find -printf %y` letter
+    kind: str = 'f'
+
+    def to_record(self) -> str:
+        return f"{self.kind}\t{self.size}\t{self.mtime}\t{self.path}"
+
+
+def scan_local(root) -> Generator[ManifestEntry, None, None]:
+    """Yield the entries under a local directory, without following links."""
+
+    root = str(root)
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+
+                rel_path = os.path.join(rel_dir, entry.name)
+                st = entry.stat(follow_symlinks=False)
+
+                if entry.is_symlink():
+                    kind = 'l'
+                elif entry.is_dir(follow_symlinks=False):
+                    kind = 'd'
+                    stack.append(rel_path)
+                elif entry.is_file(follow_symlinks=False):
+                    kind = 'f'
+                else:
+                    kind = 'o'
+
+                yield ManifestEntry(path=rel_path,
+                                    size=st.st_size,
+                                    mtime=st.st_mtime,
+                                    kind=kind)
+
+
+def parse_find_record(record: str) -> ManifestEntry:
+    """Parse a record written with `FIND_FORMAT`, without its NUL."""
+
+    kind, size, mtime, path = record.split('\t', 3)
+
+    return ManifestEntry(path=path,
+                         size=int(size),
+                         mtime=float(mtime),
+                         kind=kind)
+
+
+def parse_list_only_line(line: str) -> Optional[ManifestEntry]:
+    """Parse a line of `rsync --list-only` output.
+
+    Returns `None` for lines which aren't entries, and the root
+    directory entry '.'. Times only have a resolution of seconds and
+    are interpreted in local time.
+
+    """
+
+    match = LIST_ONLY_RE.match(line)
+    if match is None or match.group('path') == '.':
+        return None
+
+    mode = match.group('mode')
+    path = match.group('path')
+
+    kind = {'-' : 'f', 'd' : 'd', 'l' : 'l'}.get(mode[0], mode[0])
+    if kind == 'l':
+        path = path.split(' -> ', 1)[0]
+
+    mtime = time.mktime(time.strptime(match.group('date'),
+                                      '%Y/%m/%d %H:%M:%S'))
+
+    return ManifestEntry(path=path,
+                         size=int(match.group('size').replace(',', '')),
+                         mtime=mtime,
+                         kind=kind)
+
+
+def write_manifest(path,
+                   entries: Iterable[ManifestEntry],
+) -> int:
+    """Write entries as NUL separated records, returning the count."""
+
+    count = 0
+    with open(path, 'w', newline='') as wf:
+        for entry in entries:
+            wf.write(entry.to_record() + '\0')
+            count += 1
+
+    return count
+
+
+def _split_records(chunks: Iterable[bytes],
+                   sep: bytes = b'\0',
+) -> Generator[str, None, None]:
+
+    tail = b''
+    for chunk in chunks:
+
+        records = (tail + chunk).split(sep)
+        tail = records.pop()
+
+        for record in records:
+            yield os.fsdecode(record)
+
+    if tail:
+        yield os.fsdecode(tail)
+
+
+def _read_chunks(f) -> Generator[bytes, None, None]:
+
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def read_manifest(path) -> Generator[ManifestEntry, None, None]:
+    """Stream the entries of a manifest file."""
+
+    with open(path, 'rb') as rf:
+        for record in _split_records(_read_chunks(rf)):
+            yield parse_find_record(record)
+
+
+def _remote_argv(endpoint: Endpoint,
+                 method: str,
+                 rsh: str,
+) -> List[str]:
+
+    userhost = endpoint.url.host
+    if endpoint.url.user:
+        userhost = f"{endpoint.url.user}@{userhost}"
+
+    if method == 'find':
+        path = shlex.quote(endpoint.path)
+        remote = (f"test -e {path} || exit {MISSING_ROOT_EXIT}; "
+                  f"find {path} -mindepth 1 "
+                  f"-printf {shlex.quote(FIND_FORMAT)}")
+        return shlex.split(rsh) + [userhost, remote]
+
+    elif method == 'rsync':
+        # rsync runs the remote side over the remote shell itself
+        return ['rsync',
+                '--list-only',
+                '--recursive',
+                f'--rsh={rsh}',
+                f"{userhost}:{endpoint.path}/"]
+
+    else:
+        raise ValueError(f"Listing method '{method}' not recognized.")
+
+
+def list_remote(endpoint: Endpoint,
+                method: str = 'find',
+                rsh: str = 'ssh',
+                cache_dir=MANIFEST_CACHE_DIR,
+                ttl: float = MANIFEST_TTL,
+                refresh: bool = False,
+) -> Generator[ManifestEntry, None, None]:
+    """Stream the manifest of a remote endpoint, caching it on disk.
+
+    The listing is parsed while it streams in and written to the cache
+    as it goes, the cache file only being put in place once the
+    listing completed successfully. Standard error is drained by a
+    thread meanwhile, keeping its most recent lines for the error, so
+    lots of e.g. 'Permission denied' can't fill the pipe and stall
+    the listing.
+
+    A root which doesn't exist, like the destination of a first sync,
+    raises `FileNotFoundError` as for local trees.
+
+    """
+
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir).expanduser()
+        key = hashlib.sha1(f"{method}:{endpoint.url.to_text()}".encode())\
+                     .hexdigest()
+        cache_path = cache_dir / f"{key}.manifest"
+
+        if (not refresh and
+            cache_path.exists() and
+            time.time() - cache_path.stat().st_mtime < ttl):
+
+            yield from read_manifest(cache_path)
+            return
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(cache_dir), suffix='.tmp')
+        cache_file = os.fdopen(fd, 'w', newline='')
+
+    else:
+        cache_file = None
+
+    proc = subprocess.Popen(_remote_argv(endpoint, method, rsh),
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    stderr = RingBuffer()
+    drainer = threading.Thread(target=drain_pipe,
+                               args=(proc.stderr, stderr),
+                               daemon=True)
+    drainer.start()
+
+    completed = False
+    try:
+        sep = b'\0' if method == 'find' else b'\n'
+        for record in _split_records(_read_chunks(proc.stdout), sep=sep):
+
+            if method == 'find':
+                entry = parse_find_record(record)
+            else:
+                entry = parse_list_only_line(record)
+                if entry is None:
+                    continue
+
+            if cache_file is not None:
+                cache_file.write(entry.to_record() + '\0')
+
+            yield entry
+
+        returncode = proc.wait()
+        drainer.join()
+
+        message = stderr.getvalue().decode(errors='replace').strip()
+
+        if ((method == 'find' and returncode == MISSING_ROOT_EXIT) or
+            (method == 'rsync' and returncode != 0 and
+             MISSING_ROOT_RE.search(message))):
+            raise FileNotFoundError(
+                f"Remote root '{endpoint.url.to_text()}' does not exist")
+
+        if returncode != 0:
+            raise RuntimeError(f"Remote listing failed: {message}")
+
+        completed = True
+
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+        if cache_file is not None:
+            cache_file.close()
+
+            # only complete listings are cached
+            if completed:
+                os.replace(tmp_path, cache_path)
+            else:
+                os.remove(tmp_path)
+
+
+def list_tree(endpoint: Endpoint, **kwargs) -> Generator[ManifestEntry, None, None]:
+    """Stream the manifest of a local or remote endpoint."""
+
+    if endpoint.url.host:
+        return list_remote(endpoint, **kwargs)
+
+    return scan_local(endpoint.path)
+
+
+def existing_paths(endpoint: Endpoint,
+                   rel_paths: Iterable[str],
+                   rsh: str = 'ssh',
+) -> Set[str]:
+    """Get which of some paths relative to an endpoint exist.
+
+    This stats just those paths, which for a handful of them is much
+    cheaper than listing the whole tree. Remote paths are tested in
+    batches with a shell loop over the remote shell. A missing root
+    means none exist.
+
+    """
+
+    rel_paths = list(rel_paths)
+
+    if not endpoint.url.host:
+        return {rel_path for rel_path in rel_paths
+                if os.path.lexists(os.path.join(endpoint.path, rel_path))}
+
+    userhost = endpoint.url.host
+    if endpoint.url.user:
+        userhost = f"{endpoint.url.user}@{userhost}"
+
+    existing = set()
+    for start in range(0, len(rel_paths), EXISTS_BATCH):
+        batch = ' '.join(shlex.quote(rel_path)
+                         for rel_path in rel_paths[start:start + EXISTS_BATCH])
+
+        remote = (f"cd {shlex.quote(endpoint.path)} 2>/dev/null || exit 0; "
+                  f"for p in {batch}; do "
+                  "if test -e \"$p\" || test -h \"$p\"; then "
+                  "printf '%s\\0' \"$p\"; fi; done")
+
+        proc = subprocess.run(shlex.split(rsh) + [userhost, remote],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            message = proc.stderr.decode(errors='replace').strip()
+            raise RuntimeError(f"Remote stat failed: {message}")
+
+        existing.update(os.fsdecode(record)
+                        for record in proc.stdout.split(b'\0') if record)
+
+    return existing
+
+
+def shard_manifest(entries: Iterable[ManifestEntry],
+                   n_shards: int,
+) -> List[List[str]]:
+    """Split the files of a manifest into shards of balanced total size.
+
+    Files are assigned largest first to the currently smallest shard.
+    Each shard's paths are sorted.
+
+    """
+
+    if n_shards < 1:
+        raise ValueError("Number of shards must be at least 1")
+
+    files = sorted((entry for entry in entries if entry.kind != 'd'),
+                   key=lambda entry: entry.size,
+                   reverse=True)
+
+    heap = [(0, i) for i in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for entry in files:
+        total, i = heapq.heappop(heap)
+        shards[i].append(entry.path)
+        heapq.heappush(heap, (total + entry.size, i))
+
+    return [sorted(shard) for shard in shards]
+
+
+def shard_commands(command: Command,
+                   entries: Iterable[ManifestEntry],
+                   n_shards: int,
+                   files_from_dir: Optional[str] = None,
+) -> List[Command]:
+    """Split a command into commands each syncing one shard of its source.
+
+    Empty shards are dropped.
+
+    """
+
+    if files_from_dir is None:
+        files_from_dir = tempfile.mkdtemp(prefix='py_rsync_shards_')
+
+    commands = []
+    for i, shard in enumerate(shard_manifest(entries, n_shards)):
+
+        if not shard:
+            continue
+
+        files_from = os.path.join(files_from_dir, f'shard_{i}.txt')
+        with open(files_from, 'w') as wf:
+            for rel_path in shard:
+                wf.write(rel_path + '\n')
+
+        commands.append(dc.replace(
+            command,
+            options=extend_options(command.options,
+                                   kv={'files-from' : files_from})))
+
+    return commands
@@ -0,0 +1,287 @@
+"""Parallel Merkle tree verification of local trees.
+
+Proving a destination matches its source with a `--checksum` dry run
+reads both trees in a single rsync process. Here the files of both
+trees are hashed together in a process pool with memory mapped reads,
+and each directory gets a digest over the names, kinds and digests of
+its children. Comparing starts at the roots and only descends into
+directories whose digests differ, so matching subtrees are settled
+with a single comparison and the mismatches are found directly.
+
+"""
+
+import dataclasses as dc
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Tuple,
+    Sequence,
+    Generator,
+)
+
+from .main import Command
+from .local_copy import FilterRules
+from .checksum_cache import (
+    CHECKSUM_CACHE_ALGORITHM,
+    hash_file,
+)
+from .tree_diff import scan_local_sorted
+
+__all__ = [
+    'MerkleTree',
+    'build_merkle_trees',
+    'Mismatch',
+    'compare_trees',
+    'VerifyResult',
+    'verify_trees',
+    'verify_local_command',
+]
+
+
+HASH_CHUNKSIZE = 64
+"""Files handed to a hashing process at a time."""
+
+
+@dc.dataclass
+class MerkleTree():
+    """The digests of a tree's files and directories.
+
+    `children` maps each directory, '' being the root, to its children
+    by name as (kind, digest) pairs, and `digests` maps directories to
+    their own digest.
+
+    """
+
+    root: str
+    algorithm: str
+    children: Dict[str, Dict[str, Tuple[str, str]]]
+    digests: Dict[str, str]
+
+    @property
+    def digest(self) -> str:
+        return self.digests['']
+
+
+def _hash_file(args) -> str:
+
+    path, algorithm = args
+    return hash_file(path, algorithm=algorithm)
+
+
+def _scan(root, rules: Optional[FilterRules] = None):
+
+    root = str(root)
+
+    # directory -> {name: [kind, digest]}
+    children = {'': {}}
+    dirs = ['']
+    files = []
+    for entry in scan_local_sorted(root):
+
+        if rules is not None and \
+           not rules.included_path(entry.path, is_dir=entry.kind == 'd'):
+            continue
+
+        parent, name = os.path.split(entry.path)
+
+        digest = None
+        if entry.kind == 'd':
+            children[entry.path] = {}
+            dirs.append(entry.path)
+
+        elif entry.kind == 'f':
+            files.append(entry.path)
+
+        elif entry.kind == 'l':
+            digest = 'l:' + os.readlink(os.path.join(root, entry.path))
+
+        else:
+            digest = entry.kind
+
+        children[parent][name] = [entry.kind, digest]
+
+    return children, dirs, files
+
+
+def _dir_digest(algorithm: str, children: Dict[str, list]) -> str:
+
+    hasher = hashlib.new(algorithm)
+    for name in sorted(children):
+        kind, digest = children[name]
+        hasher.update(f"{kind}\0{name}\0{digest}\n".encode(errors='surrogateescape'))
+
+    return hasher.hexdigest()
+
+
+def build_merkle_trees(roots: Sequence,
+                       algorithm: str = CHECKSUM_CACHE_ALGORITHM,
+                       workers: Optional[int] = None,
+                       rules: Optional[FilterRules] = None,
+) -> List[MerkleTree]:
+    """Hash several trees, their files all in one process pool.
+
+    Paths excluded by `rules` are left out of every tree.
+
+    """
+
+    scans = [_scan(root, rules=rules) for root in roots]
+
+    jobs = [(os.path.join(str(root), rel_path), algorithm)
+            for root, (_, _, files) in zip(roots, scans)
+            for rel_path in files]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        file_digests = iter(pool.map(_hash_file, jobs, chunksize=HASH_CHUNKSIZE))
+
+        trees = []
+        for root, (children, dirs, files) in zip(roots, scans):
+
+            for rel_path in files:
+                parent, name = os.path.split(rel_path)
+                children[parent][name][1] = next(file_digests)
+
+            # children come after their parents in the scan, so the
+            # reverse order has every subdirectory's digest ready
+            digests = {}
+            for rel_dir in reversed(dirs):
+                digest = _dir_digest(algorithm, children[rel_dir])
+                digests[rel_dir] = digest
+
+                if rel_dir:
+                    parent, name = os.path.split(rel_dir)
+                    children[parent][name][1] = digest
+
+            trees.append(MerkleTree(
+                root=str(root),
+                algorithm=algorithm,
+                children={rel_dir : {name : tuple(node)
+                                     for name, node in nodes.items()}
+                          for rel_dir, nodes in children.items()},
+                digests=digests))
+
+    return trees
+
+
+@dc.dataclass(frozen=True)
+class Mismatch():
+    """A path which differs between the trees.
+
+    The reason is 'missing' from the destination, 'extra' in the
+    destination, 'kind' when one is e.g. a file and the other a
+    directory, or 'content'.
+
+    """
+
+    path: str
+    reason: str
+
+
+def compare_trees(src: MerkleTree,
+                  dest: MerkleTree,
+) -> Generator[Mismatch, None, None]:
+    """Yield the mismatches of two trees, descending only where digests differ.
+
+    A missing or extra directory is reported once, not everything in it.
+
+    """
+
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+
+        if src.digests[rel_dir] == dest.digests[rel_dir]:
+            continue
+
+        src_children = src.children[rel_dir]
+        dest_children = dest.children[rel_dir]
+
+        for name in sorted(src_children.keys() | dest_children.keys()):
+            rel_path = os.path.join(rel_dir, name)
+
+            if name not in dest_children:
+                yield Mismatch(rel_path, 'missing')
+
+            elif name not in src_children:
+                yield Mismatch(rel_path, 'extra')
+
+            else:
+                src_kind, src_digest = src_children[name]
+                dest_kind, dest_digest = dest_children[name]
+
+                # e.g. empty files and directories have equal digests
+                if src_kind != dest_kind:
+                    yield Mismatch(rel_path, 'kind')
+                elif src_digest == dest_digest:
+                    continue
+                elif src_kind == 'd':
+                    stack.append(rel_path)
+                else:
+                    yield Mismatch(rel_path, 'content')
+
+
+@dc.dataclass
+class VerifyResult():
+    """The outcome of verifying a destination tree against its source."""
+
+    src_digest: str
+    dest_digest: str
+    mismatches: List[Mismatch]
+
+    @property
+    def matches(self) -> bool:
+        return self.src_digest == self.dest_digest
+
+
+def verify_trees(src_root,
+                 dest_root,
+                 algorithm: str = CHECKSUM_CACHE_ALGORITHM,
+                 workers: Optional[int] = None,
+                 max_mismatches: Optional[int] = None,
+                 rules: Optional[FilterRules] = None,
+) -> VerifyResult:
+    """Verify a local destination tree has the same contents as the source.
+
+    Only contents, names and kinds of entries and symlink targets are
+    compared, not permissions or times. Paths excluded by `rules` are
+    ignored in both trees. Reporting stops after `max_mismatches` if
+    given.
+
+    """
+
+    src, dest = build_merkle_trees([src_root, dest_root],
+                                   algorithm=algorithm,
+                                   workers=workers,
+                                   rules=rules)
+
+    mismatches = []
+    for mismatch in compare_trees(src, dest):
+        mismatches.append(mismatch)
+
+        if max_mismatches is not None and len(mismatches) >= max_mismatches:
+            break
+
+    return VerifyResult(src_digest=src.digest,
+                        dest_digest=dest.digest,
+                        mismatches=mismatches)
+
+
+def verify_local_command(command: Command, **kwargs) -> VerifyResult:
+    """Verify the result of a local to local command, see `verify_trees`.
+
+    The command's includes and excludes apply, as the files they
+    exclude aren't transferred.
+
+    """
+
+    if command.src.url.host or command.dest.url.host:
+        raise ValueError("Merkle verification requires local endpoints")
+
+    options = command.options
+    rules = FilterRules(options and options.includes,
+                        options and options.excludes)
+
+    return verify_trees(command.src.path, command.dest.path, rules=rules, **kwargs)
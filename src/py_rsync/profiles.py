@@ -0,0 +1,303 @@
+"""Named tuning profiles and trial based auto-tuning.
+
+Profiles are sets of option values in the same form as
+`default_options`, for the common kinds of transfers:
+
+- local :: both sides on local disks, delta transfer only costs CPU
+- lan :: fast low-latency networks where the wire is not the bottleneck
+- wan :: slow or high-latency links where bytes on the wire dominate
+
+`auto_tune` times short trial transfers of a sample of the source
+with each profile and caches the fastest per endpoint pair.
+
+"""
+
+import dataclasses as dc
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import (
+    Optional,
+    Dict,
+    List,
+    Sequence,
+    Callable,
+)
+
+from .main import (
+    RSYNC_EXCLUSIVE_FLAGS,
+    FILTER_ESCAPE_RE,
+    Endpoint,
+    Options,
+    Command,
+    extend_options,
+)
+from .run import (
+    RunResult,
+    run_command,
+)
+from .checksum_cache import walk_files
+from .cache_file import (
+    load_cache,
+    save_cache,
+)
+
+__all__ = [
+    'local_options',
+    'lan_options',
+    'wan_options',
+    'PROFILES',
+    'PROFILE_FLAGS',
+    'PROFILES_CACHE_PATH',
+    'PROFILES_TTL',
+    'apply_profile',
+    'endpoint_pair_key',
+    'TuneResult',
+    'auto_tune',
+]
+
+
+local_options = {
+    'flags' : (
+        'whole-file',
+        'preallocate',
+    ),
+}
+
+lan_options = {
+    'flags' : (
+        'whole-file',
+    ),
+}
+
+wan_options = {
+    'flags' : (
+        'no-whole-file',
+        'compress',
+    ),
+    'timeout' : 300,
+}
+
+PROFILES = {
+    'local' : local_options,
+    'lan' : lan_options,
+    'wan' : wan_options,
+}
+"""The named profiles."""
+
+PROFILE_FLAGS = (
+    'whole-file',
+    'no-whole-file',
+    'compress',
+    'preallocate',
+)
+"""Flags a profile may add, unless they conflict with the given ones."""
+
+PROFILE_FIELDS = (
+    'timeout',
+)
+
+PROFILES_CACHE_PATH = Path('~/.cache/py_rsync/profiles.json')
+"""Default location of the cached auto-tune choices."""
+
+PROFILES_TTL = 7 * 24 * 60 * 60
+"""Seconds an auto-tune choice is trusted for."""
+
+
+def _conflicting(flag: str, flags) -> bool:
+
+    return any(flag in group and any(other in flags and other != flag
+                                     for other in group)
+               for group in RSYNC_EXCLUSIVE_FLAGS)
+
+
+def apply_profile(options: Optional[Options], name: str) -> Options:
+    """Return a copy of the options tuned with the named profile.
+
+    A profile only adds to the options. Its flags conflicting with
+    given ones, like 'whole-file' with '--append', and values already
+    set, like a timeout, are left as given.
+
+    """
+
+    if name not in PROFILES:
+        raise ValueError(f"Profile '{name}' not recognized.")
+
+    profile = PROFILES[name]
+
+    options = extend_options(options)
+    kv = options.kv
+
+    given = set(options.flags or ())
+    flags = tuple(flag for flag in profile.get('flags', ())
+                  if not _conflicting(flag, given))
+
+    fields = {field : profile[field]
+              for field in PROFILE_FIELDS
+              if (field in profile and
+                  getattr(options, field) is None and
+                  not (kv and field.replace('_', '-') in kv))}
+
+    # the block size only applies to the delta transfer
+    if 'whole-file' in flags:
+        fields['block_size'] = None
+        if kv and 'block-size' in kv:
+            kv = {key : value for key, value in kv.items()
+                  if key != 'block-size'}
+
+    options = dc.replace(options, kv=kv, **fields)
+
+    return extend_options(options, flags=flags)
+
+
+def endpoint_pair_key(command: Command) -> str:
+    return f"{command.src.url.to_text()} -> {command.dest.url.to_text()}"
+
+
+@dc.dataclass
+class TuneResult():
+    """The timings of the trial transfers and the chosen profile."""
+
+    profile: str
+    timings: Dict[str, float]
+    cached: bool = False
+
+
+def _sample(root: str,
+            sample_bytes: int,
+            sample_files: int,
+) -> List[str]:
+
+    paths = []
+    total = 0
+    for rel_path in walk_files(root):
+
+        if len(paths) >= sample_files or total >= sample_bytes:
+            break
+
+        paths.append(rel_path)
+        total += os.path.getsize(os.path.join(root, rel_path))
+
+    return paths
+
+
+def auto_tune(command: Command,
+              profiles: Sequence[str] = tuple(PROFILES),
+              sample_paths: Optional[Sequence[str]] = None,
+              sample_bytes: int = 64 * 1024 * 1024,
+              sample_files: int = 1000,
+              cache_path=PROFILES_CACHE_PATH,
+              ttl: float = PROFILES_TTL,
+              refresh: bool = False,
+              warmup: bool = True,
+              runner: Callable[[Command], RunResult] = run_command,
+) -> TuneResult:
+    """Pick the fastest profile for a command by trial transfers.
+
+    A sample of the source, the first files found up to the given
+    limits or the explicit `sample_paths` for remote sources, is
+    copied into an empty scratch directory next to the destination
+    with each profile. The scratch directory is emptied between trials
+    and removed afterwards, also when a trial raises.
+
+    With `warmup` an untimed transfer of the sample runs first, so the
+    first profile doesn't alone pay for reading the source cold.
+
+    """
+
+    key = endpoint_pair_key(command)
+
+    if cache_path is not None:
+        cache_path = Path(cache_path).expanduser()
+        cache = load_cache(cache_path)
+
+        entry = cache.get(key)
+        if (entry is not None and
+            not refresh and
+            time.time() - entry['tuned'] < ttl and
+            entry['profile'] in profiles):
+
+            return TuneResult(profile=entry['profile'],
+                              timings=entry['timings'],
+                              cached=True)
+
+    if sample_paths is None:
+        if command.src.url.host:
+            raise ValueError("Sample paths must be given for remote sources")
+
+        sample_paths = _sample(command.src.path, sample_bytes, sample_files)
+
+    scratch = dc.replace(command.dest,
+                         url=command.dest.url.sibling(
+                             command.dest.url.path[-1] + '.py_rsync_trial'))
+
+    with tempfile.TemporaryDirectory(prefix='py_rsync_tune_') as tmp_dir:
+
+        files_from = os.path.join(tmp_dir, 'sample.txt')
+        with open(files_from, 'w') as wf:
+            for rel_path in sample_paths:
+                wf.write(rel_path + '\n')
+
+        empty_dir = os.path.join(tmp_dir, 'empty')
+        os.mkdir(empty_dir)
+
+        # syncing an empty directory with delete clears the scratch
+        # directory on either kind of endpoint
+        clear = Command(src=Endpoint.construct(path=empty_dir),
+                        dest=scratch,
+                        options=extend_options(None,
+                                               flags=('recursive', 'delete')))
+
+        def trial(name):
+            return Command(src=command.src,
+                           dest=scratch,
+                           options=extend_options(
+                               apply_profile(command.options, name),
+                               kv={'files-from' : files_from}))
+
+        # the same sync into the destination's parent, limited to the
+        # scratch directory, removes it
+        scratch_name = FILTER_ESCAPE_RE.sub(r'\\\1', scratch.url.path[-1])
+        remove = Command(src=clear.src,
+                         dest=dc.replace(scratch, url=scratch.url.sibling('')),
+                         options=Options(flags=('recursive', 'delete'),
+                                         includes=(f'/{scratch_name}/***',),
+                                         excludes=('*',),
+                                         info=None,
+                                         kv=None))
+
+        timings = {}
+        try:
+            if warmup and profiles:
+                runner(clear)
+                runner(trial(profiles[0]))
+
+            for name in profiles:
+
+                runner(clear)
+
+                start = time.perf_counter()
+                result = runner(trial(name))
+                elapsed = time.perf_counter() - start
+
+                if result.returncode == 0:
+                    timings[name] = elapsed
+
+        finally:
+            runner(remove)
+
+    if not timings:
+        raise RuntimeError("No trial transfer succeeded")
+
+    profile = min(timings, key=timings.get)
+
+    if cache_path is not None:
+        cache[key] = {
+            'profile' : profile,
+            'timings' : timings,
+            'tuned' : time.time(),
+        }
+        save_cache(cache_path, cache)
+
+    return TuneResult(profile=profile, timings=timings)
@@ -0,0 +1,226 @@
+"""Distribute one dataset to many destinations through a relay tree.
+
+Rather than the source sending to every destination itself, each
+destination that has received a complete copy becomes a source for
+the next tier. With a fan-out of `k` the number of copies grows by a
+factor of `k + 1` per tier so hundreds of hosts are reached in a
+handful of tiers while the source uplink only serves the first.
+
+Transfers between two remote hosts are run on the sending host over
+the remote shell.
+
+"""
+
+import dataclasses as dc
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Optional,
+    List,
+    Tuple,
+    Sequence,
+    Mapping,
+    Set,
+)
+
+from .main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from .run import (
+    RunResult,
+    run_argv,
+)
+
+__all__ = [
+    'RelayTransfer',
+    'RelayTier',
+    'RelayResult',
+    'plan_relay_tier',
+    'relay_argv',
+    'distribute',
+]
+
+
+@dc.dataclass
+class RelayTransfer():
+    """A single copy from a holder to a new destination."""
+
+    src: Endpoint
+    dest: Endpoint
+    result: Optional[RunResult] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.result is not None and self.result.returncode == 0
+
+
+@dc.dataclass
+class RelayTier():
+    """The transfers run concurrently in one tier and how long it took."""
+
+    index: int
+    transfers: List[RelayTransfer]
+    duration: Optional[float] = None
+
+
+@dc.dataclass
+class RelayResult():
+    """The outcome of a distribution."""
+
+    tiers: List[RelayTier]
+    unreached: List[Endpoint]
+
+    @property
+    def ok(self) -> bool:
+        return len(self.unreached) == 0
+
+    @property
+    def tier_durations(self) -> List[float]:
+        return [tier.duration for tier in self.tiers]
+
+
+def plan_relay_tier(holders: Sequence[Endpoint],
+                    pending: Sequence[Endpoint],
+                    fanout: int = 2,
+                    failed: Optional[Mapping[str, Set[str]]] = None,
+) -> List[Tuple[Endpoint, Endpoint]]:
+    """Assign pending destinations to holders for the next tier.
+
+    Each holder sends to at most `fanout` destinations. Destinations
+    are handed out round-robin so holders share the work evenly.
+    `failed` maps the URL text of destinations to the URL texts of
+    holders whose transfer to them failed, which are only given the
+    destination again when no other holder has room left.
+
+    """
+
+    if fanout < 1:
+        raise ValueError("Fan-out must be at least 1")
+
+    failed = failed or {}
+    loads = [0] * len(holders)
+
+    pairs = []
+    for dest in pending:
+
+        # the least loaded first, in order, is round-robin
+        free = sorted((load, i) for i, load in enumerate(loads) if load < fanout)
+        if not free:
+            break
+
+        tried = failed.get(dest.url.to_text(), set())
+        untried = [i for _, i in free
+                   if holders[i].url.to_text() not in tried]
+        i = untried[0] if untried else free[0][1]
+
+        loads[i] += 1
+        pairs.append((holders[i], dest))
+
+    return pairs
+
+
+def _local_view(endpoint: Endpoint) -> Endpoint:
+    return Endpoint.construct(path=endpoint.path)
+
+
+def relay_argv(src: Endpoint,
+               dest: Endpoint,
+               options: Optional[Options] = None,
+               rsh: str = 'ssh',
+) -> List[str]:
+    """Build the arguments for copying between a holder and destination.
+
+    When the holder is remote the command is run on it over the
+    remote shell so the data flows directly between the two hosts,
+    unless the destination is local, which pulls from the holder.
+
+    """
+
+    if not src.url.host or not dest.url.host:
+        return Command(src=src, dest=dest, options=options).render_argv()
+
+    # seen from the holder, endpoints on the same host are local
+    if dest.url.host == src.url.host:
+        dest = _local_view(dest)
+
+    argv = Command(src=_local_view(src),
+                   dest=dest,
+                   options=options).render_argv()
+
+    userhost = src.url.host
+    if src.url.user:
+        userhost = f'{src.url.user}@{userhost}'
+
+    return (shlex.split(rsh) +
+            [userhost, ' '.join(shlex.quote(arg) for arg in argv)])
+
+
+def distribute(src: Endpoint,
+               destinations: Sequence[Endpoint],
+               options: Optional[Options] = None,
+               fanout: int = 2,
+               workers: Optional[int] = None,
+               rsh: str = 'ssh',
+               instrument=None,
+) -> RelayResult:
+    """Copy src to all destinations tier by tier through a relay tree.
+
+    The source only sends in the first tier, after which the reached
+    destinations are the holders. A destination whose transfer fails
+    is retried in the next tier, from another holder unless none has
+    room, and distribution stops when a tier makes no progress.
+
+    """
+
+    holders = [src]
+    pending = list(destinations)
+    failed = {}
+    tiers = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending:
+
+            tier = RelayTier(index=len(tiers),
+                             transfers=[RelayTransfer(src=holder, dest=dest)
+                                        for holder, dest
+                                        in plan_relay_tier(holders,
+                                                           pending,
+                                                           fanout=fanout,
+                                                           failed=failed)])
+
+            def transfer(relay_transfer):
+                relay_transfer.result = run_argv(
+                    relay_argv(relay_transfer.src,
+                               relay_transfer.dest,
+                               options=options,
+                               rsh=rsh),
+                    instrument=instrument)
+
+            start = time.perf_counter()
+            list(pool.map(transfer, tier.transfers))
+            tier.duration = time.perf_counter() - start
+
+            tiers.append(tier)
+
+            reached = []
+            for relay_transfer in tier.transfers:
+                if relay_transfer.ok:
+                    reached.append(relay_transfer.dest)
+                else:
+                    failed.setdefault(relay_transfer.dest.url.to_text(), set())\
+                          .add(relay_transfer.src.url.to_text())
+
+            if not reached:
+                break
+
+            # the source uplink only serves the first tier
+            if len(tiers) == 1:
+                holders = []
+
+            holders.extend(reached)
+            pending = [dest for dest in pending if dest not in reached]
+
+    return RelayResult(tiers=tiers, unreached=pending)
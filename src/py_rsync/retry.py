@@ -0,0 +1,305 @@
+"""Re-running only the files that failed in a transfer.
+
+Exit codes 23 and 24 mean some files could not be transferred or
+vanished while rsync ran. Instead of running the whole command again
+the per-file errors are parsed from standard error, paths made
+relative to the source and checked against the itemized output, and a
+retry transfers just those paths with `--files-from`, until they all
+went through or the retry budget is used up.
+
+Errors which don't name a single path below the transfer roots, like
+a failure to read the source root, can't be narrowed down and stop the
+retries.
+
+"""
+
+import dataclasses as dc
+import os
+import re
+import tempfile
+from typing import (
+    Optional,
+    List,
+    Set,
+    Tuple,
+    Iterable,
+    Generator,
+)
+
+from .main import (
+    Command,
+    extend_options,
+)
+from .capture import OutputCapture
+from .run import (
+    ITEMIZE_RE,
+    RunResult,
+    run_command,
+)
+
+__all__ = [
+    'RETRY_EXIT_CODES',
+    'FailedFiles',
+    'FailureCollector',
+    'collect_failures',
+    'retry_command',
+    'RetryResult',
+    'run_with_retries',
+]
+
+
+RETRY_EXIT_CODES = (
+    23, # partial transfer due to error
+    24, # partial transfer due to vanished source files
+)
+"""Exit codes after which only the failed files need to be retried."""
+
+# e.g. rsync: [sender] send_files failed to open "/src/a": Permission denied (13)
+FILE_ERROR_RE = re.compile(r'^rsync: (?:\[(?P<role>[a-z]+)\] )?'
+                           r'(?P<op>[^"]*)"(?P<path>[^"]+)"(?P<rest>.*)$')
+
+VANISHED_RE = re.compile(r'^file has vanished: "(?P<path>[^"]+)"')
+
+# relative paths of files whose checksum didn't match after transfer
+VERIFICATION_RE = re.compile(r'^(?:WARNING|ERROR): (?P<path>.+) failed verification')
+
+# the temporary files the receiver writes before renaming them
+TEMP_NAME_RE = re.compile(r'^\.(?P<name>.+)\.[A-Za-z0-9]{6}$')
+
+
+@dc.dataclass
+class FailedFiles():
+    """The paths, relative to the source, which didn't make it."""
+
+    failed: Set[str] = dc.field(default_factory=set)
+    vanished: Set[str] = dc.field(default_factory=set)
+    # error lines which couldn't be narrowed to a path
+    unresolved: List[str] = dc.field(default_factory=list)
+    # (path, error line) of every failure
+    errors: List[Tuple[str, str]] = dc.field(default_factory=list)
+
+
+class FailureCollector():
+    """Line parsers collecting the failed files of a run.
+
+    Add them to an `OutputCapture` with `attach` to collect while the
+    run streams its output, or feed lines afterwards.
+
+    """
+
+    def __init__(self, command: Command):
+
+        self.src_root = command.src.path.rstrip('/') + '/'
+        self.dest_root = command.dest.path.rstrip('/') + '/'
+
+        self.failures = FailedFiles()
+
+        # paths rsync set out to update, from the itemized output
+        self.itemized: Set[str] = set()
+
+        # path taken from a temporary file name -> path as written
+        self._temp_names = {}
+
+    def attach(self, capture: OutputCapture) -> None:
+
+        capture.add_parser('stdout', self.stdout_line)
+        capture.add_parser('stderr', self.stderr_line)
+
+    def _relative(self, path: str) -> Optional[str]:
+
+        if path.startswith(self.src_root):
+            return path[len(self.src_root):] or None
+
+        if path.startswith(self.dest_root):
+            rel_path = path[len(self.dest_root):]
+
+            dirname, name = os.path.split(rel_path)
+            match = TEMP_NAME_RE.match(name)
+            if match is not None:
+                stripped = os.path.join(dirname, match.group('name'))
+                self._temp_names[stripped] = rel_path
+                rel_path = stripped
+
+            return rel_path or None
+
+        # receiver messages can be relative to the destination
+        if not path.startswith('/') and path not in ('.', './'):
+            return path
+
+        return None
+
+    def stdout_line(self, line: str) -> None:
+
+        match = ITEMIZE_RE.match(line)
+        if match is not None and match.group('changes') != '*deleting':
+            self.itemized.add(match.group('path').rstrip('/'))
+
+    def stderr_line(self, line: str) -> None:
+
+        match = VANISHED_RE.match(line)
+        if match is not None:
+            rel_path = self._relative(match.group('path'))
+            if rel_path is None:
+                self.failures.unresolved.append(line)
+            else:
+                self.failures.vanished.add(rel_path)
+                self.failures.errors.append((rel_path, line))
+            return
+
+        match = VERIFICATION_RE.match(line)
+        if match is None:
+            match = FILE_ERROR_RE.match(line)
+
+        if match is None:
+            return
+
+        rel_path = self._relative(match.group('path'))
+        if rel_path is None:
+            self.failures.unresolved.append(line)
+        else:
+            self.failures.failed.add(rel_path)
+            self.failures.errors.append((rel_path, line))
+
+    def result(self) -> FailedFiles:
+        """The failures, with temporary file names resolved.
+
+        A destination name like '.name.XXXXXX' is taken as the
+        temporary file of 'name', unless the itemized output shows it
+        is a real file of that name which was transferred.
+
+        """
+
+        failed = set()
+        for rel_path in self.failures.failed:
+            raw_path = self._temp_names.get(rel_path)
+            if (raw_path is not None and
+                raw_path in self.itemized and
+                rel_path not in self.itemized):
+                rel_path = raw_path
+
+            failed.add(rel_path)
+
+        return dc.replace(self.failures, failed=failed)
+
+
+def _lines(text: str, path: Optional[str]) -> Generator[str, None, None]:
+
+    # read spilled output back from disk rather than the kept tail
+    if path is not None:
+        with open(path, errors='replace') as rf:
+            for line in rf:
+                yield line.rstrip('\n')
+    else:
+        yield from text.splitlines()
+
+
+def collect_failures(command: Command, result: RunResult) -> FailedFiles:
+    """Collect the failed files from the output of a finished run."""
+
+    collector = FailureCollector(command)
+
+    for line in _lines(result.stdout, result.stdout_path):
+        collector.stdout_line(line)
+
+    for line in _lines(result.stderr, result.stderr_path):
+        collector.stderr_line(line)
+
+    return collector.result()
+
+
+def retry_command(command: Command,
+                  paths: Iterable[str],
+                  files_from: str,
+) -> Command:
+    """Build the command transferring just the given paths.
+
+    The paths replace any `--files-from` list of the command. As
+    failed paths can be directories, which `--files-from` doesn't
+    recurse into by default, the retry is recursive.
+
+    """
+
+    with open(files_from, 'w') as wf:
+        for rel_path in sorted(paths):
+            wf.write(rel_path + '\n')
+
+    return dc.replace(command,
+                      options=extend_options(command.options,
+                                             flags=('recursive',),
+                                             kv={'files-from' : files_from}))
+
+
+@dc.dataclass
+class RetryResult():
+    """The first run and the retries following it."""
+
+    runs: List[RunResult]
+    failures: List[FailedFiles]
+
+    @property
+    def returncode(self) -> int:
+        return self.runs[-1].returncode
+
+    @property
+    def remaining(self) -> Set[str]:
+        """The paths still failed after the last run."""
+
+        return self.failures[-1].failed
+
+
+def run_with_retries(command: Command,
+                     retries: int = 3,
+                     retry_vanished: bool = False,
+                     files_from_dir: Optional[str] = None,
+                     executable: Optional[str] = None,
+                     instrument=None,
+                     job_id: Optional[str] = None,
+) -> RetryResult:
+    """Run a command and retry only its failed files up to `retries` times.
+
+    Retries happen only for the exit codes in `RETRY_EXIT_CODES` and
+    when every error could be narrowed to a path. Vanished files are
+    gone from the source and not retried unless `retry_vanished`.
+
+    """
+
+    if files_from_dir is None:
+        files_from_dir = tempfile.mkdtemp(prefix='py_rsync_retry_')
+
+    runs = []
+    failures = []
+    current = command
+    for attempt in range(retries + 1):
+
+        collector = FailureCollector(command)
+        capture = OutputCapture()
+        collector.attach(capture)
+
+        result = run_command(current,
+                             instrument=instrument,
+                             job_id=job_id and f"{job_id}.{attempt}",
+                             executable=executable,
+                             capture=capture)
+
+        failed = collector.result()
+        runs.append(result)
+        failures.append(failed)
+
+        if (result.returncode not in RETRY_EXIT_CODES or
+            failed.unresolved or
+            attempt == retries):
+            break
+
+        paths = set(failed.failed)
+        if retry_vanished:
+            paths |= failed.vanished
+
+        if not paths:
+            break
+
+        current = retry_command(
+            command,
+            paths,
+            os.path.join(files_from_dir, f'retry_{attempt + 1}.txt'))
+
+    return RetryResult(runs=runs, failures=failures)
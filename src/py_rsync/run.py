@@ -0,0 +1,275 @@
+"""Executing rendered commands and reading back their results."""
+
+import dataclasses as dc
+import re
+import subprocess
+import time
+from typing import (
+    Optional,
+    List,
+    Tuple,
+)
+
+from .main import Command
+from .instrument import NULL_INSTRUMENT
+from .capture import OutputCapture
+
+__all__ = [
+    'TransferStats',
+    'RunResult',
+    'parse_size',
+    'human_readable_unit',
+    'parse_stats',
+    'parse_itemized',
+    'run_command',
+    'run_argv',
+]
+
+
+STATS_FIELDS = (
+    # stats line label, field name, type
+    ('Number of files', 'files_total', int),
+    ('Number of created files', 'files_created', int),
+    ('Number of deleted files', 'files_deleted', int),
+    ('Number of regular files transferred', 'files_transferred', int),
+    ('Total file size', 'total_size', int),
+    ('Total transferred file size', 'transferred_size', int),
+    ('Literal data', 'literal_data', int),
+    ('Matched data', 'matched_data', int),
+    ('File list size', 'file_list_size', int),
+    ('File list generation time', 'file_list_generation_time', float),
+    ('File list transfer time', 'file_list_transfer_time', float),
+    ('Total bytes sent', 'bytes_sent', int),
+    ('Total bytes received', 'bytes_received', int),
+)
+"""The lines of the `--stats` output which are parsed."""
+
+SIZE_SUFFIXES = 'KMGTP'
+
+ITEMIZE_RE = re.compile(r'^(?P<changes>[<>ch.*][fdLDS][^ ]{9}|\*deleting) +(?P<path>.+)$')
+
+SHORT_FLAGS_RE = re.compile(r'^-[A-Za-z]+$')
+
+STATS_LINE_RE = re.compile(r'^(?P<label>[A-Za-z ]+): (?P<value>[0-9.,]+[KMGTP]?)')
+
+
+@dc.dataclass
+class TransferStats():
+    """Values parsed from rsync's `--stats` output."""
+
+    files_total: Optional[int] = None
+    files_created: Optional[int] = None
+    files_deleted: Optional[int] = None
+    files_transferred: Optional[int] = None
+    total_size: Optional[int] = None
+    transferred_size: Optional[int] = None
+    literal_data: Optional[int] = None
+    matched_data: Optional[int] = None
+    file_list_size: Optional[int] = None
+    file_list_generation_time: Optional[float] = None
+    file_list_transfer_time: Optional[float] = None
+    bytes_sent: Optional[int] = None
+    bytes_received: Optional[int] = None
+
+
+@dc.dataclass
+class RunResult():
+    """The outcome of running a command."""
+
+    argv: List[str]
+    returncode: int
+    stdout: str
+    stderr: str
+    stats: TransferStats
+    duration: float
+    # when the output was too large to keep it was spilled to these
+    # files, and stdout and stderr only hold the most recent part
+    stdout_path: Optional[str] = None
+    stderr_path: Optional[str] = None
+
+
+def parse_size(value: str, unit: int = 1000) -> int:
+    """Parse a possibly human-readable number from rsync output.
+
+    Handles plain digits, thousands separators and the unit suffixes
+    of `--human-readable`. Suffixed values are only as precise as
+    rsync printed them.
+
+    """
+
+    value = value.replace(',', '')
+
+    if value and value[-1] in SIZE_SUFFIXES:
+        power = SIZE_SUFFIXES.index(value[-1]) + 1
+        return int(float(value[:-1]) * unit**power)
+
+    return int(float(value))
+
+
+def human_readable_unit(argv: List[str]) -> int:
+    """The unit of the sizes rsync prints for an argument list.
+
+    Each '--human-readable' (or '-h') raises rsync's level by one from
+    the default of plain digits. Once given sizes are in powers of
+    1000, more than once in powers of 1024.
+
+    """
+
+    level = 0
+    for arg in argv[1:]:
+        if arg == '--human-readable':
+            level += 1
+        elif arg in ('--no-human-readable', '--no-h'):
+            level = 0
+        elif SHORT_FLAGS_RE.match(arg):
+            level += arg.count('h')
+
+    return 1024 if level >= 2 else 1000
+
+
+def parse_stats(output: str, unit: int = 1000) -> TransferStats:
+    """Parse the `--stats` section of rsync's standard output."""
+
+    fields = {label : (name, type_) for label, name, type_ in STATS_FIELDS}
+
+    stats = TransferStats()
+    for line in output.splitlines():
+
+        match = STATS_LINE_RE.match(line)
+        if match is None or match.group('label') not in fields:
+            continue
+
+        name, type_ = fields[match.group('label')]
+        if type_ is float:
+            value = float(match.group('value').replace(',', ''))
+        else:
+            value = parse_size(match.group('value'), unit=unit)
+
+        setattr(stats, name, value)
+
+    return stats
+
+
+def parse_itemized(output: str) -> List[Tuple[str, str]]:
+    """Get the (changes, path) pairs from `--itemize-changes` output."""
+
+    items = []
+    for line in output.splitlines():
+
+        match = ITEMIZE_RE.match(line)
+        if match is not None:
+            items.append((match.group('changes'), match.group('path')))
+
+    return items
+
+
+def run_command(command: Command,
+                instrument=None,
+                job_id: Optional[str] = None,
+                executable: Optional[str] = None,
+                capture: Optional[OutputCapture] = None,
+) -> RunResult:
+    """Run the command to completion and collect its output and stats.
+
+    When an `Instrument` is given the phases of the run and its
+    results are recorded under `job_id`. The output is read with a
+    fresh `OutputCapture` unless one, e.g. with line parsers
+    registered, is given.
+
+    """
+
+    recorder = (instrument or NULL_INSTRUMENT).job(job_id)
+
+    with recorder.phase('render'):
+        argv = command.render_argv()
+
+    if executable is not None:
+        argv[0] = executable
+
+    return _execute(argv, recorder, capture=capture)
+
+
+def run_argv(argv: List[str],
+             stdin_path: Optional[str] = None,
+             instrument=None,
+             job_id: Optional[str] = None,
+             capture: Optional[OutputCapture] = None,
+) -> RunResult:
+    """Run an already built rsync argument list like `run_command`.
+
+    This is for invocations the command template can't express, like
+    reading a batch. When `stdin_path` is given the file is fed to the
+    process on standard input.
+
+    """
+
+    recorder = (instrument or NULL_INSTRUMENT).job(job_id)
+
+    return _execute(list(argv), recorder,
+                    stdin_path=stdin_path,
+                    capture=capture)
+
+
+def _execute(argv: List[str],
+             recorder,
+             stdin_path: Optional[str] = None,
+             capture: Optional[OutputCapture] = None,
+) -> RunResult:
+
+    if capture is None:
+        capture = OutputCapture()
+
+    start = time.perf_counter()
+
+    stdin = open(stdin_path, 'rb') if stdin_path is not None else None
+    try:
+        with recorder.phase('startup'):
+            proc = subprocess.Popen(argv,
+                                    stdin=stdin,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+
+        run_start = time.perf_counter()
+        capture.run(proc)
+        run_time = time.perf_counter() - run_start
+
+    finally:
+        if stdin is not None:
+            stdin.close()
+
+    with recorder.phase('teardown'):
+        stdout = capture.stdout.text()
+        if stdout is None:
+            stdout = capture.stdout.tail()
+
+        stderr = capture.stderr.text()
+        if stderr is None:
+            stderr = capture.stderr.tail()
+
+        # the stats are at the very end of the output
+        stats = parse_stats(capture.stdout.tail(),
+                            unit=human_readable_unit(argv))
+
+    duration = time.perf_counter() - start
+
+    if recorder.enabled:
+
+        file_list_time = stats.file_list_generation_time or 0.0
+        recorder.add_phase('file_list', file_list_time)
+        recorder.add_phase('transfer', max(run_time - file_list_time, 0.0))
+
+        recorder.record(exit_code=proc.returncode,
+                        bytes_sent=stats.bytes_sent,
+                        bytes_received=stats.bytes_received,
+                        files_total=stats.files_total,
+                        files_transferred=stats.files_transferred)
+        recorder.finish()
+
+    return RunResult(argv=argv,
+                     returncode=proc.returncode,
+                     stdout=stdout,
+                     stderr=stderr,
+                     stats=stats,
+                     duration=duration,
+                     stdout_path=capture.stdout.spill_path,
+                     stderr_path=capture.stderr.spill_path)
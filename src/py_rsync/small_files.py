@@ -0,0 +1,312 @@
+"""Tar stream transfer mode for trees of many small files.
+
+rsync spends a roughly fixed amount of work per file, so trees of
+millions of tiny files move at a few thousand files a second whatever
+the bandwidth. Here the files under a size threshold of a local source
+are packed into a few parallel tar streams, piped straight into a tar
+extracting on the destination (over the remote shell when remote). The
+large files still go through rsync with a `--files-from` list, and a
+final rsync pass over the whole tree fixes anything tar didn't carry
+over, like empty directories, and confirms the result.
+
+"""
+
+import concurrent.futures as cf
+import dataclasses as dc
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from typing import (
+    Optional,
+    List,
+)
+
+from .main import (
+    Endpoint,
+    Command,
+    extend_options,
+)
+from .manifest import (
+    scan_local,
+    shard_manifest,
+)
+from .columnar import ColumnarManifest
+from .capture import (
+    RingBuffer,
+    drain_pipe,
+)
+from .local_copy import FilterRules
+from .run import (
+    RunResult,
+    run_command,
+)
+
+__all__ = [
+    'SMALL_FILE_THRESHOLD',
+    'SMALL_FILE_UNSUPPORTED_FLAGS',
+    'SmallFilePlan',
+    'plan_small_files',
+    'tar_create_argv',
+    'tar_extract_argv',
+    'SmallFileResult',
+    'sync_small_files',
+]
+
+
+SMALL_FILE_THRESHOLD = 64 * 1024
+"""Files below this many bytes are sent in tar streams."""
+
+SMALL_FILE_UNSUPPORTED_FLAGS = (
+    'dry-run',
+    'update',
+    'ignore-existing',
+    'existing',
+    'backup',
+    'append',
+)
+"""Flags whose skipping or keeping of destination files tar can't honour."""
+
+
+@dc.dataclass
+class SmallFilePlan():
+    """Tar streams for the small files and rsync jobs for the rest."""
+
+    # the paths of each tar stream, relative to the source
+    streams: List[List[str]]
+    stream_lists: List[str]
+    small_bytes: int
+    large: Optional[Command]
+    verify: Command
+
+    @property
+    def small_count(self) -> int:
+        return sum(len(stream) for stream in self.streams)
+
+
+def plan_small_files(command: Command,
+                     threshold: int = SMALL_FILE_THRESHOLD,
+                     n_streams: int = 4,
+                     files_from_dir: Optional[str] = None,
+                     manifest: Optional[ColumnarManifest] = None,
+) -> SmallFilePlan:
+    """Split a local source into tar streams of small files and a large job.
+
+    Small files and symlinks are balanced by size over `n_streams`
+    streams, whose NUL separated lists are written for `tar -T`. The
+    large files get a rsync job with a `--files-from` list, `None` if
+    there are none. The source is scanned unless a columnar manifest
+    of it is given. Entries are filtered with the command's includes
+    and excludes like the local engine does.
+
+    tar overwrites whatever is at the destination, so commands with
+    any of the `SMALL_FILE_UNSUPPORTED_FLAGS`, or their own
+    `--files-from` list, raise a `ValueError`.
+
+    """
+
+    if command.src.url.host:
+        raise ValueError("Small file mode requires a local source")
+
+    options = command.options
+    unsupported = [flag for flag in (options and options.flags) or ()
+                   if flag in SMALL_FILE_UNSUPPORTED_FLAGS]
+    if options and options.kv and 'files-from' in options.kv:
+        unsupported.append('files-from')
+
+    if unsupported:
+        raise ValueError(
+            f"Options not supported by the small file mode: {', '.join(unsupported)}")
+
+    rules = FilterRules(options and options.includes,
+                        options and options.excludes)
+
+    if files_from_dir is None:
+        files_from_dir = tempfile.mkdtemp(prefix='py_rsync_small_')
+
+    entries = scan_local(command.src.path) if manifest is None else manifest
+
+    small = []
+    small_bytes = 0
+    large_list = os.path.join(files_from_dir, 'large.txt')
+    n_large = 0
+    with open(large_list, 'w') as wf:
+        for entry in entries:
+
+            if not rules.included_path(entry.path, is_dir=entry.kind == 'd'):
+                continue
+
+            if entry.kind == 'f' and entry.size >= threshold:
+                wf.write(entry.path + '\n')
+                n_large += 1
+
+            elif entry.kind in ('f', 'l'):
+                small.append(entry)
+                if entry.kind == 'f':
+                    small_bytes += entry.size
+
+    streams = [stream for stream in shard_manifest(small, n_streams) if stream]
+
+    stream_lists = []
+    for i, stream in enumerate(streams):
+        stream_list = os.path.join(files_from_dir, f'stream_{i}.list')
+        with open(stream_list, 'w') as wf:
+            for rel_path in stream:
+                wf.write(rel_path + '\0')
+
+        stream_lists.append(stream_list)
+
+    large = None
+    if n_large:
+        large = dc.replace(command,
+                           options=extend_options(command.options,
+                                                  kv={'files-from' : large_list}))
+
+    return SmallFilePlan(streams=streams,
+                         stream_lists=stream_lists,
+                         small_bytes=small_bytes,
+                         large=large,
+                         verify=command)
+
+
+def tar_create_argv(src_dir: str, stream_list: str) -> List[str]:
+    """The tar writing the files of a stream list to standard output."""
+
+    # the pax format keeps sub-second modification times, which the
+    # final rsync pass would otherwise see as changes
+    return ['tar',
+            '-C', src_dir,
+            '--format=posix',
+            '--null',
+            '--no-recursion',
+            '-T', stream_list,
+            '-cf', '-']
+
+
+def tar_extract_argv(dest: Endpoint,
+                     target_dir: str,
+                     rsh: str = 'ssh',
+) -> List[str]:
+    """The tar extracting a stream from standard input at the destination."""
+
+    if not dest.url.host:
+        return ['tar', '-C', target_dir, '-xpf', '-']
+
+    userhost = dest.url.host
+    if dest.url.user:
+        userhost = f"{dest.url.user}@{userhost}"
+
+    target = shlex.quote(target_dir)
+    return shlex.split(rsh) + [userhost,
+                               f"mkdir -p {target} && tar -C {target} -xpf -"]
+
+
+def _pipe(create_argv: List[str], extract_argv: List[str]) -> None:
+
+    create = subprocess.Popen(create_argv,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+
+    # tar warns on standard error about e.g. unreadable files or files
+    # changing as they're read, so it's drained while the extraction
+    # consumes the stream, else tar blocks on it and stops writing
+    create_err = RingBuffer()
+    drainer = threading.Thread(target=drain_pipe,
+                               args=(create.stderr, create_err),
+                               daemon=True)
+    drainer.start()
+
+    try:
+        extract = subprocess.run(extract_argv,
+                                 stdin=create.stdout,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+    finally:
+        create.stdout.close()
+        create.wait()
+        drainer.join()
+
+    if create.returncode != 0:
+        raise RuntimeError(
+            "tar stream creation failed: "
+            f"{create_err.getvalue().decode(errors='replace').strip()}")
+
+    if extract.returncode != 0:
+        raise RuntimeError(
+            f"tar stream extraction failed: {extract.stderr.decode().strip()}")
+
+
+@dc.dataclass
+class SmallFileResult():
+    """The outcome of a small file mode transfer."""
+
+    plan: SmallFilePlan
+    tar_duration: float
+    large: Optional[RunResult]
+    verify: RunResult
+
+    @property
+    def returncode(self) -> int:
+        return self.verify.returncode
+
+
+def sync_small_files(command: Command,
+                     threshold: int = SMALL_FILE_THRESHOLD,
+                     n_streams: int = 4,
+                     rsh: str = 'ssh',
+                     executable: Optional[str] = None,
+                     instrument=None,
+                     job_id: Optional[str] = None,
+                     plan: Optional[SmallFilePlan] = None,
+) -> SmallFileResult:
+    """Transfer a tree with its small files in tar streams.
+
+    The tar streams run in parallel, then the large file job and the
+    final pass over the whole command run with rsync. A failed tar
+    stream raises a `RuntimeError` before rsync is started.
+
+    """
+
+    if plan is None:
+        plan = plan_small_files(command,
+                                threshold=threshold,
+                                n_streams=n_streams)
+
+    # the source is always rendered with a trailing slash, so its
+    # contents go straight into the destination
+    target_dir = command.dest.path
+    if not command.dest.url.host:
+        os.makedirs(target_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    if plan.stream_lists:
+        with cf.ThreadPoolExecutor(max_workers=len(plan.stream_lists)) as pool:
+            futures = [
+                pool.submit(_pipe,
+                            tar_create_argv(command.src.path, stream_list),
+                            tar_extract_argv(command.dest, target_dir, rsh=rsh))
+                for stream_list in plan.stream_lists]
+
+            for future in futures:
+                future.result()
+
+    tar_duration = time.perf_counter() - start
+
+    large = None
+    if plan.large is not None:
+        large = run_command(plan.large,
+                            instrument=instrument,
+                            job_id=job_id and f"{job_id}.large",
+                            executable=executable)
+
+    verify = run_command(plan.verify,
+                         instrument=instrument,
+                         job_id=job_id and f"{job_id}.verify",
+                         executable=executable)
+
+    return SmallFileResult(plan=plan,
+                           tar_duration=tar_duration,
+                           large=large,
+                           verify=verify)
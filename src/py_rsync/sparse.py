@@ -0,0 +1,192 @@
+"""Transfer mode for sparse files such as VM disk images.
+
+Without `--sparse` the holes of a sparse file are written out as
+zeros on the destination, inflating it and moving gigabytes of
+nothing. Here sparse files of a local source are found with
+`SEEK_DATA`/`SEEK_HOLE` and split out of the main job: files new on
+the destination are sent with `--sparse` and files that already exist
+are updated with `--inplace`, which only writes the changed blocks and
+so keeps the destination's holes.
+
+"""
+
+import dataclasses as dc
+import os
+import tempfile
+from typing import (
+    Optional,
+    List,
+    Iterable,
+)
+
+from .main import (
+    Command,
+    extend_options,
+    protect_paths,
+)
+from .manifest import (
+    ManifestEntry,
+    scan_local,
+    existing_paths,
+)
+from .local_copy import FilterRules
+
+__all__ = [
+    'SparseInfo',
+    'sparse_info',
+    'SparsePlan',
+    'plan_sparse',
+]
+
+
+@dc.dataclass
+class SparseInfo():
+    """How much of a file is data and how much is holes."""
+
+    path: str
+    size: int
+    data_bytes: int
+
+    @property
+    def hole_bytes(self) -> int:
+        return self.size - self.data_bytes
+
+    @property
+    def is_sparse(self) -> bool:
+        return self.hole_bytes > 0
+
+
+def sparse_info(path, rel_path: Optional[str] = None) -> SparseInfo:
+    """Measure the data extents of a file with `SEEK_DATA`/`SEEK_HOLE`.
+
+    Files whose allocated blocks cover their size can't have holes and
+    are not seeked. Filesystems without hole reporting show every file
+    as fully data.
+
+    """
+
+    st = os.stat(path)
+    size = st.st_size
+    rel_path = str(path) if rel_path is None else rel_path
+
+    if st.st_blocks * 512 >= size:
+        return SparseInfo(path=rel_path, size=size, data_bytes=size)
+
+    data_bytes = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        pos = 0
+        while pos < size:
+            try:
+                data_start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError:
+                # ENXIO, no more data after pos
+                break
+
+            data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+            data_bytes += data_end - data_start
+            pos = data_end
+
+    finally:
+        os.close(fd)
+
+    return SparseInfo(path=rel_path, size=size, data_bytes=data_bytes)
+
+
+@dc.dataclass
+class SparsePlan():
+    """The jobs for a tree with sparse files split out."""
+
+    rest: Command
+    sparse: Optional[Command]
+    inplace: Optional[Command]
+    files: List[SparseInfo]
+
+    @property
+    def hole_bytes(self) -> int:
+        """Bytes of holes that won't be sent as zeros."""
+
+        return sum(info.hole_bytes for info in self.files)
+
+
+def _job(command: Command,
+         paths: List[str],
+         flag: str,
+         files_from: str,
+) -> Optional[Command]:
+
+    if not paths:
+        return None
+
+    with open(files_from, 'w') as wf:
+        for rel_path in paths:
+            wf.write(rel_path + '\n')
+
+    return dc.replace(command,
+                      options=extend_options(command.options,
+                                             flags=(flag,),
+                                             kv={'files-from' : files_from}))
+
+
+def plan_sparse(command: Command,
+                dest_entries: Optional[Iterable[ManifestEntry]] = None,
+                min_hole_bytes: int = 1024 * 1024,
+                files_from_dir: Optional[str] = None,
+                rsh: str = 'ssh',
+) -> SparsePlan:
+    """Split the sparse files of a local source into their own jobs.
+
+    Only files the command's includes and excludes let through are
+    considered. Which of them already exist on the destination is read
+    from `dest_entries` if given, otherwise just their paths are
+    tested there (over the remote shell when remote, see
+    `existing_paths`). Files with fewer hole bytes than
+    `min_hole_bytes` stay in the main job. The main job leaves the
+    others out with hide and protect rules, so it doesn't delete them
+    even with '--delete-excluded'.
+
+    """
+
+    if command.src.url.host:
+        raise ValueError("Sparse planning requires a local source")
+
+    if files_from_dir is None:
+        files_from_dir = tempfile.mkdtemp(prefix='py_rsync_sparse_')
+
+    root = command.src.path
+    options = command.options
+    rules = FilterRules(options and options.includes,
+                        options and options.excludes)
+
+    files = []
+    for entry in scan_local(root):
+        if entry.kind != 'f' or not rules.included_path(entry.path):
+            continue
+
+        info = sparse_info(os.path.join(root, entry.path), rel_path=entry.path)
+        if info.hole_bytes >= min_hole_bytes:
+            files.append(info)
+
+    if not files:
+        return SparsePlan(rest=command, sparse=None, inplace=None, files=[])
+
+    paths = [info.path for info in files]
+    if dest_entries is None:
+        existing = existing_paths(command.dest, paths, rsh=rsh)
+    else:
+        existing = {entry.path for entry in dest_entries}
+
+    new_paths = sorted(path for path in paths if path not in existing)
+    old_paths = sorted(path for path in paths if path in existing)
+
+    rest_options = protect_paths(options,
+                                 paths,
+                                 os.path.join(files_from_dir, 'sparse.rules'))
+
+    return SparsePlan(
+        rest=dc.replace(command, options=rest_options),
+        sparse=_job(command, new_paths, 'sparse',
+                    os.path.join(files_from_dir, 'sparse.txt')),
+        inplace=_job(command, old_paths, 'inplace',
+                     os.path.join(files_from_dir, 'inplace.txt')),
+        files=files)
@@ -0,0 +1,350 @@
+"""Constant memory diffs of sorted tree manifests.
+
+Both manifests are streamed in the same order, by path components, and
+walked together like a merge join, so only the current entry of each
+side is held in memory no matter how large the trees are. Manifests
+which aren't already in that order, like remote `find` listings, are
+put in order with an external sort over temporary manifest files.
+
+The diff is turned into jobs for a command: the added and changed
+paths become its `--files-from` list and the deleted paths a list
+removed with `--delete-missing-args`.
+
+"""
+
+import dataclasses as dc
+import heapq
+import os
+import shutil
+import tempfile
+from typing import (
+    Optional,
+    Iterable,
+    Iterator,
+    Generator,
+    Tuple,
+)
+
+from .main import (
+    Command,
+    extend_options,
+)
+from .manifest import (
+    ManifestEntry,
+    write_manifest,
+    read_manifest,
+)
+
+__all__ = [
+    'DIFF_CHANGES',
+    'manifest_key',
+    'scan_local_sorted',
+    'sort_manifest',
+    'DiffEntry',
+    'diff_manifests',
+    'DiffPlan',
+    'plan_diff',
+]
+
+
+DIFF_CHANGES = (
+    'added',
+    'changed',
+    'deleted',
+)
+"""The kinds of differences between a source and destination tree."""
+
+SORT_CHUNK_SIZE = 1_000_000
+"""Entries sorted in memory at a time by `sort_manifest`."""
+
+
+def manifest_key(path: str) -> Tuple[str, ...]:
+    """The sort key of a manifest path.
+
+    Paths are ordered by their components so that a directory is
+    directly followed by everything under it, the order of a depth
+    first walk with each directory's names sorted.
+
+    """
+
+    return tuple(path.split('/'))
+
+
+def _entry_key(entry: ManifestEntry) -> Tuple[str, ...]:
+    return manifest_key(entry.path)
+
+
+def _kind(entry: os.DirEntry) -> str:
+
+    if entry.is_symlink():
+        return 'l'
+    elif entry.is_dir(follow_symlinks=False):
+        return 'd'
+    elif entry.is_file(follow_symlinks=False):
+        return 'f'
+    else:
+        return 'o'
+
+
+def scan_local_sorted(root) -> Generator[ManifestEntry, None, None]:
+    """Yield the entries under a local directory in `manifest_key` order.
+
+    Like `manifest.scan_local` but only one directory listing per
+    level of the current path is held at a time.
+
+    """
+
+    root = str(root)
+
+    def listing(rel_dir):
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        return iter(entries)
+
+    stack = [('', listing(''))]
+    while stack:
+        rel_dir, it = stack[-1]
+
+        entry = next(it, None)
+        if entry is None:
+            stack.pop()
+            continue
+
+        rel_path = os.path.join(rel_dir, entry.name)
+        st = entry.stat(follow_symlinks=False)
+        kind = _kind(entry)
+
+        yield ManifestEntry(path=rel_path,
+                            size=st.st_size,
+                            mtime=st.st_mtime,
+                            kind=kind)
+
+        if kind == 'd':
+            stack.append((rel_path, listing(rel_path)))
+
+
+def sort_manifest(entries: Iterable[ManifestEntry],
+                  chunk_size: int = SORT_CHUNK_SIZE,
+                  tmp_dir: Optional[str] = None,
+) -> Generator[ManifestEntry, None, None]:
+    """Stream entries in `manifest_key` order with an external sort.
+
+    Entries are sorted in chunks of `chunk_size`. When there is more
+    than one chunk each is written out as a manifest file and the
+    files are merged, the files being removed afterwards.
+
+    """
+
+    run_dir = None
+    runs = []
+    try:
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+
+            if len(chunk) >= chunk_size:
+                if run_dir is None:
+                    run_dir = tempfile.mkdtemp(prefix='py_rsync_sort_',
+                                               dir=tmp_dir)
+
+                chunk.sort(key=_entry_key)
+                run_path = os.path.join(run_dir, f'run_{len(runs)}.manifest')
+                write_manifest(run_path, chunk)
+                runs.append(run_path)
+                chunk = []
+
+        chunk.sort(key=_entry_key)
+
+        if not runs:
+            yield from chunk
+            return
+
+        yield from heapq.merge(*[read_manifest(run_path) for run_path in runs],
+                               chunk,
+                               key=_entry_key)
+
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+@dc.dataclass(frozen=True)
+class DiffEntry():
+    """A path which differs between the trees.
+
+    The entry is the source's, except for deletions where it is the
+    destination's.
+
+    """
+
+    change: str
+    entry: ManifestEntry
+
+
+def _check_order(entries: Iterable[ManifestEntry],
+                 side: str,
+) -> Iterator[ManifestEntry]:
+
+    last = None
+    for entry in entries:
+        key = _entry_key(entry)
+        if last is not None and key <= last:
+            raise ValueError(
+                f"The {side} manifest is not sorted at '{entry.path}', "
+                "see sort_manifest")
+
+        last = key
+        yield entry
+
+
+def _differs(src: ManifestEntry,
+             dest: ManifestEntry,
+             modify_window: float,
+) -> bool:
+
+    if src.kind != dest.kind:
+        return True
+
+    # the size and time of directories say nothing about their contents
+    if src.kind == 'd':
+        return False
+
+    return (src.size != dest.size or
+            abs(src.mtime - dest.mtime) > modify_window)
+
+
+def diff_manifests(src_entries: Iterable[ManifestEntry],
+                   dest_entries: Iterable[ManifestEntry],
+                   modify_window: float = 0.0,
+) -> Generator[DiffEntry, None, None]:
+    """Merge join two sorted manifests into a stream of differences.
+
+    Entries are compared by kind, size and modification time like
+    rsync's quick check, with times within `modify_window` seconds
+    counting as equal (use 1 against listings with second resolution).
+    A `ValueError` is raised when either side is out of order.
+
+    """
+
+    src_it = _check_order(src_entries, 'source')
+    dest_it = _check_order(dest_entries, 'destination')
+
+    src = next(src_it, None)
+    dest = next(dest_it, None)
+    while src is not None or dest is not None:
+
+        if dest is None:
+            yield DiffEntry('added', src)
+            src = next(src_it, None)
+            continue
+
+        if src is None:
+            yield DiffEntry('deleted', dest)
+            dest = next(dest_it, None)
+            continue
+
+        src_key = _entry_key(src)
+        dest_key = _entry_key(dest)
+
+        if src_key < dest_key:
+            yield DiffEntry('added', src)
+            src = next(src_it, None)
+
+        elif src_key > dest_key:
+            yield DiffEntry('deleted', dest)
+            dest = next(dest_it, None)
+
+        else:
+            if _differs(src, dest, modify_window):
+                yield DiffEntry('changed', src)
+
+            src = next(src_it, None)
+            dest = next(dest_it, None)
+
+
+@dc.dataclass
+class DiffPlan():
+    """Jobs covering the differences between two trees."""
+
+    transfer: Optional[Command]
+    delete: Optional[Command]
+    added: int
+    changed: int
+    deleted: int
+    transfer_bytes: int
+    files_from: str
+    delete_list: str
+
+
+def plan_diff(command: Command,
+              src_entries: Iterable[ManifestEntry],
+              dest_entries: Iterable[ManifestEntry],
+              modify_window: float = 0.0,
+              files_from_dir: Optional[str] = None,
+) -> DiffPlan:
+    """Turn the diff of sorted manifests into jobs for a command.
+
+    The added and changed paths are written to a `--files-from` list
+    of the transfer job and the deleted ones to the list of the delete
+    job, which removes them as missing arguments, directories with
+    everything under them. Either job is `None` when it has nothing to
+    do. The lists are written as the diff streams so memory stays
+    constant.
+
+    """
+
+    if files_from_dir is None:
+        files_from_dir = tempfile.mkdtemp(prefix='py_rsync_diff_')
+
+    files_from = os.path.join(files_from_dir, 'transfer.txt')
+    delete_list = os.path.join(files_from_dir, 'delete.txt')
+
+    counts = {change : 0 for change in DIFF_CHANGES}
+    transfer_bytes = 0
+    deleted_dir = None
+    with open(files_from, 'w') as transfer_f, \
+         open(delete_list, 'w') as delete_f:
+
+        for diff in diff_manifests(src_entries, dest_entries,
+                                   modify_window=modify_window):
+
+            counts[diff.change] += 1
+
+            if diff.change == 'deleted':
+
+                # removing a directory removes everything under it
+                if (deleted_dir is not None and
+                    diff.entry.path.startswith(deleted_dir)):
+                    continue
+
+                delete_f.write(diff.entry.path + '\n')
+                if diff.entry.kind == 'd':
+                    deleted_dir = diff.entry.path + '/'
+            else:
+                transfer_f.write(diff.entry.path + '\n')
+                if diff.entry.kind == 'f':
+                    transfer_bytes += diff.entry.size
+
+    transfer = None
+    if counts['added'] or counts['changed']:
+        transfer = dc.replace(
+            command,
+            options=extend_options(command.options,
+                                   kv={'files-from' : files_from}))
+
+    delete = None
+    if counts['deleted']:
+        delete = dc.replace(
+            command,
+            options=extend_options(command.options,
+                                   flags=('delete-missing-args', 'force'),
+                                   kv={'files-from' : delete_list}))
+
+    return DiffPlan(transfer=transfer,
+                    delete=delete,
+                    added=counts['added'],
+                    changed=counts['changed'],
+                    deleted=counts['deleted'],
+                    transfer_bytes=transfer_bytes,
+                    files_from=files_from,
+                    delete_list=delete_list)
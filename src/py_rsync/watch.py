@@ -0,0 +1,318 @@
+"""Continuous syncing driven by Linux inotify events.
+
+The source tree of a command is watched with inotify (through
+`ctypes`, no extra dependency) and events are coalesced over a
+debounce window. Each batch then runs rsync with a `--files-from`
+list of only the touched paths. When the kernel event queue overflows,
+or files were deleted and the command deletes on the receiver, a full
+sync is run instead since the touched paths are no longer known.
+
+"""
+
+import ctypes
+import ctypes.util
+import dataclasses as dc
+import os
+import select
+import struct
+import tempfile
+import time
+from typing import (
+    Optional,
+    Set,
+    Dict,
+    Callable,
+)
+
+from .main import (
+    Command,
+    extend_options,
+)
+from .run import (
+    RunResult,
+    run_command,
+)
+
+__all__ = [
+    'IN_WATCH_MASK',
+    'Inotify',
+    'WatchBatch',
+    'WatchSync',
+]
+
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+IN_WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+"""The events watched on every directory of the tree."""
+
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_SIZE = 64 * 1024
+
+
+def _libc():
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int,
+                                       ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+    return libc
+
+
+class Inotify():
+    """Minimal recursive inotify watcher over a directory tree."""
+
+    def __init__(self, root, mask: int = IN_WATCH_MASK):
+
+        self.root = os.path.abspath(str(root))
+        self.mask = mask
+
+        self._libc = _libc()
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # watch descriptor to directory path relative to the root
+        self.watches: Dict[int, str] = {}
+
+        self.add_tree('')
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_watch(self, rel_dir: str) -> None:
+
+        wd = self._libc.inotify_add_watch(
+            self.fd,
+            os.fsencode(os.path.join(self.root, rel_dir)),
+            self.mask | IN_ONLYDIR)
+
+        # the directory may already be gone
+        if wd >= 0:
+            self.watches[wd] = rel_dir
+
+    def add_tree(self, rel_dir: str) -> Set[str]:
+        """Watch a directory and all below it, returning the files found.
+
+        Files created before the watch was added would otherwise be
+        missed so they are reported as touched.
+
+        """
+
+        found = set()
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            self.add_watch(current)
+
+            try:
+                entries = list(os.scandir(os.path.join(self.root, current)))
+            except OSError:
+                continue
+
+            for entry in entries:
+                rel_path = os.path.join(current, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel_path)
+                else:
+                    found.add(rel_path)
+
+        return found
+
+    def read_events(self, timeout: Optional[float] = None):
+        """Yield (mask, relative path) for the events available.
+
+        Blocks for up to `timeout` seconds for the first event.
+
+        """
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+
+                name = data[pos:pos + name_len].rstrip(b'\0')
+                pos += name_len
+
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                rel_dir = self.watches.get(wd, '')
+                yield mask, os.path.join(rel_dir, os.fsdecode(name))
+
+
+@dc.dataclass
+class WatchBatch():
+    """The touched paths collected over one debounce window."""
+
+    touched: Set[str] = dc.field(default_factory=set)
+    deleted: Set[str] = dc.field(default_factory=set)
+    overflow: bool = False
+
+    def __bool__(self) -> bool:
+        return bool(self.touched or self.deleted or self.overflow)
+
+
+class WatchSync():
+    """Run a command incrementally whenever its source tree changes."""
+
+    def __init__(self,
+                 command: Command,
+                 debounce: float = 2.0,
+                 max_latency: float = 30.0,
+                 runner: Callable[[Command], RunResult] = run_command,
+    ):
+
+        if command.src.url.host:
+            raise ValueError("Watching requires a local source endpoint")
+
+        self.command = command
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.runner = runner
+
+        self.inotify = Inotify(command.src.path)
+
+    def close(self) -> None:
+        self.inotify.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def collect(self, timeout: Optional[float] = None) -> WatchBatch:
+        """Wait for events and coalesce them until the tree is quiet.
+
+        Collection ends once no event arrived for `debounce` seconds or
+        `max_latency` seconds after the first event.
+
+        """
+
+        batch = WatchBatch()
+        first = None
+        wait = timeout
+        while True:
+
+            got_event = False
+            for mask, rel_path in self.inotify.read_events(timeout=wait):
+                got_event = True
+
+                if mask & IN_Q_OVERFLOW:
+                    batch.overflow = True
+
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    batch.deleted.add(rel_path)
+                    batch.touched.discard(rel_path)
+
+                elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    batch.touched.update(self.inotify.add_tree(rel_path))
+
+                elif not mask & IN_ISDIR and rel_path:
+                    batch.touched.add(rel_path)
+                    batch.deleted.discard(rel_path)
+
+            if not got_event:
+                return batch
+
+            if first is None:
+                first = time.monotonic()
+
+            if time.monotonic() - first >= self.max_latency:
+                return batch
+
+            wait = self.debounce
+
+    def batch_command(self, batch: WatchBatch) -> Optional[Command]:
+        """Build the command syncing a batch, `None` if nothing to do."""
+
+        deletes = bool(self.command.options and self.command.options.deletes)
+
+        if batch.overflow or (batch.deleted and deletes):
+            return self.command
+
+        paths = sorted(rel_path for rel_path in batch.touched
+                       if os.path.lexists(os.path.join(self.command.src.path,
+                                                       rel_path)))
+        if not paths:
+            return None
+
+        fd, files_from = tempfile.mkstemp(prefix='py_rsync_watch_',
+                                          suffix='.txt')
+        with os.fdopen(fd, 'w') as wf:
+            for rel_path in paths:
+                wf.write(rel_path + '\n')
+
+        return dc.replace(self.command,
+                          options=extend_options(self.command.options,
+                                                 kv={'files-from' : files_from}))
+
+    def step(self, timeout: Optional[float] = None) -> Optional[RunResult]:
+        """Collect one batch and sync it."""
+
+        batch = self.collect(timeout=timeout)
+        if not batch:
+            return None
+
+        command = self.batch_command(batch)
+        if command is None:
+            return None
+
+        try:
+            return self.runner(command)
+
+        finally:
+            files_from = ((command.options and command.options.kv) or {})\
+                .get('files-from')
+            if command is not self.command and files_from:
+                os.remove(files_from)
+
+    def run_forever(self, full_sync_first: bool = True) -> None:
+
+        if full_sync_first:
+            self.runner(self.command)
+
+        while True:
+            self.step()
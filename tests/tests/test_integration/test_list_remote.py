@@ -0,0 +1,105 @@
+import os
+import threading
+
+import pytest
+
+from py_rsync.main import Endpoint
+from py_rsync.manifest import (
+    list_remote,
+    scan_local,
+    existing_paths,
+)
+
+# runs the remote command locally, the host being taken as $0
+STANDIN_RSH = "sh -c 'exec sh -c \"$1\"'"
+
+# writes a lot to standard error before listing, like find does for
+# many unreadable directories
+NOISY_RSH = ("sh -c 'yes \"find: Permission denied\" | head -c 4000000 >&2; "
+             "exec sh -c \"$1\"'")
+
+
+@pytest.fixture
+def tree(tmp_path):
+
+    root = tmp_path / 'tree'
+    for i in range(20):
+        subdir = root / f'd{i % 4}'
+        subdir.mkdir(parents=True, exist_ok=True)
+        (subdir / f'file {i}.dat').write_bytes(b'x' * i)
+
+    os.symlink('d0', root / 'link')
+
+    return root
+
+
+def _list(root, rsh, **kwargs):
+
+    endpoint = Endpoint.construct(host='standin', path=str(root))
+    return sorted(list_remote(endpoint, rsh=rsh, cache_dir=None, **kwargs),
+                  key=lambda entry: entry.path)
+
+
+def test_list_remote_matches_local_scan(tree):
+
+    entries = _list(tree, STANDIN_RSH)
+    local = sorted(scan_local(tree), key=lambda entry: entry.path)
+
+    assert [(e.path, e.kind, e.size) for e in entries] == \
+           [(e.path, e.kind, e.size) for e in local]
+
+
+def test_list_remote_drains_stderr(tree):
+
+    result = {}
+
+    def target():
+        result['entries'] = _list(tree, NOISY_RSH)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+
+    assert not thread.is_alive(), "listing stalled on a full stderr pipe"
+    assert len([e for e in result['entries'] if e.kind == 'f']) == 20
+
+
+def test_list_remote_missing_root(tmp_path):
+
+    with pytest.raises(FileNotFoundError):
+        _list(tmp_path / 'missing', STANDIN_RSH)
+
+
+def test_list_remote_failure(tree):
+
+    with pytest.raises(RuntimeError, match="Remote listing failed"):
+        _list(tree, "sh -c 'echo unreachable >&2; exit 255'")
+
+
+def test_list_remote_caches(tree, tmp_path):
+
+    endpoint = Endpoint.construct(host='standin', path=str(tree))
+    cache_dir = tmp_path / 'cache'
+
+    first = list(list_remote(endpoint, rsh=STANDIN_RSH, cache_dir=cache_dir))
+
+    # a failing remote shell shows the second listing came from the cache
+    second = list(list_remote(endpoint, rsh='false', cache_dir=cache_dir))
+
+    assert first == second
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_existing_paths(tree, tmp_path):
+
+    endpoint = Endpoint.construct(host='standin', path=str(tree))
+    paths = ['d0/file 0.dat', 'link', "d1/it's missing", 'd9/file 9.dat']
+
+    assert existing_paths(endpoint, paths, rsh=STANDIN_RSH) == \
+        {'d0/file 0.dat', 'link'}
+
+    missing = Endpoint.construct(host='standin', path=str(tmp_path / 'missing'))
+    assert existing_paths(missing, paths, rsh=STANDIN_RSH) == set()
+
+    with pytest.raises(RuntimeError, match="Remote stat failed"):
+        existing_paths(endpoint, paths, rsh="sh -c 'echo down >&2; exit 255'")
@@ -0,0 +1,114 @@
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.run import TransferStats
+from py_rsync.block_size import (
+    LARGE_FILE_THRESHOLD,
+    BlockSizeHistory,
+    plan_large_files,
+)
+
+
+@pytest.fixture
+def command(tmp_path):
+
+    src = tmp_path / 'src'
+    for rel_path, size in [('big', 2048),
+                           ('sub/big [1].img', 4096),
+                           ('small', 10)]:
+        path = src / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * size)
+
+    return Command(src=Endpoint.construct(path=str(src)),
+                   dest=Endpoint.construct(host='host', path='/dest'),
+                   options=Options(flags=('archive', 'delete-excluded'),
+                                   includes=(),
+                                   excludes=('*.tmp',),
+                                   info=None,
+                                   kv=None))
+
+
+def test_plan_large_files(command, tmp_path):
+
+    history = BlockSizeHistory(tmp_path / 'history.jsonl')
+    plan = plan_large_files(command, history,
+                            threshold=1024,
+                            files_from_dir=str(tmp_path))
+
+    assert sorted(d.path for d in plan.decisions) == ['big', 'sub/big [1].img']
+    for job, decision in zip(plan.large, plan.decisions):
+        assert job.options.block_size == decision.block_size
+        assert 'no-whole-file' in job.options.flags
+        assert 'stats' in job.options.flags
+        with open(job.options.kv['files-from']) as rf:
+            assert rf.read() == decision.path + '\n'
+
+    # the rest job keeps the user's excludes, which delete-excluded
+    # deletes, but only hides and protects the large files
+    rest = plan.rest.options
+    assert rest.excludes == ('*.tmp',)
+    assert rest.kv == {'filter' : f'. {tmp_path}/large.rules'}
+    assert sorted((tmp_path / 'large.rules').read_text().splitlines()) == [
+        'H /big', 'H /sub/big \\[1].img',
+        'P /big', 'P /sub/big \\[1].img',
+    ]
+    assert f"--filter=. {tmp_path}/large.rules" in plan.rest.render_argv()
+
+
+def test_plan_without_large_files(command, tmp_path):
+
+    plan = plan_large_files(command,
+                            BlockSizeHistory(tmp_path / 'history.jsonl'),
+                            files_from_dir=str(tmp_path))
+
+    assert plan.large == []
+    assert plan.rest == command
+
+
+def _stats(sent, literal, matched):
+
+    return TransferStats(bytes_sent=sent,
+                         bytes_received=0,
+                         literal_data=literal,
+                         matched_data=matched)
+
+
+def test_history_explores_then_exploits(tmp_path):
+
+    path = tmp_path / 'history.jsonl'
+    history = BlockSizeHistory(path)
+    size = LARGE_FILE_THRESHOLD
+
+    wire = {2048 : 300, 8192 : 100}
+    for block_size in (2048, 8192):
+        decision = history.choose('f', size, candidates=(2048, 8192))
+        assert (decision.block_size, decision.reason) == (block_size, 'explore')
+        history.record(decision, _stats(wire[block_size], 500, 500))
+
+    decision = BlockSizeHistory(path).choose('f', size, candidates=(2048, 8192))
+    assert decision.block_size == 8192
+    assert decision.reason.startswith('least bytes')
+
+
+def test_history_skips_failed_block_sizes(tmp_path):
+
+    path = tmp_path / 'history.jsonl'
+    history = BlockSizeHistory(path)
+    size = LARGE_FILE_THRESHOLD
+
+    decision = history.choose('f', size, candidates=(2048, 8192))
+    assert history.record(decision, TransferStats(), returncode=12) is None
+
+    decision = BlockSizeHistory(path).choose('f', size, candidates=(2048, 8192))
+    assert decision.block_size == 8192
+    history.record(decision, _stats(100, 0, 0), returncode=0)
+    history.record(decision, TransferStats())
+
+    decision = BlockSizeHistory(path).choose('f', size, candidates=(2048, 8192))
+    assert decision.block_size is None
+    assert decision.reason == 'every candidate failed'
@@ -0,0 +1,102 @@
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.capabilities import (
+    RsyncCapabilities,
+    parse_version_output,
+    best_choice,
+    auto_choices,
+)
+
+VERSION_OUTPUT = """\
+rsync  version 3.2.7  protocol version 31
+Copyright (C) 1996-2022 by Andrew Tridgell, Wayne Davison, and others.
+Web site: https://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, symlinks, symtimes, hardlinks, hardlink-specials,
+    hardlink-symlinks, IPv6, atimes, batchfiles, inplace, append, ACLs,
+    xattrs, optional secluded-args, iconv, prealloc, stop-at, no crtimes
+Optimizations:
+    SIMD-roll, no asm-roll, openssl-crypto, no asm-MD5
+Checksum list:
+    xxh128 xxh3 xxh64 (xxhash) md5 md4 sha1 none
+Compress list:
+    zstd lz4 zlibx zlib none
+Daemon auth list:
+    sha512 sha256 sha1 md5 md4
+
+rsync comes with ABSOLUTELY NO WARRANTY.  This is free software, and you
+"""
+
+
+@pytest.fixture
+def local():
+
+    return parse_version_output(VERSION_OUTPUT)
+
+
+def _command(flags=('archive', 'compress'), kv=None, **fields):
+
+    return Command(src=Endpoint.construct(path='/src'),
+                   dest=Endpoint.construct(host='host', path='/dest'),
+                   options=Options(flags=flags,
+                                   includes=(),
+                                   excludes=(),
+                                   info=None,
+                                   kv=kv,
+                                   **fields))
+
+
+def test_parse_version_output(local):
+
+    assert local.version_info == (3, 2, 7)
+    assert local.protocol == 31
+    assert local.has_capability('inplace')
+    assert 'xxh128' in local.checksums
+    assert local.compressions[:2] == ('zstd', 'lz4')
+
+
+def test_best_choice():
+
+    assert best_choice(('zstd', 'lz4', 'zlib'),
+                       ('zstd', 'zlib'), ('lz4', 'zlib')) == 'zlib'
+    assert best_choice(('zstd',), ('lz4',)) is None
+
+
+def test_auto_choices(local):
+
+    remote = RsyncCapabilities(version='3.2.3',
+                               protocol=31,
+                               checksums=('xxh64', 'md5'),
+                               compressions=('lz4', 'zlib'))
+
+    options = auto_choices(_command(), local, remote).options
+
+    assert options.checksum_choice == 'xxh64'
+    assert options.kv == {'compress-choice' : 'lz4'}
+
+
+def test_auto_choices_keeps_given_choices(local):
+
+    options = auto_choices(_command(kv={'compress-choice' : 'zlib',
+                                        'checksum-choice' : 'md5'}),
+                           local).options
+    assert options.checksum_choice is None
+    assert options.kv == {'compress-choice' : 'zlib', 'checksum-choice' : 'md5'}
+
+    options = auto_choices(_command(checksum_choice='md4'), local).options
+    assert options.checksum_choice == 'md4'
+
+
+def test_auto_choices_old_rsync(local):
+
+    command = _command()
+    old = RsyncCapabilities(version='3.1.3', protocol=31)
+
+    assert auto_choices(command, local, old) is command
+    assert auto_choices(_command(flags=('archive',)), local).options.kv is None
@@ -0,0 +1,112 @@
+import subprocess
+import sys
+
+from py_rsync.capture import (
+    RingBuffer,
+    StreamCapture,
+    OutputCapture,
+)
+
+
+def _lines(capture):
+
+    lines = []
+    capture.parsers.append(lines.append)
+    return lines
+
+
+def test_ring_buffer_keeps_recent_lines():
+
+    ring = RingBuffer(capacity=10)
+    for line in (b'aaaa\n', b'bbbb\n', b'cccc\n'):
+        ring.append(line)
+
+    assert ring.getvalue() == b'bbbb\ncccc\n'
+    assert ring.dropped == 1
+
+    ring.append(b'x' * 20)
+    assert ring.getvalue() == b'x' * 20
+
+
+def test_lines_split_across_chunks():
+
+    capture = StreamCapture('stdout')
+    lines = _lines(capture)
+
+    for chunk in (b'sent 1', b'0 bytes\nrece', b'ived 5 bytes\n', b'total'):
+        capture.feed(chunk)
+    capture.close()
+
+    assert lines == ['sent 10 bytes', 'received 5 bytes', 'total']
+    assert capture.n_lines == 3
+    assert capture.text() == 'sent 10 bytes\nreceived 5 bytes\ntotal'
+
+
+def test_carriage_returns_end_lines():
+
+    capture = StreamCapture('stdout')
+    lines = _lines(capture)
+
+    # progress2 output, with a carriage return and newline split over
+    # two chunks
+    capture.feed(b'     32,768   0%\r  1,048,576  50%\r')
+    capture.feed(b'\n  2,097,152 100%\r\nsent 100 bytes\n')
+    capture.close()
+
+    assert lines == ['     32,768   0%',
+                     '  1,048,576  50%',
+                     '  2,097,152 100%',
+                     'sent 100 bytes']
+
+
+def test_output_without_line_breaks_is_bounded():
+
+    capture = StreamCapture('stdout', ring_size=1024, spill_threshold=None)
+    lines = _lines(capture)
+
+    for _ in range(100):
+        capture.feed(b'x' * 100)
+
+    assert len(capture._partial) < 1024
+    assert capture.ring.nbytes <= 1024 + 1024
+    assert all(len(line) >= 1024 for line in lines)
+
+    capture.close()
+    assert sum(len(line) for line in lines) == 10000
+
+
+def test_spill_to_file(tmp_path):
+
+    capture = StreamCapture('stdout', spill_threshold=100, spill_dir=str(tmp_path))
+
+    for i in range(50):
+        capture.feed(f'line {i}\n'.encode())
+    capture.close()
+
+    assert capture.spilled
+    assert capture.text() is None
+    with open(capture.spill_path, 'rb') as rf:
+        assert rf.read() == b''.join(f'line {i}\n'.encode() for i in range(50))
+
+    assert capture.tail().endswith('line 49\n')
+
+
+def test_output_capture_run():
+
+    script = ("import sys\n"
+              "for i in range(20000):\n"
+              "    sys.stdout.write(f'out {i}\\n')\n"
+              "    sys.stderr.write(f'err {i}\\n')\n")
+    proc = subprocess.Popen([sys.executable, '-c', script],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    capture = OutputCapture(ring_size=100)
+    errors = []
+    capture.add_parser('stderr', errors.append)
+
+    assert capture.run(proc) == 0
+    assert capture.stdout.n_lines == 20000
+    assert capture.stdout.tail().endswith('out 19999\n')
+    assert len(capture.stdout.tail()) <= 100
+    assert errors[-1] == 'err 19999'
@@ -0,0 +1,98 @@
+import pytest
+
+from py_rsync.manifest import ManifestEntry
+from py_rsync.columnar import (
+    ColumnarManifest,
+    scan_columnar,
+)
+
+ENTRIES = [
+    ManifestEntry(path='docs', kind='d', size=4096, mtime=100.0),
+    ManifestEntry(path='docs/a.txt', kind='f', size=10, mtime=100.0),
+    ManifestEntry(path='docs/b.iso', kind='f', size=5000, mtime=200.0),
+    ManifestEntry(path='docs/sub/c.iso', kind='f', size=100000, mtime=300.0),
+    ManifestEntry(path='top.txt', kind='f', size=0, mtime=400.5),
+    ManifestEntry(path='link', kind='l', size=7, mtime=500.0),
+    ManifestEntry(path='déjà vu.txt', kind='f', size=3, mtime=600.0),
+]
+
+
+@pytest.fixture
+def manifest():
+
+    return ColumnarManifest.from_entries(ENTRIES)
+
+
+def _paths(manifest, rows):
+
+    return [entry.path for entry in manifest.entries(rows)]
+
+
+def test_from_entries(manifest):
+
+    assert len(manifest) == len(ENTRIES)
+    assert list(manifest) == ENTRIES
+    assert manifest.dirname(3) == 'docs/sub'
+    assert manifest.name(3) == 'c.iso'
+    assert manifest.total_size() == sum(entry.size for entry in ENTRIES)
+
+
+def test_save_load_round_trip(manifest, tmp_path):
+
+    path = tmp_path / 'manifest.col'
+    manifest.save(path)
+
+    with ColumnarManifest.load(path) as loaded:
+        assert list(loaded) == ENTRIES
+        assert loaded.nbytes == manifest.nbytes
+        assert list(loaded.select(extensions=['.iso'])) == [2, 3]
+
+        with pytest.raises(ValueError, match="read only"):
+            loaded.append(ENTRIES[0])
+
+    assert len(loaded) == 0
+    assert loaded._mmap is None
+    loaded.close()
+
+
+def test_load_rejects_other_files(tmp_path):
+
+    path = tmp_path / 'other'
+    path.write_bytes(b'x' * 64)
+
+    with pytest.raises(ValueError, match="Not a columnar manifest"):
+        ColumnarManifest.load(path)
+
+
+@pytest.mark.parametrize('conditions, paths', [
+    ({}, ['docs/a.txt', 'docs/b.iso', 'docs/sub/c.iso', 'top.txt',
+          'déjà vu.txt']),
+    ({'kinds' : None}, [entry.path for entry in ENTRIES]),
+    ({'kinds' : 'dl'}, ['docs', 'link']),
+    ({'min_size' : 10, 'max_size' : 100000}, ['docs/a.txt', 'docs/b.iso']),
+    ({'min_size' : 5000}, ['docs/b.iso', 'docs/sub/c.iso']),
+    ({'mtime_after' : 200.0, 'mtime_before' : 400.5},
+     ['docs/b.iso', 'docs/sub/c.iso']),
+    ({'extensions' : ['.txt']}, ['docs/a.txt', 'top.txt', 'déjà vu.txt']),
+    ({'extensions' : ['.txt'], 'max_size' : 5}, ['top.txt', 'déjà vu.txt']),
+    ({'min_size' : 10**9}, []),
+])
+def test_select(manifest, conditions, paths):
+
+    assert _paths(manifest, manifest.select(**conditions)) == paths
+
+
+def test_total_size_of_selection(manifest):
+
+    assert manifest.total_size(manifest.select(extensions=['.iso'])) == 105000
+
+
+def test_scan_columnar(tmp_path):
+
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub/file').write_bytes(b'x' * 100)
+
+    manifest = scan_columnar(tmp_path)
+
+    assert _paths(manifest, manifest.select()) == ['sub/file']
+    assert manifest.total_size(manifest.select()) == 100
@@ -0,0 +1,145 @@
+import json
+
+import pytest
+
+from py_rsync.benchmark import (
+    BenchmarkResult,
+    save_results,
+)
+from py_rsync.compare import (
+    t_quantile,
+    relative_change_interval,
+    compare_results,
+    compare_files,
+    main,
+)
+
+
+@pytest.mark.parametrize('p, df, t', [
+    (0.975, 5, 2.571),
+    (0.975, 10, 2.228),
+    (0.975, 30, 2.042),
+    (0.95, 10, 1.812),
+    (0.975, 10**6, 1.960),
+])
+def test_t_quantile(p, df, t):
+
+    assert t_quantile(p, df) == pytest.approx(t, rel=0.005)
+
+
+def test_relative_change_interval():
+
+    # equal sizes and variances give 2 * (n - 1) degrees of freedom
+    baseline = [9, 10, 11, 9, 10, 11]
+    candidate = [10, 11, 12, 10, 11, 12]
+    margin = 2.228 * (2 * 0.8 / 6)**0.5 / 10
+
+    change, ci_low, ci_high = relative_change_interval(baseline, candidate)
+
+    assert change == pytest.approx(0.1)
+    assert ci_low == pytest.approx(0.1 - margin, abs=1e-3)
+    assert ci_high == pytest.approx(0.1 + margin, abs=1e-3)
+
+    # a higher confidence widens the interval
+    _, wide_low, wide_high = relative_change_interval(baseline, candidate,
+                                                      confidence=0.99)
+    assert wide_low < ci_low and wide_high > ci_high
+
+
+def test_relative_change_interval_unequal_variances():
+
+    # the noisy side dominates, with close to its own degrees of freedom
+    baseline = [10.0] * 20 + [10.1]
+    candidate = [8, 12, 9, 11, 10]
+
+    change, ci_low, ci_high = relative_change_interval(baseline, candidate)
+
+    se = (2.5 / 5 + 0.000476 / 21)**0.5
+    assert (ci_high - ci_low) / 2 == pytest.approx(2.776 * se / 10.005, rel=0.05)
+
+
+def test_relative_change_interval_degenerate():
+
+    assert relative_change_interval([10], [11, 12]) == (pytest.approx(0.15),
+                                                        None, None)
+    assert relative_change_interval([10, 10], [12, 12]) == pytest.approx(
+        (0.2, 0.2, 0.2))
+
+
+def _results(**samples):
+
+    return {name : BenchmarkResult(name=name, samples=values)
+            for name, values in samples.items()}
+
+
+BASELINE = _results(slower=[10, 10.1, 9.9, 10, 10.1],
+                    faster=[10, 10.1, 9.9, 10, 10.1],
+                    same=[10, 10.1, 9.9, 10, 10.1],
+                    noisy=[10, 10.1, 9.9, 10, 10.1],
+                    single=[10],
+                    gone=[1, 1])
+
+CANDIDATE = _results(slower=[12, 12.1, 11.9, 12, 12.1],
+                     faster=[8, 8.1, 7.9, 8, 8.1],
+                     same=[10, 10.1, 9.9, 10.1, 10],
+                     noisy=[8, 14, 9, 13, 11],
+                     single=[10.1],
+                     added=[1, 1])
+
+
+def test_compare_results():
+
+    report = compare_results(BASELINE, CANDIDATE)
+
+    assert {c.name : c.status for c in report.comparisons} == {
+        'added' : 'new',
+        'faster' : 'improvement',
+        'gone' : 'missing',
+        'noisy' : 'inconclusive',
+        'same' : 'unchanged',
+        'single' : 'unchanged',
+        'slower' : 'regression',
+    }
+    assert [c.name for c in report.regressions] == ['slower']
+    assert not report.passed
+
+
+def test_case_thresholds():
+
+    report = compare_results(BASELINE, CANDIDATE, thresholds={'slower' : 0.5})
+
+    slower, = [c for c in report.comparisons if c.name == 'slower']
+    assert slower.status == 'unchanged'
+    assert slower.threshold == 0.5
+    assert report.passed
+
+
+def test_report_output():
+
+    report = compare_results(BASELINE, CANDIDATE)
+
+    text = report.to_text()
+    assert text.splitlines()[-1] == "FAILED: 1 regression(s)"
+    assert 'regression' in [line.split()[-1] for line in text.splitlines()[1:-1]]
+
+    data = json.loads(json.dumps(report.to_dict()))
+    assert data['passed'] is False
+    assert data['confidence'] == 0.95
+    assert len(data['comparisons']) == 7
+
+
+def test_compare_files_and_main(tmp_path, capsys):
+
+    baseline_path = tmp_path / 'baseline.json'
+    candidate_path = tmp_path / 'candidate.json'
+    save_results(baseline_path, BASELINE)
+    save_results(candidate_path, CANDIDATE)
+
+    assert not compare_files(baseline_path, candidate_path).passed
+
+    assert main([str(baseline_path), str(candidate_path)]) == 1
+    assert capsys.readouterr().out.rstrip().endswith("FAILED: 1 regression(s)")
+
+    assert main([str(baseline_path), str(candidate_path),
+                 '--case-threshold', 'slower=0.5']) == 0
+    assert capsys.readouterr().out.rstrip().endswith("PASSED")
@@ -0,0 +1,170 @@
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.manifest import ManifestEntry
+from py_rsync.run import (
+    TransferStats,
+    RunResult,
+)
+from py_rsync.estimate import (
+    DEFAULT_RATES,
+    FILE_LIST_BYTES_PER_FILE,
+    bwlimit_rate,
+    summarize_manifest,
+    ManifestSummary,
+    TransferEstimator,
+)
+
+
+@pytest.mark.parametrize('value, rate', [
+    ('1000', 1000 * 1024),
+    (1000, 1000 * 1024),
+    ('1.5', 1536),
+    ('10K', 10 * 1024),
+    ('10k', 10 * 1024),
+    ('10M', 10 * 1024**2),
+    ('10MiB', 10 * 1024**2),
+    ('10MB', 10 * 1000**2),
+    ('1.5G', 1.5 * 1024**3),
+    ('0', float('inf')),
+    ('0K', float('inf')),
+])
+def test_bwlimit_rate(value, rate):
+
+    assert bwlimit_rate(value) == rate
+
+
+@pytest.mark.parametrize('value', ['', 'fast', '10X', '-1', '10 M'])
+def test_bwlimit_rate_invalid(value):
+
+    with pytest.raises(ValueError, match="Invalid bandwidth limit"):
+        bwlimit_rate(value)
+
+
+def _command(flags=('archive',), bwlimit=None, kv=None, dest_host='host'):
+
+    return Command(src=Endpoint.construct(path='/src'),
+                   dest=Endpoint.construct(host=dest_host, path='/dest'),
+                   options=Options(flags=flags,
+                                   includes=(),
+                                   excludes=(),
+                                   info=None,
+                                   kv=kv,
+                                   bwlimit=bwlimit))
+
+
+SUMMARY = ManifestSummary(n_files=1000, total_bytes=10**9)
+
+
+def test_summarize_manifest():
+
+    entries = [ManifestEntry(path='d', kind='d', size=4096, mtime=0.0),
+               ManifestEntry(path='d/a', kind='f', size=100, mtime=0.0),
+               ManifestEntry(path='d/b', kind='f', size=200, mtime=0.0),
+               ManifestEntry(path='l', kind='l', size=1, mtime=0.0)]
+
+    assert summarize_manifest(entries) == ManifestSummary(n_files=2,
+                                                          total_bytes=300)
+
+
+def test_estimate_defaults():
+
+    estimate = TransferEstimator(cache_path=None).estimate(_command(), SUMMARY)
+
+    wire_bytes = 10**9 + 1000 * FILE_LIST_BYTES_PER_FILE
+    assert estimate.runs == 0
+    assert estimate.wire_bytes == wire_bytes
+    assert estimate.file_list == pytest.approx(1000 * DEFAULT_RATES['per_file_seconds'])
+    assert estimate.checksum == 0.0
+    assert estimate.transfer == pytest.approx(wire_bytes / DEFAULT_RATES['bandwidth'])
+    assert estimate.duration == pytest.approx(estimate.file_list + estimate.transfer)
+
+
+def test_estimate_options():
+
+    estimator = TransferEstimator(cache_path=None)
+
+    compressed = estimator.estimate(_command(flags=('archive', 'compress')), SUMMARY)
+    assert compressed.wire_bytes < estimator.estimate(_command(), SUMMARY).wire_bytes
+
+    checksum = estimator.estimate(_command(flags=('archive', 'checksum')), SUMMARY)
+    assert checksum.checksum == pytest.approx(10**9 / DEFAULT_RATES['checksum_rate'])
+
+    dry_run = estimator.estimate(_command(flags=('archive', 'dry-run')), SUMMARY)
+    assert dry_run.wire_bytes == 1000 * FILE_LIST_BYTES_PER_FILE
+
+
+def test_estimate_bwlimit():
+
+    estimator = TransferEstimator(cache_path=None)
+
+    limited = estimator.estimate(_command(bwlimit='1M'), SUMMARY)
+    assert limited.transfer == pytest.approx(limited.wire_bytes / 1024**2)
+
+    from_kv = estimator.estimate(_command(kv={'bwlimit' : '1024'}), SUMMARY)
+    assert from_kv.transfer == pytest.approx(limited.transfer)
+
+    unlimited = estimator.estimate(_command(bwlimit='0'), SUMMARY)
+    assert unlimited.transfer == pytest.approx(
+        unlimited.wire_bytes / DEFAULT_RATES['bandwidth'])
+
+
+def _result(returncode=0, duration=12.0, **stats):
+
+    return RunResult(argv=['rsync'],
+                     returncode=returncode,
+                     stdout='',
+                     stderr='',
+                     stats=TransferStats(**stats),
+                     duration=duration)
+
+
+STATS = dict(files_total=1000,
+             total_size=10**9,
+             transferred_size=10**8,
+             literal_data=2 * 10**7,
+             matched_data=8 * 10**7,
+             file_list_generation_time=1.5,
+             file_list_transfer_time=0.5,
+             bytes_sent=2 * 10**7,
+             bytes_received=10**5)
+
+
+def test_record_learns_rates(tmp_path):
+
+    cache_path = tmp_path / 'estimates.json'
+    estimator = TransferEstimator(cache_path=cache_path)
+    command = _command()
+
+    rates = estimator.record(command, _result(**STATS))
+
+    assert rates.runs == 1
+    assert rates.per_file_seconds == pytest.approx(2.0 / 1000)
+    assert rates.bandwidth == pytest.approx((2 * 10**7 + 10**5) / 10.0)
+    assert rates.change_fraction == pytest.approx(0.1)
+    assert rates.literal_fraction == pytest.approx(0.2)
+    assert rates.compress_ratio is None
+
+    # a second run moves the averages towards it
+    estimator.record(command, _result(**dict(STATS, transferred_size=2 * 10**8)))
+    assert 0.1 < estimator.rates(command).change_fraction < 0.2
+
+    # the rates are saved and keyed by the hosts only
+    reloaded = TransferEstimator(cache_path=cache_path)
+    other_paths = Command(src=Endpoint.construct(path='/elsewhere'),
+                          dest=Endpoint.construct(host='host', path='/x'),
+                          options=None)
+    assert reloaded.rates(other_paths) == estimator.rates(command)
+    assert reloaded.estimate(other_paths, SUMMARY).runs == 2
+
+
+def test_record_ignores_failed_runs():
+
+    estimator = TransferEstimator(cache_path=None)
+
+    assert estimator.record(_command(), _result(returncode=23, **STATS)).runs == 0
+    assert estimator.record(_command(), _result()).runs == 0
@@ -0,0 +1,52 @@
+import concurrent.futures as cf
+
+from py_rsync.instrument import (
+    Instrument,
+    MemorySink,
+    PrometheusSink,
+)
+
+
+def _run(instrument, job_id, exit_code=0):
+
+    recorder = instrument.job(job_id)
+    with recorder.phase('render'):
+        pass
+    recorder.add_phase('transfer', 0.5)
+    recorder.record(exit_code=exit_code,
+                    bytes_sent=100,
+                    bytes_received=10,
+                    files_transferred=1)
+
+    return recorder.finish()
+
+
+def test_memory_sink():
+
+    sink = MemorySink()
+    metrics = _run(Instrument([sink]), 'job-1', exit_code=23)
+
+    assert sink.records == [metrics]
+    assert metrics.job_id == 'job-1'
+    assert metrics.exit_code == 23
+    assert metrics.phases['transfer'] == 0.5
+    assert 'render' in metrics.phases
+    assert metrics.finished >= metrics.started
+
+
+def test_prometheus_sink_from_threads(tmp_path):
+
+    path = tmp_path / 'py_rsync.prom'
+    sink = PrometheusSink(path)
+    instrument = Instrument([sink])
+
+    with cf.ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: _run(instrument, f'job-{i}', exit_code=i % 2),
+                      range(400)))
+
+    text = path.read_text()
+    assert 'py_rsync_jobs_total{exit_code="0"} 200' in text
+    assert 'py_rsync_jobs_total{exit_code="1"} 200' in text
+    assert 'py_rsync_bytes_sent_total 40000' in text
+    assert 'py_rsync_phase_seconds_total{phase="transfer"} 200.0' in text
+    assert text == sink.render()
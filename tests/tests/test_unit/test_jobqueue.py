@@ -0,0 +1,195 @@
+import time
+
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.jobqueue import (
+    JobQueue,
+    command_to_dict,
+    command_from_dict,
+)
+
+
+def _commands(n):
+
+    return [Command(src=Endpoint.construct(path=f'/src/{i}'),
+                    dest=Endpoint.construct(host='host', path=f'/dest/{i}'),
+                    options=Options(flags=('archive',),
+                                    includes=(),
+                                    excludes=('*.tmp',),
+                                    info=None,
+                                    kv={'files-from' : f'/shard_{i}.txt'}))
+            for i in range(n)]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+
+    return tmp_path / 'jobs.sqlite'
+
+
+def test_command_round_trip():
+
+    command = _commands(1)[0]
+
+    assert command_from_dict(command_to_dict(command)) == command
+
+
+def test_lease_and_complete(db_path):
+
+    with JobQueue(db_path, owner='w1') as queue:
+        assert queue.enqueue(_commands(3)) == 3
+
+        jobs = queue.lease(2)
+        assert [job.command.src.path for job in jobs] == ['/src/0', '/src/1']
+        assert [job.attempts for job in jobs] == [1, 1]
+
+        queue.complete(jobs[0])
+        queue.complete(jobs[1], returncode=23, error='partial')
+
+        assert queue.counts() == {'pending' : 1, 'running' : 0,
+                                  'done' : 1, 'failed' : 1}
+
+
+def test_live_lease_is_not_taken(db_path):
+
+    with JobQueue(db_path, owner='w1') as first, \
+         JobQueue(db_path, owner='w2') as second:
+
+        first.enqueue(_commands(1))
+        assert len(first.lease()) == 1
+        assert second.lease() == []
+
+
+def test_expired_lease_is_taken_over(db_path):
+
+    with JobQueue(db_path, owner='w1', lease_seconds=0.05) as first, \
+         JobQueue(db_path, owner='w2') as second:
+
+        first.enqueue(_commands(1))
+        job = first.lease()[0]
+        time.sleep(0.1)
+
+        taken = second.lease()
+        assert [j.id for j in taken] == [job.id]
+        assert taken[0].attempts == 2
+        assert not first.renew(job)
+
+
+def test_completion_by_non_owner_is_dropped(db_path):
+
+    with JobQueue(db_path, owner='w1', lease_seconds=0.05) as first, \
+         JobQueue(db_path, owner='w2') as second:
+
+        first.enqueue(_commands(1))
+        stale = first.lease()[0]
+        time.sleep(0.1)
+        job = second.lease()[0]
+
+        first.complete(stale, returncode=1)
+        first.flush()
+        assert second.counts()['running'] == 1
+
+        second.complete(job)
+        assert second.counts()['done'] == 1
+
+
+def test_renew_extends_lease(db_path):
+
+    with JobQueue(db_path, owner='w1', lease_seconds=0.2) as first, \
+         JobQueue(db_path, owner='w2') as second:
+
+        first.enqueue(_commands(1))
+        job = first.lease()[0]
+        for _ in range(3):
+            time.sleep(0.1)
+            assert first.renew(job)
+
+        assert second.lease() == []
+
+
+def test_recover_releases_own_and_expired_leases(db_path):
+
+    with JobQueue(db_path, owner='w1') as first, \
+         JobQueue(db_path, owner='w2') as second, \
+         JobQueue(db_path, owner='w3', lease_seconds=0.05) as third:
+
+        first.enqueue(_commands(3))
+        first.lease()
+        second.lease()
+        third.lease()
+        time.sleep(0.1)
+
+    # a restart of w1, the live lease of w2 stays
+    with JobQueue(db_path, owner='w1') as restarted:
+        assert restarted.recover() == 2
+        assert restarted.counts() == {'pending' : 2, 'running' : 1,
+                                      'done' : 0, 'failed' : 0}
+
+
+def test_recover_flushes_completions(db_path):
+
+    with JobQueue(db_path, owner='w1', batch_size=100) as queue:
+        queue.enqueue(_commands(1))
+        queue.complete(queue.lease()[0])
+
+        assert queue.recover() == 0
+        assert queue.counts()['done'] == 1
+
+
+def test_retry_failed(db_path):
+
+    with JobQueue(db_path, owner='w1') as queue:
+        queue.enqueue(_commands(2))
+
+        first, second = queue.lease(2)
+        queue.complete(first, returncode=1)
+        queue.complete(second, returncode=1)
+        assert queue.retry_failed() == 2
+
+        first, second = queue.lease(2)
+        queue.complete(first, returncode=1)
+        queue.complete(second)
+
+        assert queue.retry_failed(max_attempts=2) == 0
+        assert queue.retry_failed(max_attempts=3) == 1
+        assert queue.counts() == {'pending' : 1, 'running' : 0,
+                                  'done' : 1, 'failed' : 0}
+
+
+def test_run_keeps_leases_alive(db_path):
+
+    seen = []
+
+    with JobQueue(db_path, owner='w1', lease_seconds=0.3) as first, \
+         JobQueue(db_path, owner='w2') as second:
+
+        first.enqueue(_commands(3))
+
+        def runner(command):
+            # longer than the lease, all jobs of the batch being leased
+            # at once
+            time.sleep(0.4)
+            seen.append(second.lease())
+            return 0 if command.src.path != '/src/2' else 1
+
+        assert first.run(runner, batch=3) == 3
+        assert seen == [[], [], []]
+        assert first.counts() == {'pending' : 0, 'running' : 0,
+                                  'done' : 2, 'failed' : 1}
+
+
+def test_run_fails_raising_jobs(db_path):
+
+    def runner(command):
+        raise OSError("rsync not found")
+
+    with JobQueue(db_path, owner='w1') as queue:
+        queue.enqueue(_commands(1))
+
+        assert queue.run(runner) == 1
+        assert queue.counts()['failed'] == 1
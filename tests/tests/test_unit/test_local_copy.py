@@ -0,0 +1,232 @@
+import os
+
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.local_copy import (
+    FilterRules,
+    local_copy,
+)
+
+
+def _write(root, rel_path, data=b'data'):
+
+    path = root / rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def _command(src, dest, flags=('archive', 'delete'), includes=(), excludes=(),
+             kv=None):
+
+    return Command(src=Endpoint.construct(path=str(src)),
+                   dest=Endpoint.construct(path=str(dest)),
+                   options=Options(flags=flags,
+                                   includes=includes,
+                                   excludes=excludes,
+                                   info=None,
+                                   kv=kv))
+
+
+@pytest.fixture
+def trees(tmp_path):
+
+    src = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    _write(src, 'keep/f')
+
+    return src, dest
+
+
+def test_delete_extraneous(trees):
+
+    src, dest = trees
+    _write(dest, 'keep/f')
+    _write(dest, 'extra/a')
+    _write(dest, 'extra/sub/b')
+    _write(dest, 'keep/old')
+
+    result = local_copy(_command(src, dest))
+
+    assert sorted(result.deleted) == ['extra', 'extra/a', 'extra/sub',
+                                      'extra/sub/b', 'keep/old']
+    assert sorted(p.name for p in dest.iterdir()) == ['keep']
+    assert (dest / 'keep/f').exists()
+
+
+def test_excluded_directory_protects_contents(trees):
+
+    src, dest = trees
+    _write(dest, 'cache/data.bin')
+    _write(dest, 'cache/deeper/more.bin')
+
+    result = local_copy(_command(src, dest, excludes=('cache/',)))
+
+    assert result.deleted == []
+    assert (dest / 'cache/data.bin').exists()
+    assert (dest / 'cache/deeper/more.bin').exists()
+
+
+def test_protected_entries_keep_extraneous_directory(trees):
+
+    src, dest = trees
+    _write(dest, 'extra/a')
+    _write(dest, 'extra/b.tmp')
+
+    result = local_copy(_command(src, dest, excludes=('*.tmp',)))
+
+    assert result.deleted == ['extra/a']
+    assert (dest / 'extra/b.tmp').exists()
+    assert not (dest / 'extra/a').exists()
+
+
+def test_delete_excluded(trees):
+
+    src, dest = trees
+    _write(dest, 'cache/data.bin')
+
+    result = local_copy(_command(src, dest,
+                                 flags=('archive', 'delete-excluded'),
+                                 excludes=('cache/',)))
+
+    assert sorted(result.deleted) == ['cache', 'cache/data.bin']
+    assert not (dest / 'cache').exists()
+
+
+def test_delete_dry_run(trees):
+
+    src, dest = trees
+    _write(dest, 'extra/a')
+
+    result = local_copy(_command(src, dest, flags=('archive', 'delete', 'dry-run')))
+
+    assert sorted(result.deleted) == ['extra', 'extra/a']
+    assert (dest / 'extra/a').exists()
+
+
+def test_no_delete_without_delete_flag(trees):
+
+    src, dest = trees
+    _write(dest, 'extra/a')
+
+    result = local_copy(_command(src, dest, flags=('archive',)))
+
+    assert result.deleted == []
+    assert (dest / 'extra/a').exists()
+    assert (dest / 'keep/f').read_bytes() == b'data'
+
+
+def test_files_from_applies_filters(trees, tmp_path):
+
+    src, dest = trees
+    _write(src, 'a/keep.dat')
+    _write(src, 'a/skip.tmp')
+    _write(src, 'cache/data.bin')
+    files_from = tmp_path / 'files.txt'
+    files_from.write_text('a/keep.dat\na/skip.tmp\ncache/data.bin\n')
+
+    result = local_copy(_command(src, dest,
+                                 flags=('archive',),
+                                 excludes=('*.tmp', 'cache/'),
+                                 kv={'files-from' : str(files_from)}))
+
+    assert result.copied == ['a/keep.dat']
+    assert not (dest / 'a/skip.tmp').exists()
+    assert not (dest / 'cache').exists()
+
+
+def test_file_replaces_directory(trees):
+
+    src, dest = trees
+    _write(src, 'entry', b'file')
+    _write(dest, 'entry/nested/old')
+
+    result = local_copy(_command(src, dest))
+
+    assert 'entry' in result.deleted
+    assert (dest / 'entry').read_bytes() == b'file'
+
+
+def test_directory_replaces_file(trees):
+
+    src, dest = trees
+    _write(src, 'entry/inner', b'inner')
+    _write(dest, 'entry', b'file')
+    os.symlink('keep', dest / 'linked')
+    _write(src, 'linked/f')
+
+    result = local_copy(_command(src, dest))
+
+    assert sorted(result.deleted) == ['entry', 'linked']
+    assert (dest / 'entry/inner').read_bytes() == b'inner'
+    assert not (dest / 'linked').is_symlink()
+    assert (dest / 'keep/f').exists()
+
+
+def test_symlink_replaces_directory(trees):
+
+    src, dest = trees
+    os.symlink('keep', src / 'entry')
+    _write(dest, 'entry/old')
+
+    result = local_copy(_command(src, dest))
+
+    assert result.deleted == ['entry']
+    assert os.readlink(dest / 'entry') == 'keep'
+
+
+def test_type_change_dry_run(trees):
+
+    src, dest = trees
+    _write(src, 'entry/inner')
+    _write(dest, 'entry', b'file')
+
+    result = local_copy(_command(src, dest, flags=('archive', 'delete', 'dry-run')))
+
+    assert result.deleted == ['entry']
+    assert 'entry/inner' in result.copied
+    assert (dest / 'entry').read_bytes() == b'file'
+
+
+def test_special_files_raise_in_archive_mode(trees):
+
+    src, dest = trees
+    os.mkfifo(src / 'fifo')
+
+    with pytest.raises(ValueError, match="special files.*fifo"):
+        local_copy(_command(src, dest))
+
+    # without archive mode rsync skips them
+    result = local_copy(_command(src, dest, flags=('recursive',)))
+    assert result.copied == ['keep/f']
+
+
+@pytest.mark.parametrize('pattern, rel_path, is_dir, included', [
+    ('cache/', 'cache', True, False),
+    ('cache/', 'cache', False, True),
+    ('*.tmp', 'a/b.tmp', False, False),
+    ('/top', 'top', False, False),
+    ('/top', 'a/top', False, True),
+    ('a/b', 'x/a/b', False, False),
+])
+def test_filter_rules(pattern, rel_path, is_dir, included):
+
+    rules = FilterRules(excludes=(pattern,))
+
+    assert rules.included(rel_path, is_dir=is_dir) == included
+
+
+def test_filter_rules_included_path():
+
+    rules = FilterRules(excludes=('cache/', '*.tmp'))
+
+    assert not rules.included_path('cache', is_dir=True)
+    assert not rules.included_path('cache/data.bin')
+    assert not rules.included_path('a/cache/deeper/data.bin')
+    assert not rules.included_path('a/b.tmp')
+    assert rules.included_path('a/b.dat')
+    assert rules.included_path('cache')
@@ -0,0 +1,91 @@
+import pytest
+
+from py_rsync.logfile import (
+    compile_log_format,
+    parse_log_line,
+    iter_log_records,
+    LogTailer,
+)
+
+LOG_LINES = [
+    "2024/05/01 12:00:00 [4242] building file list",
+    "2024/05/01 12:00:01 [4242] >f+++++++++ data/new file.bin",
+    "2024/05/01 12:00:01 [4242] cL+++++++++ latest -> data/new file.bin",
+    "2024/05/01 12:00:02 [4242] *deleting   data/old file.bin",
+    "2024/05/01 12:00:02 [4242] .d..t...... data/",
+]
+
+
+@pytest.fixture
+def pattern():
+
+    return compile_log_format()
+
+
+@pytest.mark.parametrize('line, itemize, name, link', [
+    (LOG_LINES[1], '>f+++++++++', 'data/new file.bin', ''),
+    (LOG_LINES[2], 'cL+++++++++', 'latest', ' -> data/new file.bin'),
+    (LOG_LINES[3], '*deleting', 'data/old file.bin', ''),
+    (LOG_LINES[4], '.d..t......', 'data/', ''),
+])
+def test_parse_log_line(pattern, line, itemize, name, link):
+
+    record = parse_log_line(line, pattern)
+
+    assert record.matched
+    assert record.timestamp.startswith('2024/05/01 12:00:0')
+    assert record.pid == 4242
+    assert record.fields == {'itemize' : itemize, 'name' : name, 'link' : link}
+
+
+def test_parse_unmatched_line(pattern):
+
+    record = parse_log_line(LOG_LINES[0], pattern)
+
+    assert not record.matched
+    assert record.pid == 4242
+    assert record.fields == {}
+
+    assert parse_log_line("garbage", pattern).timestamp is None
+
+
+def test_custom_format():
+
+    pattern = compile_log_format('%o %b %n')
+    record = parse_log_line("2024/05/01 12:00:01 [7] send 1,048,576 a b", pattern)
+
+    assert record.fields == {'operation' : 'send', 'bytes' : 1048576, 'name' : 'a b'}
+
+    with pytest.raises(ValueError, match="not supported"):
+        compile_log_format('%Z')
+
+
+def test_iter_log_records_skips_partial_line(tmp_path):
+
+    path = tmp_path / 'rsync.log'
+    path.write_text('\n'.join(LOG_LINES))
+
+    records = list(iter_log_records(path))
+
+    assert [r.line for r in records] == LOG_LINES[:-1]
+    assert records[1].offset == len(LOG_LINES[0]) + 1
+
+
+def test_tailer(tmp_path):
+
+    path = tmp_path / 'rsync.log'
+    tailer = LogTailer(path)
+    assert list(tailer.poll()) == []
+
+    with open(path, 'w') as wf:
+        wf.write('\n'.join(LOG_LINES[:3]))
+        wf.flush()
+        assert [r.line for r in tailer.poll()] == LOG_LINES[:2]
+
+        wf.write('\n' + '\n'.join(LOG_LINES[3:]) + '\n')
+        wf.flush()
+        records = list(tailer.poll())
+
+    assert [r.line for r in records] == LOG_LINES[2:]
+    assert records[1].fields['itemize'] == '*deleting'
+    assert list(tailer.poll()) == []
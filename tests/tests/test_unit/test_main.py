@@ -0,0 +1,75 @@
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+    command_key,
+    RenderCache,
+)
+
+
+def _command(flags=('archive',), kv=None, block_size=None):
+
+    return Command(src=Endpoint.construct(path='/src'),
+                   dest=Endpoint.construct(host='host', path='/dest'),
+                   options=Options(flags=flags,
+                                   includes=(),
+                                   excludes=(),
+                                   info=None,
+                                   kv=kv,
+                                   block_size=block_size))
+
+
+def test_command_key_follows_content():
+
+    command = _command(kv={'filter' : '. rules'})
+
+    assert command_key(command) == command_key(_command(kv={'filter' : '. rules'}))
+    assert command_key(command) != command_key(_command(kv={'filter' : '. other'}))
+    hash(command_key(command))
+
+
+def test_command_key_freezes_sets():
+
+    first = _command(kv={'filter' : '. rules'})
+    second = _command(kv={'filter' : '. rules'})
+    first.options.kv = {'filter' : {'. b', '. a'}}
+    second.options.kv = {'filter' : frozenset({'. a', '. b'})}
+
+    assert command_key(first) == command_key(second)
+
+    second.options.kv = {'filter' : ('. a', '. b')}
+    assert command_key(first) != command_key(second)
+
+
+def test_command_key_rejects_unknown_values():
+
+    command = _command()
+    command.options.kv = {'filter' : bytearray(b'. rules')}
+
+    with pytest.raises(TypeError, match="bytearray"):
+        command_key(command)
+
+
+def test_render_cache():
+
+    cache = RenderCache(maxsize=1)
+    command = _command()
+
+    assert cache.render(command) == command.render()
+    assert cache.render(_command()) == command.render()
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.render(_command(flags=('archive', 'delete')))
+    assert len(cache) == 1
+    assert cache.render_argv(command) == command.render_argv()
+
+
+def test_conflicts():
+
+    with pytest.raises(ValueError, match="append & whole-file"):
+        _command(flags=('append', 'whole-file'))
+
+    # rsync takes a block size with --whole-file, it's just unused
+    assert _command(flags=('whole-file',), block_size=8192).options.conflicts() == []
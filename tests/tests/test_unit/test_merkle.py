@@ -0,0 +1,156 @@
+import os
+
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.local_copy import FilterRules
+from py_rsync.merkle import (
+    build_merkle_trees,
+    Mismatch,
+    compare_trees,
+    verify_trees,
+    verify_local_command,
+)
+
+
+def _tree(root):
+
+    (root / 'docs/sub').mkdir(parents=True)
+    (root / 'docs/a.txt').write_text('a')
+    (root / 'docs/sub/b.txt').write_text('b')
+    (root / 'empty').mkdir()
+    (root / 'top.txt').write_text('top')
+    os.symlink('top.txt', root / 'link')
+
+
+@pytest.fixture
+def trees(tmp_path):
+
+    src = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    _tree(src)
+    _tree(dest)
+
+    return src, dest
+
+
+def test_identical_trees(trees):
+
+    src, dest = trees
+
+    src_tree, dest_tree = build_merkle_trees([src, dest], workers=1)
+
+    assert src_tree.digest == dest_tree.digest
+    assert src_tree.digests == dest_tree.digests
+    assert set(src_tree.children) == {'', 'docs', 'docs/sub', 'empty'}
+    assert src_tree.children['']['link'][0] == 'l'
+    assert list(compare_trees(src_tree, dest_tree)) == []
+
+    result = verify_trees(src, dest, workers=1)
+    assert result.matches
+    assert result.mismatches == []
+
+
+def test_mismatches(trees):
+
+    src, dest = trees
+    (dest / 'docs/sub/b.txt').write_text('changed')
+    (dest / 'top.txt').unlink()
+    (dest / 'top.txt').mkdir()
+    (dest / 'extra').mkdir()
+    (dest / 'extra/file').write_text('x')
+    (src / 'new').mkdir()
+    (src / 'new/file').write_text('x')
+    os.remove(dest / 'link')
+    os.symlink('elsewhere', dest / 'link')
+
+    result = verify_trees(src, dest, workers=1)
+
+    assert not result.matches
+    assert sorted(result.mismatches, key=lambda m: m.path) == [
+        Mismatch('docs/sub/b.txt', 'content'),
+        Mismatch('extra', 'extra'),
+        Mismatch('link', 'content'),
+        Mismatch('new', 'missing'),
+        Mismatch('top.txt', 'kind'),
+    ]
+
+
+def test_matching_subtrees_are_not_descended(trees):
+
+    src, dest = trees
+    (dest / 'top.txt').write_text('changed')
+
+    src_tree, dest_tree = build_merkle_trees([src, dest], workers=1)
+    assert src_tree.digests['docs'] == dest_tree.digests['docs']
+
+    # an unequal listing of the matching subtree isn't looked at
+    dest_tree.children['docs'] = {}
+
+    assert list(compare_trees(src_tree, dest_tree)) == [
+        Mismatch('top.txt', 'content'),
+    ]
+
+
+def test_max_mismatches(trees):
+
+    src, dest = trees
+    for name in ('top.txt', 'docs/a.txt', 'docs/sub/b.txt'):
+        (dest / name).write_text('changed')
+
+    result = verify_trees(src, dest, workers=1, max_mismatches=2)
+
+    assert len(result.mismatches) == 2
+
+
+def test_rules(trees):
+
+    src, dest = trees
+    (dest / 'docs/sub/b.txt').write_text('changed')
+    (src / 'cache.tmp').write_text('x')
+
+    rules = FilterRules(excludes=('sub/', '*.tmp'))
+    src_tree, dest_tree = build_merkle_trees([src, dest], workers=1, rules=rules)
+
+    assert 'docs/sub' not in src_tree.children
+    assert 'cache.tmp' not in src_tree.children['']
+    assert verify_trees(src, dest, workers=1, rules=rules).matches
+
+
+def _command(src, dest, includes=(), excludes=(), dest_host=None):
+
+    return Command(src=Endpoint.construct(path=str(src)),
+                   dest=Endpoint.construct(host=dest_host, path=str(dest)),
+                   options=Options(flags=('archive',),
+                                   includes=includes,
+                                   excludes=excludes,
+                                   info=None,
+                                   kv=None))
+
+
+def test_verify_local_command_applies_filters(trees):
+
+    src, dest = trees
+    (src / 'docs/skip.log').write_text('x')
+    (src / 'docs/keep.log').write_text('x')
+    (dest / 'docs/keep.log').write_text('x')
+
+    assert verify_local_command(_command(src, dest,
+                                         includes=('keep.log',),
+                                         excludes=('*.log',)),
+                                workers=1).matches
+
+    result = verify_local_command(_command(src, dest), workers=1)
+    assert result.mismatches == [Mismatch('docs/skip.log', 'missing')]
+
+
+def test_verify_local_command_requires_local_endpoints(trees):
+
+    src, dest = trees
+
+    with pytest.raises(ValueError, match="local endpoints"):
+        verify_local_command(_command(src, dest, dest_host='host'))
@@ -0,0 +1,155 @@
+import types
+
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.profiles import (
+    apply_profile,
+    auto_tune,
+)
+
+
+def _options(flags=('archive',), kv=None, **fields):
+
+    return Options(flags=flags,
+                   includes=(),
+                   excludes=(),
+                   info=None,
+                   kv=kv,
+                   **fields)
+
+
+@pytest.mark.parametrize('name, flags', [
+    ('local', ('archive', 'whole-file', 'preallocate')),
+    ('lan', ('archive', 'whole-file')),
+    ('wan', ('archive', 'no-whole-file', 'compress')),
+])
+def test_apply_profile(name, flags):
+
+    assert apply_profile(_options(), name).flags == flags
+
+
+def test_apply_profile_skips_conflicting_flags():
+
+    options = apply_profile(_options(flags=('archive', 'append')), 'local')
+    assert options.flags == ('archive', 'append', 'preallocate')
+
+    options = apply_profile(_options(flags=('archive', 'no-whole-file')), 'lan')
+    assert options.flags == ('archive', 'no-whole-file')
+
+    options = apply_profile(_options(flags=('archive', 'whole-file')), 'wan')
+    assert options.flags == ('archive', 'whole-file', 'compress')
+
+
+def test_apply_profile_keeps_given_options():
+
+    options = apply_profile(_options(flags=('archive', 'inplace'), timeout=30),
+                            'wan')
+    assert options.flags == ('archive', 'inplace', 'no-whole-file', 'compress')
+    assert options.timeout == 30
+
+    options = apply_profile(_options(kv={'timeout' : '30'}), 'wan')
+    assert options.timeout is None
+    assert options.kv == {'timeout' : '30'}
+
+    assert apply_profile(_options(), 'wan').timeout == 300
+
+
+def test_apply_profile_drops_block_size_for_whole_file():
+
+    options = apply_profile(_options(block_size=8192, kv={'block-size' : '8192'}),
+                            'lan')
+    assert options.block_size is None
+    assert options.kv == {}
+
+    assert apply_profile(_options(block_size=8192), 'wan').block_size == 8192
+
+
+def test_apply_profile_unknown():
+
+    with pytest.raises(ValueError, match="not recognized"):
+        apply_profile(None, 'satellite')
+
+
+@pytest.fixture
+def command(tmp_path):
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(3):
+        (src / f'f{i}').write_bytes(b'x' * 100)
+
+    return Command(src=Endpoint.construct(path=str(src)),
+                   dest=Endpoint.construct(path=str(tmp_path / 'dest')),
+                   options=_options())
+
+
+def _runner(calls, fail=()):
+
+    def runner(command):
+        calls.append(command)
+        failed = any(flag in (command.options.flags or ()) for flag in fail)
+        return types.SimpleNamespace(returncode=1 if failed else 0)
+
+    return runner
+
+
+def test_auto_tune(command, tmp_path):
+
+    calls = []
+    cache_path = tmp_path / 'profiles.json'
+
+    result = auto_tune(command,
+                       cache_path=cache_path,
+                       runner=_runner(calls, fail=('compress',)))
+
+    assert not result.cached
+    assert set(result.timings) == {'local', 'lan'}
+    assert result.profile in ('local', 'lan')
+
+    trials = [c for c in calls if c.options.kv and 'files-from' in c.options.kv]
+    assert len(trials) == 4
+    assert all(c.dest.path == str(tmp_path / 'dest.py_rsync_trial')
+               for c in trials)
+
+    # the scratch directory is removed from the destination's parent
+    remove = calls[-1]
+    assert remove.dest.path == str(tmp_path) + '/'
+    assert remove.options.includes == ('/dest.py_rsync_trial/***',)
+    assert remove.options.excludes == ('*',)
+    assert 'delete' in remove.options.flags
+
+    calls.clear()
+    cached = auto_tune(command, cache_path=cache_path, runner=_runner(calls))
+    assert cached.cached
+    assert cached.profile == result.profile
+    assert calls == []
+
+
+def test_auto_tune_removes_scratch_on_error(command):
+
+    calls = []
+
+    def runner(command):
+        calls.append(command)
+        if command.options.kv and 'files-from' in command.options.kv:
+            raise OSError("rsync not found")
+        return types.SimpleNamespace(returncode=0)
+
+    with pytest.raises(OSError):
+        auto_tune(command, cache_path=None, runner=runner)
+
+    assert calls[-1].options.includes == ('/dest.py_rsync_trial/***',)
+
+
+def test_auto_tune_all_failed(command):
+
+    with pytest.raises(RuntimeError, match="No trial"):
+        auto_tune(command,
+                  cache_path=None,
+                  warmup=False,
+                  runner=_runner([], fail=('archive',)))
@@ -0,0 +1,135 @@
+import shlex
+
+import pytest
+
+from py_rsync.main import Endpoint
+from py_rsync.run import RunResult
+from py_rsync import relay
+from py_rsync.relay import (
+    plan_relay_tier,
+    relay_argv,
+    distribute,
+)
+
+
+def _host(name):
+
+    return Endpoint.construct(host=name, path='/data')
+
+
+def _names(pairs):
+
+    return [(src.url.host, dest.url.host) for src, dest in pairs]
+
+
+def test_plan_relay_tier_round_robin():
+
+    holders = [_host('a'), _host('b')]
+    pending = [_host(f'd{i}') for i in range(5)]
+
+    assert _names(plan_relay_tier(holders, pending, fanout=2)) == [
+        ('a', 'd0'), ('b', 'd1'), ('a', 'd2'), ('b', 'd3'),
+    ]
+
+    with pytest.raises(ValueError):
+        plan_relay_tier(holders, pending, fanout=0)
+
+
+def test_plan_relay_tier_avoids_failed_holders():
+
+    holders = [_host('a'), _host('b')]
+    pending = [_host('d0'), _host('d1')]
+    failed = {pending[0].url.to_text() : {holders[0].url.to_text()}}
+
+    assert _names(plan_relay_tier(holders, pending, fanout=1, failed=failed)) == [
+        ('b', 'd0'), ('a', 'd1'),
+    ]
+
+    # the failed holder is used when no other has room
+    assert _names(plan_relay_tier(holders[:1], pending[:1], failed=failed)) == [
+        ('a', 'd0'),
+    ]
+
+
+def test_relay_argv_runs_on_remote_holder():
+
+    argv = relay_argv(Endpoint.construct(user='u', host='a', path='/data'),
+                      _host('b'),
+                      rsh='ssh -p 2222')
+
+    assert argv[:4] == ['ssh', '-p', '2222', 'u@a']
+    assert shlex.split(argv[4])[-2:] == ['/data/', 'b:/data']
+
+
+def test_relay_argv_same_host_is_local():
+
+    argv = relay_argv(_host('a'), Endpoint.construct(host='a', path='/copy'))
+
+    assert shlex.split(argv[-1])[-2:] == ['/data/', '/copy']
+
+
+def test_relay_argv_pulls_to_local_destination():
+
+    argv = relay_argv(_host('a'), Endpoint.construct(path='/local'))
+
+    assert argv[0] == 'rsync'
+    assert argv[-2:] == ['a:/data/', '/local']
+
+
+@pytest.fixture
+def transfers(monkeypatch):
+
+    calls = []
+    fail = set()
+
+    def run_argv(argv, instrument=None):
+        holder = argv[1] if argv[0] == 'ssh' else 'source'
+        dest = shlex.split(argv[-1])[-1].split(':')[0]
+        calls.append((holder, dest))
+        return RunResult(argv=argv,
+                         returncode=1 if (holder, dest) in fail else 0,
+                         stdout='', stderr='', stats=None, duration=0.0)
+
+    monkeypatch.setattr(relay, 'run_argv', run_argv)
+
+    return calls, fail
+
+
+def test_distribute_source_only_serves_first_tier(transfers):
+
+    calls, _ = transfers
+    src = Endpoint.construct(path='/data')
+    destinations = [_host(f'd{i}') for i in range(8)]
+
+    result = distribute(src, destinations, fanout=2, workers=1)
+
+    assert result.ok
+    assert [len(tier.transfers) for tier in result.tiers] == [2, 4, 2]
+    assert [holder for holder, _ in calls].count('source') == 2
+
+
+def test_distribute_retries_from_another_holder(transfers):
+
+    calls, fail = transfers
+    fail.add(('d0', 'd2'))
+    src = Endpoint.construct(path='/data')
+    destinations = [_host(f'd{i}') for i in range(4)]
+
+    result = distribute(src, destinations, fanout=1, workers=1)
+
+    assert result.ok
+    retry = [holder for holder, dest in calls if dest == 'd2']
+    assert retry[0] == 'd0'
+    assert retry[1] != 'd0'
+
+
+def test_distribute_stops_without_progress(transfers):
+
+    _, fail = transfers
+    fail.add(('source', 'd0'))
+
+    result = distribute(Endpoint.construct(path='/data'), [_host('d0')])
+
+    assert not result.ok
+    assert [d.url.host for d in result.unreached] == ['d0']
+    assert len(result.tiers) == 1
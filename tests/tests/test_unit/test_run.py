@@ -0,0 +1,99 @@
+import stat
+
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+    default_options,
+)
+from py_rsync.run import (
+    parse_size,
+    human_readable_unit,
+    parse_stats,
+    run_command,
+)
+
+STATS_OUTPUT = """\
+Number of files: 1,205 (reg: 1,100, dir: 105)
+Number of created files: 3
+Number of deleted files: 0
+Number of regular files transferred: 12
+Total file size: 1.50G bytes
+Total transferred file size: 10.00M bytes
+Literal data: 2.00M bytes
+Matched data: 8.00M bytes
+File list size: 40.12K
+File list generation time: 0.003 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 2.10M
+Total bytes received: 3.45K
+"""
+
+
+@pytest.mark.parametrize('value, unit, size', [
+    ('1,234', 1000, 1234),
+    ('1.50K', 1000, 1500),
+    ('1.50K', 1024, 1536),
+    ('2.00M', 1024, 2 * 1024**2),
+])
+def test_parse_size(value, unit, size):
+
+    assert parse_size(value, unit=unit) == size
+
+
+@pytest.mark.parametrize('args, unit', [
+    ([], 1000),
+    (['--human-readable'], 1000),
+    (['--human-readable', '--human-readable'], 1024),
+    (['-avh'], 1000),
+    (['-avhh'], 1024),
+    (['-h', '--human-readable'], 1024),
+    (['-hh', '--no-human-readable', '-h'], 1000),
+    (['--rsh=ssh -h', 'host:/path/hh'], 1000),
+])
+def test_human_readable_unit(args, unit):
+
+    assert human_readable_unit(['rsync'] + args) == unit
+
+
+def test_parse_stats():
+
+    stats = parse_stats(STATS_OUTPUT, unit=1024)
+
+    assert stats.files_total == 1205
+    assert stats.files_transferred == 12
+    assert stats.literal_data == 2 * 1024**2
+    assert stats.matched_data == 8 * 1024**2
+    assert stats.bytes_received == int(3.45 * 1024)
+    assert stats.file_list_generation_time == 0.003
+
+
+@pytest.fixture
+def fake_rsync(tmp_path):
+
+    (tmp_path / 'stats.txt').write_text(STATS_OUTPUT)
+    path = tmp_path / 'rsync'
+    path.write_text(f"#!/bin/sh\ncat {tmp_path / 'stats.txt'}\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+    return str(path)
+
+
+def test_run_command_reads_stats_in_rendered_units(fake_rsync):
+
+    # the default options pass human-readable twice
+    command = Command(src=Endpoint.construct(path='/src'),
+                      dest=Endpoint.construct(path='/dest'),
+                      options=Options(flags=default_options['flags'],
+                                      includes=(),
+                                      excludes=(),
+                                      info=None,
+                                      kv=None))
+
+    result = run_command(command, executable=fake_rsync)
+
+    assert result.returncode == 0
+    assert result.stats.literal_data == 2 * 1024**2
+    assert result.stats.total_size == int(1.5 * 1024**3)
@@ -0,0 +1,114 @@
+import os
+import threading
+
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.small_files import (
+    plan_small_files,
+    sync_small_files,
+    _pipe,
+)
+
+
+def _command(src, dest, flags=('archive',), excludes=(), kv=None):
+
+    return Command(src=Endpoint.construct(path=str(src)),
+                   dest=Endpoint.construct(path=str(dest)),
+                   options=Options(flags=flags,
+                                   includes=(),
+                                   excludes=excludes,
+                                   info=None,
+                                   kv=kv))
+
+
+@pytest.fixture
+def src(tmp_path):
+
+    root = tmp_path / 'src'
+    for rel_path, size in [('a/small', 10),
+                           ('a/large', 4096),
+                           ('cache/small', 10),
+                           ('cache/large', 4096),
+                           ('b/skip.tmp', 10)]:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * size)
+
+    return root
+
+
+def test_plan_applies_excludes(src, tmp_path):
+
+    plan = plan_small_files(_command(src, tmp_path / 'dest',
+                                     excludes=('cache/', '*.tmp')),
+                            threshold=1024,
+                            files_from_dir=str(tmp_path))
+
+    assert sorted(path for stream in plan.streams for path in stream) == ['a/small']
+    assert (tmp_path / 'large.txt').read_text() == 'a/large\n'
+
+
+@pytest.mark.parametrize('flags, kv', [
+    (('archive', 'update'), None),
+    (('archive', 'ignore-existing'), None),
+    (('archive', 'existing'), None),
+    (('archive', 'dry-run'), None),
+    (('archive',), {'files-from' : 'list.txt'}),
+])
+def test_plan_refuses_skip_options(src, tmp_path, flags, kv):
+
+    with pytest.raises(ValueError, match="not supported"):
+        plan_small_files(_command(src, tmp_path / 'dest', flags=flags, kv=kv))
+
+
+def test_sync_small_files(src, tmp_path):
+
+    dest = tmp_path / 'dest'
+    (src / 'link').symlink_to('a/small')
+
+    # rsync itself is stood in for, the test is about the tar streams
+    result = sync_small_files(_command(src, dest, excludes=('*.tmp',)),
+                              threshold=1024,
+                              n_streams=2,
+                              executable='true')
+
+    assert result.returncode == 0
+    assert result.large is not None
+    assert result.plan.small_count == 3
+    assert (dest / 'a/small').read_bytes() == b'x' * 10
+    assert (dest / 'cache/small').read_bytes() == b'x' * 10
+    assert os.readlink(dest / 'link') == 'a/small'
+    assert not (dest / 'a/large').exists()
+    assert not (dest / 'b/skip.tmp').exists()
+
+
+def test_pipe_drains_create_stderr(tmp_path):
+
+    out = tmp_path / 'out'
+    create = ['sh', '-c',
+              'yes "tar: file changed as we read it" | head -c 4000000 >&2; '
+              'echo payload']
+    result = {}
+
+    def target():
+        _pipe(create, ['sh', '-c', f'cat > {out}'])
+        result['done'] = True
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+
+    assert not thread.is_alive(), "tar stream stalled on a full stderr pipe"
+    assert result['done']
+    assert out.read_text() == 'payload\n'
+
+
+def test_pipe_reports_create_failure(tmp_path):
+
+    with pytest.raises(RuntimeError, match="creation failed: no such file"):
+        _pipe(['sh', '-c', 'echo no such file >&2; exit 2'], ['cat'])
@@ -0,0 +1,121 @@
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.manifest import existing_paths
+from py_rsync.sparse import (
+    sparse_info,
+    plan_sparse,
+)
+
+MiB = 1024 * 1024
+
+
+def _sparse(path, size=8 * MiB):
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as wf:
+        wf.write(b'x' * 4096)
+        wf.truncate(size)
+
+
+@pytest.fixture
+def trees(tmp_path):
+
+    src = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    _sparse(src / 'new.img')
+    _sparse(src / 'vm/old [1].img')
+    _sparse(src / 'cache/skip.img')
+    (src / 'dense').write_bytes(b'x' * 4096)
+    _sparse(dest / 'vm/old [1].img')
+
+    if sparse_info(src / 'new.img').hole_bytes == 0:
+        pytest.skip("filesystem doesn't report holes")
+
+    return src, dest
+
+
+def _command(src, dest, excludes=()):
+
+    return Command(src=Endpoint.construct(path=str(src)),
+                   dest=Endpoint.construct(path=str(dest)),
+                   options=Options(flags=('archive', 'delete-excluded'),
+                                   includes=(),
+                                   excludes=excludes,
+                                   info=None,
+                                   kv=None))
+
+
+def test_sparse_info(trees):
+
+    src, _ = trees
+
+    info = sparse_info(src / 'new.img', rel_path='new.img')
+    assert info.path == 'new.img'
+    assert info.size == 8 * MiB
+    assert info.is_sparse
+    assert info.data_bytes < MiB
+
+    assert not sparse_info(src / 'dense').is_sparse
+
+
+def test_plan_sparse(trees, tmp_path):
+
+    src, dest = trees
+
+    plan = plan_sparse(_command(src, dest, excludes=('cache/',)),
+                       files_from_dir=str(tmp_path))
+
+    assert sorted(info.path for info in plan.files) == ['new.img',
+                                                        'vm/old [1].img']
+    assert (tmp_path / 'sparse.txt').read_text() == 'new.img\n'
+    assert (tmp_path / 'inplace.txt').read_text() == 'vm/old [1].img\n'
+    assert 'sparse' in plan.sparse.options.flags
+    assert 'inplace' in plan.inplace.options.flags
+
+    # the user's excludes are kept, the sparse files are only hidden
+    # and protected so delete-excluded leaves them alone
+    assert plan.rest.options.excludes == ('cache/',)
+    assert plan.rest.options.kv == {'filter' : f'. {tmp_path}/sparse.rules'}
+    assert (tmp_path / 'sparse.rules').read_text().splitlines() == [
+        'H /new.img', 'P /new.img',
+        'H /vm/old \\[1].img', 'P /vm/old \\[1].img',
+    ]
+
+
+def test_plan_sparse_first_sync(trees, tmp_path):
+
+    src, _ = trees
+
+    plan = plan_sparse(_command(src, tmp_path / 'missing'),
+                       files_from_dir=str(tmp_path))
+
+    assert len(plan.files) == 3
+    assert plan.inplace is None
+
+
+def test_plan_sparse_without_sparse_files(tmp_path):
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'dense').write_bytes(b'x' * 4096)
+    command = _command(src, tmp_path / 'dest')
+
+    plan = plan_sparse(command, files_from_dir=str(tmp_path))
+
+    assert plan.rest == command
+    assert plan.sparse is None and plan.inplace is None
+
+
+def test_existing_paths_local(trees):
+
+    _, dest = trees
+    (dest / 'link').symlink_to('missing')
+
+    assert existing_paths(Endpoint.construct(path=str(dest)),
+                          ['vm/old [1].img', 'link', 'new.img']) == \
+        {'vm/old [1].img', 'link'}
@@ -0,0 +1,155 @@
+import pytest
+
+from py_rsync.main import (
+    Endpoint,
+    Options,
+    Command,
+)
+from py_rsync.manifest import (
+    ManifestEntry,
+    scan_local,
+)
+from py_rsync.tree_diff import (
+    manifest_key,
+    scan_local_sorted,
+    sort_manifest,
+    DiffEntry,
+    diff_manifests,
+    plan_diff,
+)
+
+
+def _entry(path, kind='f', size=1, mtime=100.0):
+
+    return ManifestEntry(path=path, kind=kind, size=size, mtime=mtime)
+
+
+def _paths(entries):
+
+    return [entry.path for entry in entries]
+
+
+def test_manifest_key_keeps_directories_together():
+
+    paths = ['a-b', 'a/c', 'a', 'a/b/c', 'a.txt', 'b']
+
+    assert sorted(paths, key=manifest_key) == ['a', 'a/b/c', 'a/c',
+                                               'a-b', 'a.txt', 'b']
+
+
+def test_scan_local_sorted(tmp_path):
+
+    for path in ('a/c', 'a/b/c', 'a-b', 'a.txt'):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('x')
+
+    entries = list(scan_local_sorted(tmp_path))
+
+    assert _paths(entries) == ['a', 'a/b', 'a/b/c', 'a/c', 'a-b', 'a.txt']
+    assert sorted(entries, key=lambda e: e.path) == \
+        sorted(scan_local(tmp_path), key=lambda e: e.path)
+
+
+@pytest.mark.parametrize('chunk_size', [2, 1000])
+def test_sort_manifest(tmp_path, chunk_size):
+
+    paths = ['b', 'a/c', 'a-b', 'a', 'a/b/c', 'a/b', 'a.txt']
+
+    entries = list(sort_manifest([_entry(path) for path in paths],
+                                 chunk_size=chunk_size,
+                                 tmp_dir=str(tmp_path)))
+
+    assert _paths(entries) == sorted(paths, key=manifest_key)
+    # the runs of the external sort are removed
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_diff_manifests():
+
+    src = [_entry('a', kind='d', mtime=1.0),
+           _entry('a/changed', size=2),
+           _entry('a/same'),
+           _entry('a/touched', mtime=200.0),
+           _entry('b', kind='d'),
+           _entry('b/new'),
+           _entry('kind')]
+    dest = [_entry('a', kind='d', mtime=2.0),
+            _entry('a/changed', size=1),
+            _entry('a/gone'),
+            _entry('a/same'),
+            _entry('a/touched', mtime=100.0),
+            _entry('kind', kind='d'),
+            _entry('kind/file')]
+
+    assert list(diff_manifests(src, dest)) == [
+        DiffEntry('changed', src[1]),
+        DiffEntry('deleted', dest[2]),
+        DiffEntry('changed', src[3]),
+        DiffEntry('added', src[4]),
+        DiffEntry('added', src[5]),
+        DiffEntry('changed', src[6]),
+        DiffEntry('deleted', dest[6]),
+    ]
+
+
+def test_diff_manifests_modify_window():
+
+    src = [_entry('a', mtime=100.5)]
+    dest = [_entry('a', mtime=100.0)]
+
+    assert len(list(diff_manifests(src, dest))) == 1
+    assert list(diff_manifests(src, dest, modify_window=1)) == []
+
+
+def test_diff_manifests_requires_order():
+
+    with pytest.raises(ValueError, match="destination manifest is not sorted"):
+        list(diff_manifests([], [_entry('b'), _entry('a')]))
+
+
+def _command():
+
+    return Command(src=Endpoint.construct(path='/src'),
+                   dest=Endpoint.construct(host='host', path='/dest'),
+                   options=Options(flags=('archive',),
+                                   includes=(),
+                                   excludes=(),
+                                   info=None,
+                                   kv=None))
+
+
+def test_plan_diff(tmp_path):
+
+    src = [_entry('a', kind='d'),
+           _entry('a/changed', size=20),
+           _entry('a/new', size=300),
+           _entry('link', kind='l', size=4000)]
+    dest = [_entry('a', kind='d'),
+            _entry('a/changed', size=10),
+            _entry('old', kind='d'),
+            _entry('old/x'),
+            _entry('old/y'),
+            _entry('stale')]
+
+    plan = plan_diff(_command(), src, dest, files_from_dir=str(tmp_path))
+
+    assert (plan.added, plan.changed, plan.deleted) == (2, 1, 4)
+    assert plan.transfer_bytes == 320
+
+    with open(plan.files_from) as rf:
+        assert rf.read().splitlines() == ['a/changed', 'a/new', 'link']
+    with open(plan.delete_list) as rf:
+        assert rf.read().splitlines() == ['old', 'stale']
+
+    assert plan.transfer.options.kv == {'files-from' : plan.files_from}
+    assert plan.delete.options.kv == {'files-from' : plan.delete_list}
+    assert {'delete-missing-args', 'force'} <= set(plan.delete.options.flags)
+
+
+def test_plan_diff_without_differences(tmp_path):
+
+    entries = [_entry('a')]
+
+    plan = plan_diff(_command(), entries, entries, files_from_dir=str(tmp_path))
+
+    assert plan.transfer is None and plan.delete is None